@@ -1,14 +1,13 @@
 #!/usr/bin/env python
 """Adds snmp checks for a switch """
 
-import getopt
 import re
-import subprocess
 import sys
 
-from circonusapi import circonusapi
-from circonusapi import config
-from circuslib import log, util
+from circuslib import bulk, log, plan, snmp, util
+from circuslib import options as shared_options
+
+api = None
 
 
 # OID prefixes
@@ -35,57 +34,185 @@ metrics = [
 port_name_prefix = "%s.1" % prefix_2
 
 def get_ports(params):
-    """Looks up what ports are on the switch via snmpwalk"""
-    output = subprocess.Popen(("/usr/bin/snmpwalk", "-On", "-v2c", "-c",
-        params['community'], params['target'], port_name_prefix),
-        stdout=subprocess.PIPE).communicate()[0]
+    """Looks up what ports are on the switch via snmp"""
+    walk = snmp.backends[params.get('walker', 'native')]
     ports = {}
-    for line in output.split("\n"):
-        m = re.match(
-            r'[.0-9]+\.(\d+) = STRING: "?(?:ethernet)?([0-9/]+)"?', line)
+    for oid, value in walk(params['target'], params['community'],
+                           port_name_prefix, port=params['snmp_port'],
+                           timeout=params.get('timeout', 30)):
+        if not isinstance(value, basestring):
+            continue
+        m = re.match(r'"?(?:ethernet)?([0-9/]+)"?', value)
         if m:
-            if not params['pattern'] or re.match(params['pattern'], m.group(2)):
-                ports[m.group(2)] = m.group(1)
+            if not params['pattern'] or re.match(params['pattern'], m.group(1)):
+                ports[m.group(1)] = oid.rsplit('.', 1)[1]
     return ports
 
-def add_checks(params):
-    for name, idx in sorted(params['ports'].items()):
-        log.msgnb("Adding port %s..." % name)
-        check_bundle = {
-            "brokers": [ "/broker/%s" % params['broker'] ],
-            "config": {
-                "community": params['community'],
-                "port": params['snmp_port']
-            },
-            "display_name" : "%s port %s interface stats" % (
-                        params['friendly_name'], name),
-            "metrics": [],
-            "period": 60,
-            "status": "active",
-            "target": params['target'],
-            "timeout": 10,
-            "type": "snmp"
-        }
-
-        for m in metrics:
-            check_bundle["metrics"].append(m)
-            check_bundle['config']["oid_%s" % m['name']] = "%s.%s" % (
-                    oids[m['name']], idx)
+def make_check_bundle(params, name, idx):
+    check_bundle = {
+        "brokers": [ "/broker/%s" % params['broker'] ],
+        "config": {
+            "community": params['community'],
+            "port": params['snmp_port']
+        },
+        "display_name" : "%s port %s interface stats" % (
+                    params['friendly_name'], name),
+        "metrics": [],
+        "period": 60,
+        "status": "active",
+        "target": params['target'],
+        "timeout": 10,
+        "type": "snmp"
+    }
 
-        try:
-            api.add_check_bundle(check_bundle)
-            log.msgnf("Success")
-        except circonusapi.CirconusAPIError, e:
-            log.msgnf("Failed")
-            log.error(e)
+    for m in metrics:
+        check_bundle["metrics"].append(m)
+        check_bundle['config']["oid_%s" % m['name']] = "%s.%s" % (
+                oids[m['name']], idx)
+    return check_bundle
+
+def read_targets(filename, params):
+    """Reads a file listing switches to add checks for
+
+    Each line contains the target, the friendly name, and optionally the snmp
+    community and a pattern to limit which ports are added. Use - for the
+    community to use the default. Blank lines and lines starting with # are
+    ignored.
+
+    Returns a list of params, one for each switch.
+    """
+    targets = []
+    with open(filename) as fh:
+        for lineno, line in enumerate(fh, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) < 2 or len(fields) > 4:
+                raise ValueError("%s line %s: expected TARGET FRIENDLY_NAME"
+                                 " [COMMUNITY [PATTERN]]" % (filename, lineno))
+            target = dict(params)
+            target['target'] = fields[0]
+            target['friendly_name'] = fields[1]
+            if len(fields) > 2 and fields[2] != '-':
+                target['community'] = fields[2]
+            target['pattern'] = fields[3] if len(fields) > 3 else None
+            targets.append(target)
+    return targets
+
+def discover_ports(targets, concurrency=1):
+    """Looks up the ports on several switches at once
+
+    Sets 'ports' on each of the targets, and returns the list of targets
+    where discovery succeeded.
+    """
+    found = []
+    for r in bulk.run(get_ports, targets, concurrency,
+                      errors=(snmp.SNMPError,)):
+        if r.ok:
+            r.item['ports'] = r.value
+            found.append(r.item)
+            log.msg("%s: found %s ports" % (r.item['friendly_name'],
+                                            len(r.value)))
+        else:
+            log.error("%s: %s" % (r.item['friendly_name'], r.error))
+            log.result({
+                'action': 'discover',
+                'target': r.item['target'],
+                'description': "Discovering ports on %s" % (
+                    r.item['friendly_name']),
+                'status': 'failed',
+                'error': str(r.error)})
+    return found
+
+def find_existing_checks(targets):
+    """Finds the existing port checks for the given switches
+
+    Returns a dict of check bundles keyed by (target, port index), where the
+    port index is taken from the check's oid_name. The check bundles are
+    always fetched from the API rather than the cache, as they are about to
+    be compared against (and maybe changed).
+    """
+    wanted = set(t['target'] for t in targets)
+    prefix = "%s." % oids['name']
+    existing = {}
+    api.refresh('/check_bundle')
+    for b in api.iter_list('/check_bundle'):
+        if b.get('type') != 'snmp' or b.get('target') not in wanted:
+            continue
+        oid = b.get('config', {}).get('oid_name', '')
+        if oid.startswith(prefix):
+            existing[(b['target'], oid[len(prefix):])] = b
+    return existing
+
+def check_changes(existing, wanted):
+    """Returns the changes (to config and/or metrics) needed to make an
+    existing check's oids and metrics match what make_check_bundle would
+    create. Returns an empty dict if they already match."""
+    changes = {}
+    config = existing.get('config', {})
+    for k, v in wanted['config'].items():
+        if k.startswith('oid_') and config.get(k) != v:
+            changes['config'] = dict(config)
+            changes['config'].update(wanted['config'])
+            break
+    old_metrics = sorted((m.get('name'), m.get('type'))
+                         for m in existing.get('metrics', []))
+    new_metrics = sorted((m['name'], m['type']) for m in wanted['metrics'])
+    if old_metrics != new_metrics:
+        changes['metrics'] = wanted['metrics']
+    return changes
+
+def reconcile(targets, existing, update=False):
+    """Works out which checks need adding (or updating) to match the ports
+    discovered on each switch
+
+    Returns a list of changes and a list of (target, check bundle) for
+    existing checks whose ports weren't found.
+    """
+    existing = dict(existing)
+    changes = []
+    for t in targets:
+        for name, idx in sorted(t['ports'].items()):
+            wanted = make_check_bundle(t, name, idx)
+            b = existing.pop((t['target'], idx), None)
+            if b is None:
+                changes.append(plan.make_change(
+                    "POST", "/check_bundle", wanted,
+                    "Adding %s port %s" % (t['friendly_name'], name)))
+            elif update:
+                changed = check_changes(b, wanted)
+                if changed:
+                    changes.append(plan.make_change(
+                        "PUT", b['_cid'], plan.update_data(b, changed),
+                        "Updating %s port %s" % (t['friendly_name'], name)))
+    by_target = dict((t['target'], t) for t in targets)
+    missing = [(by_target[target], b) for (target, idx), b in
+               sorted(existing.items())]
+    return changes, missing
+
+def additions(targets):
+    """Yields changes adding checks for all discovered ports on one or more
+    switches"""
+    for t in targets:
+        for name, idx in sorted(t['ports'].items()):
+            yield plan.make_change(
+                "POST", "/check_bundle", make_check_bundle(t, name, idx),
+                "Adding %s port %s" % (t['friendly_name'], name))
+
+def add_checks(targets, concurrency=1):
+    """Adds checks for all discovered ports on one or more switches"""
+    plan.make_changes(api, additions(targets), concurrency)
 
 def usage(params):
     print "Usage: %s [opts] TARGET FRIENDLY_NAME PATTERN" % sys.argv[0]
+    print "       %s [opts] -T TARGETS_FILE" % sys.argv[0]
+    print "       %s [opts] --apply PLAN_FILE" % sys.argv[0]
     print """
-This command queries the switch using snmpwalk to discover what ports
-to add checks for. This requires that the snmpwalk command be
-available and that the switch be accessible over snmp from the machine
-that this command is run from.
+This command queries the switch over snmp to discover what ports to
+add checks for. This requires that the switch be accessible over snmp
+from the machine that this command is run from. By default the ports
+are looked up using a built in GETBULK walk; use --walker=snmpwalk to
+use the snmpwalk command instead.
 
 Arguments:
     target          -- The address of the switch
@@ -93,69 +220,149 @@ Arguments:
                        is usually the (short) hostname of the switch.
     pattern         -- An optional regex to limit which ports to add.
 
+To add checks for many switches at once, list them in a file passed with
+-T, one per line in the form:
+
+    TARGET FRIENDLY_NAME [COMMUNITY [PATTERN]]
+
+Ports on all of the switches are discovered in parallel, and then checks
+for all of them are added in one go.
+
+With --reconcile, the existing snmp checks for each switch are looked up
+first, and checks are only added for ports that don't have one yet.
+Existing checks whose port is no longer found are listed, but left alone.
+Adding --update also updates existing checks whose oids or metrics differ
+from what would be added.
+
+With --plan, the checks that would be added (or updated) are written to a
+plan file instead, which can be reviewed and later applied with --apply.
 """
     print "Options:"
-    print "  -a -- account"
     print "  -c -- SNMP community (default: %s)" % (params['community'],)
     print "  -p -- SNMP port (default: %s)" % (params['snmp_port'],)
     print "  -b -- ID of the broker to use: (default: %s)" % (
             params['broker'],)
+    print "  -T -- file listing switches to add checks for"
+    print "  -t -- snmp walk timeout in seconds (default: %s)" % (
+            params['timeout'],)
+    print "  -w -- number of switches to walk in parallel (default: %s)" % (
+            params['walk_concurrency'],)
+    print "  --walker -- how to walk the switch: native or snmpwalk" \
+          " (default: %s)" % params['walker']
+    print "  --reconcile -- only add checks for ports that don't have one"
+    print "  --update -- with --reconcile, update checks that have changed"
+    shared_options.usage(params)
 
-if __name__ == '__main__':
-    # Get the api token from the rc file
-    c = config.load_config()
-    account = c.get('general', 'default_account')
-
-    params = {
+def get_params():
+    params = shared_options.defaults()
+    params.update({
         'community': 'public',
         'snmp_port': 161,
         'broker': 1,
-        'debug': False
-    }
+        'targets_file': None,
+        'timeout': 30,
+        'walk_concurrency': 8,
+        'walker': 'native',
+        'reconcile': False,
+        'update': False
+    })
+    return params
 
-    try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], "a:b:c:dp:")
-    except getopt.GetoptError, err:
-        print str(err)
-        usage(params)
-        sys.exit(2)
+def main(argv=None):
+    global api
+    if argv is None:
+        argv = sys.argv[1:]
+    params = get_params()
 
-    for o,a in opts:
-        if o == '-a':
-            account = a
+    def handler(o, a):
         if o == '-b':
             params['broker'] = a
         if o == '-c':
             params['community'] = a
-        if o == '-d':
-            params['debug'] = not params['debug']
         if o == '-p':
-            params['snmp_port'] = a
-
-    # Rest of the command line args
-    try:
-        params['target'] = args[0]
-        params['friendly_name'] = args[1]
-    except IndexError:
-        usage(params)
-        sys.exit(1)
-    try:
-        params['pattern'] = args[2]
-    except IndexError:
-        params['pattern'] = None
+            params['snmp_port'] = int(a)
+        if o == '-T':
+            params['targets_file'] = a
+        if o == '-t':
+            params['timeout'] = float(a)
+        if o == '-w':
+            params['walk_concurrency'] = int(a)
+        if o == '--walker':
+            if a not in snmp.backends:
+                log.error("Unknown walker: %s" % a)
+                sys.exit(2)
+            params['walker'] = a
+        if o == '--reconcile':
+            params['reconcile'] = True
+        if o == '--update':
+            params['update'] = True
+    args = shared_options.parse(argv, params, usage, "b:c:p:T:t:w:",
+                                ["walker=", "reconcile", "update"], handler)
 
     # Now initialize the API
-    api_token = c.get('tokens', account)
-    api = circonusapi.CirconusAPI(api_token)
+    api = shared_options.get_api(params)
 
-    if params['debug']:
-        api.debug = True
-        log.debug_enabled = True
+    if params['apply']:
+        plan.apply_pretty(api, params['apply'], params['rate'],
+                          params['concurrency'])
+        sys.exit(0)
 
-    ports = get_ports(params)
+    # Rest of the command line args
+    if params['targets_file']:
+        try:
+            targets = read_targets(params['targets_file'], params)
+        except (IOError, ValueError), e:
+            log.error(e)
+            sys.exit(1)
+    else:
+        try:
+            params['target'] = args[0]
+            params['friendly_name'] = args[1]
+        except IndexError:
+            usage(params)
+            sys.exit(1)
+        try:
+            params['pattern'] = args[2]
+        except IndexError:
+            params['pattern'] = None
+        targets = [params]
+
+    targets = discover_ports(targets, params['walk_concurrency'])
+    if not targets:
+        # The errors for each switch have already been printed
+        log.error("Unable to discover ports on any switch")
+        sys.exit(1)
+    if params['reconcile']:
+        log.msg("Looking up existing checks")
+        changes, missing = reconcile(targets, find_existing_checks(targets),
+                                     params['update'])
+        for t, b in missing:
+            log.msg("%s: port for %s was not found (or didn't match the"
+                    " pattern)" % (t['friendly_name'], b['display_name']))
+        if not changes:
+            log.msg("All ports already have up to date checks")
+            sys.exit(0)
+        if params['plan']:
+            plan.plan_pretty(params['plan'], changes, params['rate'],
+                             params['concurrency'])
+            sys.exit(0)
+        log.msg("About to make the following changes:")
+        for c in changes:
+            log.msg(c['description'])
+        if util.confirm():
+            plan.make_changes(api, changes, params['concurrency'],
+                              total=len(changes))
+        sys.exit(0)
+    if params['plan']:
+        plan.plan_pretty(params['plan'], additions(targets), params['rate'],
+                         params['concurrency'])
+        sys.exit(0)
     log.msg("About to add checks for the following ports:")
-    for port in sorted(ports):
-        log.msg(port)
-    params['ports'] = ports
+    for t in targets:
+        for port in sorted(t['ports']):
+            log.msg("%s %s" % (t['friendly_name'], port))
     if util.confirm():
-        add_checks(params)
+        add_checks(targets, params['concurrency'])
+
+if __name__ == '__main__':
+    main()
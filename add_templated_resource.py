@@ -20,19 +20,46 @@ Example - adding graphs for all checks on switch-foo:
             -f 'display_name=(switch-foo) port (.*)' \
             switch_graph.json
 
+To review what would be added first, use --plan FILE to write the additions
+to a plan file, and --apply FILE to add them later without querying again.
+
+With a large number of matches, rendering the template can take longer than
+adding the results. --processes N renders in N processes at once, and
+--pipeline starts making changes as soon as the first resources are
+rendered, rather than rendering everything first.
+
+Additions are recorded in a journal as they are made. If a run is
+interrupted, run the same command again with --resume to skip the resources
+that were already added.
+
 For more information, see the add_templated_resource.md file.
 """
 
-import getopt
-import re
+import multiprocessing
+import os
 import sys
 
-from circonusapi import circonusapi
-from circonusapi import config
-from circuslib import log, util, template
+from circuslib import journal, log, matcher, plan, render, store, util
+from circuslib import options as shared_options
+from circuslib import template
+
+def get_params():
+    params = shared_options.defaults()
+    params.update({
+        'endpoint': 'check_bundle',
+        'filters': [],
+        'excludes': [],
+        'journal': None,
+        'resume': False,
+        'processes': 1,
+        'pipeline': False,
+        'verify_metrics': False
+    })
+    return params
 
 def usage(params):
     print "Usage: %s [opts] TEMPLATE_FILE [VAR=VALUE ...]" % sys.argv[0]
+    print "       %s [opts] --apply PLAN_FILE" % sys.argv[0]
     print """
 This command queries the switch using snmpwalk to discover what ports
 to add checks for. This requires that the snmpwalk command be
@@ -44,78 +71,114 @@ Arguments:
     VAR=VALUE       -- One or more values to substitute in the template
 """
     print "Options:"
-    print "  -a -- account"
-    print "  -d -- debug (default: %s)" % (params['debug'])
     print "  -e -- endpoint to query for template values (default: %s)" % (
             params['endpoint'])
-    print "  -f -- filter on the query (default: %s)" % (params['filter'])
+    print "  -f -- filter on the query, as field=regex. Can be given more" \
+          " than once (default: match everything)"
+    print "  -x -- exclude query results matching field=regex. Can be given" \
+          " more than once"
+    print "  --resume -- skip anything the journal says was already added"
+    print "  --journal -- where to keep the journal (default: a file in" \
+          " %s)" % journal.DEFAULT_DIRECTORY
+    print "  --processes -- number of processes to render the template in" \
+          " (default: %s, 0 for one per cpu)" % params['processes']
+    print "  --pipeline -- make changes as they are rendered, instead of" \
+          " rendering everything first"
+    print "  --verify-metrics -- skip check bundles that don't have all of" \
+          " the metrics the template uses"
+    shared_options.usage(params)
 
 def run_query(params, api):
     log.msg("Querying endpoint: %s" % params['endpoint'])
-    results = api.api_call("GET", params['endpoint'])
+    # Resources are filtered as they are parsed, so only the matching ones
+    # are kept in memory
+    results = api.iter_list(params['endpoint'])
     filtered_results = []
-    k, v = params['filter'].split('=', 1)
-    log.debug("Filter is checking that %s matches %s" % (k,v))
-    for r in results:
-        match = re.search(v, r[k])
-        if match:
-            for i, j in enumerate(match.groups()):
-                # Adds group1, group2 etc. variables
-                r['group%s' % (i+1)] = j
-            filtered_results.append(r)
+    log.debug("Filters: %s, excluding: %s" % (params['filters'],
+                                              params['excludes']))
+    try:
+        m = matcher.Matcher.from_filters(params['filters'],
+                                         params['excludes'])
+    except ValueError, e:
+        log.error(e)
+        sys.exit(2)
+    for r, groups in m.filter(results):
+        # Adds group1, group2 etc. variables
+        r.update(groups)
+        filtered_results.append(r)
 
     return filtered_results
 
-def flatten_dict(d):
-    """Flattens a dictionary/list combo into a 1-level dict.
-    Keys are compressed (e.g. {"a": {"b": 0}} becomes: {"a_b": 0}), and lists
-    are treated as dicts with numerical keys"""
-    scalars = ((k, v) for k, v in d.items() if type(v) not in [dict, list])
-    lists = ((k, v) for k, v in d.items() if type(v) == list)
-    dicts = [(k, v) for k, v in d.items() if type(v) == dict]
-    for l in lists:
-        dicts.append((l[0], dict(((k, v) for k, v in enumerate(l[1])))))
-    flattened = {}
-    flattened.update(scalars)
-    for key, d in dicts:
-        flattened_d = flatten_dict(d)
-        flattened.update(dict(("%s_%s" % (key, k), v) for k, v in
-            flattened_d.items()))
-    return flattened
-
-def merge_params(static_vars, resource):
-    merged_params = {}
-    merged_params.update(static_vars)
-    merged_params.update(flatten_dict(resource))
-    return merged_params
-
-if __name__ == '__main__':
-    # Get the api token from the rc file
-    c = config.load_config()
-    account = c.get('general', 'default_account')
-
-    params = {
-        'endpoint': 'check_bundle',
-        'filter': ".*",
-        'debug': False
-    }
-
-    try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], "a:de:f:")
-    except getopt.GetoptError, err:
-        print str(err)
-        usage(params)
-        sys.exit(2)
+def render_resources(t, results, static_vars, resource_store, processes=1):
+    """Yields the resources to add, rendering the template for each result
+    (in worker processes if processes > 1)"""
+    for processed in render.render(t, results, static_vars, resource_store,
+                                   processes):
+        # Allow multiple resources per template by making the template into a
+        # list, or with __foreach
+        if type(processed) == dict:
+            yield processed
+        else:
+            for r in processed:
+                yield r
 
-    for o,a in opts:
-        if o == '-a':
-            account = a
-        if o == '-d':
-            params['debug'] = not params['debug']
+def additions(to_add):
+    """Converts resources to add into changes (see circuslib.plan)"""
+    title_fields = store.title_fields
+    for r in to_add:
+        yield plan.make_change("POST", r['_cid'], r, "Adding entry %s" %
+                               r[title_fields[r['_cid']]])
+
+def add(params, api, changes, total=None):
+    journal_path = params['journal'] or journal.default_path(
+        'add_templated_resource', shared_options.account(params),
+        params['endpoint'], params['filters'], params['excludes'],
+        os.path.abspath(params['template']), params['vars'])
+    run_journal = journal.Journal(journal_path, params['resume'])
+    plan.make_changes(api, changes, params['concurrency'], run_journal,
+                      total)
+    run_journal.close()
+    log.msg("Journal written to %s" % run_journal.filename)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    params = get_params()
+
+    def handler(o, a):
         if o == '-e':
             params['endpoint'] = a
         if o == '-f':
-            params['filter'] = a
+            params['filters'].append(a)
+        if o == '-x':
+            params['excludes'].append(a)
+        if o == '--resume':
+            params['resume'] = True
+        if o == '--journal':
+            params['journal'] = a
+        if o == '--processes':
+            params['processes'] = int(a) or multiprocessing.cpu_count()
+        if o == '--pipeline':
+            params['pipeline'] = True
+        if o == '--verify-metrics':
+            params['verify_metrics'] = True
+    args = shared_options.parse(argv, params, usage, "e:f:x:",
+                                ["resume", "journal=", "processes=",
+                                 "pipeline", "verify-metrics"], handler)
+
+    # Now initialize the API
+    account = shared_options.account(params)
+    api = shared_options.get_api(params)
+
+    if params['apply']:
+        journal_path = params['journal'] or journal.default_path(
+            'add_templated_resource', account,
+            os.path.abspath(params['apply']))
+        run_journal = journal.Journal(journal_path, params['resume'])
+        plan.apply_pretty(api, params['apply'], params['rate'],
+                          params['concurrency'], run_journal)
+        run_journal.close()
+        sys.exit(0)
 
     # Rest of the command line args
     try:
@@ -125,52 +188,39 @@ if __name__ == '__main__':
         sys.exit(1)
     params['vars'] = args[1:]
 
-    # Now initialize the API
-    api_token = c.get('tokens', account)
-    api = circonusapi.CirconusAPI(api_token)
-
-    if params['debug']:
-        api.debug = True
-        log.debug_enabled = True
-
     t = template.Template(params['template'])
     params['vars'] = t.parse_nv_params(params['vars'])
     results = run_query(params, api)
-    to_add = []
-    for r in results:
-        merged_params = merge_params(params['vars'], r)
-        processed = t.sub(merged_params)
-        # Allow multiple resources per template by making the template into a
-        # list
-        if type(processed) == list:
-            to_add.extend(processed)
-        else:
-            to_add.append(processed)
+    if params['verify_metrics'] and \
+            params['endpoint'].strip('/') == 'check_bundle' and \
+            t.get_metrics():
+        results = util.verify_metrics_pretty(t, results)
+    resource_store = store.ResourceStore.for_api(api)
+    rendered = render_resources(t, results, params['vars'], resource_store,
+                                params['processes'])
+    if params['pipeline']:
+        # Changes are made as they are rendered, so we don't know how many
+        # there will be up front
+        if params['plan']:
+            plan.plan_pretty(params['plan'], additions(rendered),
+                             params['rate'], params['concurrency'])
+            sys.exit(0)
+        if util.confirm("Adding resources for %s matches. Continue?" % (
+                len(results))):
+            add(params, api, additions(rendered))
+        return
+    to_add = list(rendered)
+    changes = list(additions(to_add))
+    if params['plan']:
+        plan.plan_pretty(params['plan'], changes, params['rate'],
+                         params['concurrency'])
+        sys.exit(0)
     log.msg("Adding the following:")
-    # Mapping of endpoints to which attribute is used as a friendly name
-    # TODO - add this as a library function?
-    title_fields = {
-        "/graph": "title",
-        "/check_bundle": "display_name",
-        "/rule_set": "metric_name",
-        "/worksheet": "description",
-        "/template": "name",
-        "/contact_group": "name",
-        "/account": "name",
-        "/broker": "_name",
-        "/user": "email"
-    }
     for r in to_add:
-        field = title_fields[r['_cid']]
+        field = store.title_fields[r['_cid']]
         log.msg(r[field])
     if util.confirm("%s additions to be made. Continue?" % len(to_add)):
-        for r in to_add:
-            field = title_fields[r['_cid']]
-            log.msgnb("Adding entry %s..." % r[field])
-            try:
-                api.api_call("POST", r['_cid'], r)
-            except circonusapi.CirconusAPIError, e:
-                log.msgnf("Failed")
-                log.error(e)
-                continue
-            log.msgnf("Success")
+        add(params, api, changes, len(changes))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Benchmarks circuslib.bulk against a local fake API server
+
+Starts a threaded http server on localhost that answers every request after
+a fixed delay (simulating API round trip latency), then submits the same set
+of resources with increasing concurrency levels and reports the throughput.
+
+Usage: benchmarks/bulk_submit.py [COUNT] [LATENCY_MS]
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import sys
+import threading
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from circuslib import bulk
+
+
+class FakeAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    latency = 0.02
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        data = json.loads(body)
+        data['_cid'] = "%s/1" % self.path
+        response = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(response))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAPIServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def start_server(latency):
+    FakeAPIHandler.latency = latency
+    server = FakeAPIServer(('127.0.0.1', 0), FakeAPIHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.02
+    server = start_server(latency)
+    base = "http://127.0.0.1:%s" % server.server_address[1]
+
+    def post(resource):
+        req = urllib2.Request("%s%s" % (base, resource['_cid']),
+                              json.dumps(resource),
+                              {'Content-Type': 'application/json'})
+        return json.loads(urllib2.urlopen(req).read())
+
+    resources = [{'_cid': '/check_bundle', 'display_name': 'check %s' % i}
+                 for i in range(count)]
+    print "%s resources, %sms simulated latency" % (count, latency * 1000)
+    print "%6s %10s %10s" % ("-j", "seconds", "req/s")
+    for concurrency in (1, 2, 4, 8, 16, 32):
+        start = time.time()
+        results = list(bulk.run(post, resources, concurrency))
+        elapsed = time.time() - start
+        assert [r.index for r in results] == range(count)
+        assert all(r.ok for r in results)
+        print "%6s %10.2f %10.1f" % (concurrency, elapsed, count / elapsed)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
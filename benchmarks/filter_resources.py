@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Benchmarks filtering a large listing of resources
+
+Compares the previous approach of sorting the whole listing and then calling
+re.search with the raw pattern for each resource, against circuslib.matcher,
+which compiles its patterns once and filters before sorting.
+
+Usage: benchmarks/filter_resources.py [COUNT]
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from circuslib import matcher
+
+
+def make_resources(count):
+    random.seed(0)
+    kinds = ['http', 'snmp', 'ping_icmp', 'mysql', 'postgres']
+    return [{'_cid': '/check_bundle/%s' % i,
+             'display_name': 'host%s.dc%s.example.com %s' % (
+                 random.randint(0, 5000), random.randint(1, 4),
+                 random.choice(kinds)),
+             'type': random.choice(kinds)} for i in range(count)]
+
+
+def legacy(resources, pattern, exclude):
+    matching = []
+    for r in sorted(resources):
+        m = re.search(pattern, r['display_name'])
+        if m and not re.search(exclude, r['display_name']):
+            matching.append((r, dict(("group%s" % (i + 1), g)
+                                     for i, g in enumerate(m.groups()))))
+    return matching
+
+
+def compiled(resources, pattern, exclude):
+    m = matcher.Matcher([('display_name', pattern)],
+                        [('display_name', exclude)])
+    return sorted(m.filter(resources))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    resources = make_resources(count)
+    pattern = r'^(host\d+)\.dc2\.example\.com (http|mysql)$'
+    exclude = r'host1\d\d\.'
+    print "Filtering %s resources" % count
+    start = time.time()
+    legacy_out = legacy(resources, pattern, exclude)
+    legacy_time = time.time() - start
+    start = time.time()
+    compiled_out = compiled(resources, pattern, exclude)
+    compiled_time = time.time() - start
+    assert legacy_out == compiled_out
+    print "%s matches" % len(compiled_out)
+    print "%10s %10s %14s" % ("", "seconds", "resources/s")
+    print "%10s %10.2f %14.0f" % ("legacy", legacy_time, count / legacy_time)
+    print "%10s %10.2f %14.0f" % ("matcher", compiled_time,
+                                  count / compiled_time)
+    print "Speedup: %.1fx" % (legacy_time / compiled_time)
+
+
+if __name__ == '__main__':
+    main()
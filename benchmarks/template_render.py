@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Benchmarks circuslib.template rendering
+
+Renders a graph template (in the style of the one described in
+add_templated_resource.md) once for each of a number of synthetic resources,
+using both the compiled template engine and the previous implementation,
+which walked the whole template running re.sub on every string for every
+resource. The output of both is checked to be identical. The compiled
+template is also rendered across PROCESSES worker processes (see
+circuslib.render), which should approach PROCESSES times faster on a machine
+with that many cores.
+
+Usage: benchmarks/template_render.py [COUNT] [PROCESSES]
+"""
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from circuslib import render, template
+
+TEMPLATE = {
+    "_cid": "/graph",
+    "__vars": {"check": "{strip_endpoint:_checks_0}"},
+    "title": "{group1} http",
+    "style": "area",
+    "tags": ["site:{group1}", "type:http"],
+    "guides": [],
+    "composites": [],
+    "description": None,
+    "max_left_y": None,
+    "datapoints": [dict(
+        alpha="0.3", axis="l", check_id="{check}", color="#33aa33",
+        data_formula=None, derive="gauge", hidden=False, legend_formula=None,
+        metric_name=metric, metric_type="numeric", stack=None,
+        name="{group1} http %s (ms)" % metric)
+        for metric in ("tt_connect", "tt_firstbyte", "duration", "code")]
+}
+
+
+class LegacyTemplate(template.Template):
+    """The template implementation before templates were compiled"""
+    def sub(self, params):
+        return self._process(self.template, params)
+
+    def _process(self, i, params):
+        if type(i) == dict:
+            return dict((self._process_str(k, params), self._process(v, params))
+                        for k, v in i.items())
+        if type(i) == list:
+            return [self._process(v, params) for v in i]
+        if type(i) == str or type(i) == unicode:
+            return self._process_str(i, params)
+        return i
+
+    def _process_str(self, s, params):
+        return re.sub("{(?:([a-zA-Z_]+):)?([^ }]+)}",
+                lambda m: self._legacy_expand_var(m.group(1), m.group(2),
+                                                  params), s)
+
+    def _legacy_expand_var(self, filter_name, var, params):
+        expansion = None
+        if var in params:
+            expansion = params[var]
+        elif var in self.vars:
+            expansion = self.vars[var]
+        if not expansion:
+            raise ValueError("Unable to expand variable %s" % var)
+        expansion = self._process_str(expansion, params)
+        return self._apply_filter(filter_name, expansion)
+
+
+def bench(t, resources):
+    start = time.time()
+    out = [t.sub(r) for r in resources]
+    return time.time() - start, out
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    fd, filename = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as fh:
+        json.dump(TEMPLATE, fh)
+    resources = [{'group1': 'www%s.example.com' % i,
+                  '_checks_0': '/check/%s' % i} for i in range(count)]
+    print "Rendering a graph template for %s resources" % count
+    legacy_time, legacy_out = bench(LegacyTemplate(filename), resources)
+    compiled_time, compiled_out = bench(template.Template(filename),
+                                        resources)
+    start = time.time()
+    parallel_out = list(render.render(template.Template(filename), resources,
+                                      processes=processes))
+    parallel_time = time.time() - start
+    os.unlink(filename)
+    assert legacy_out == compiled_out == parallel_out
+    print "%10s %10s %12s" % ("", "seconds", "renders/s")
+    print "%10s %10.2f %12.0f" % ("legacy", legacy_time, count / legacy_time)
+    print "%10s %10.2f %12.0f" % ("compiled", compiled_time,
+                                  count / compiled_time)
+    print "%10s %10.2f %12.0f" % ("%s procs" % processes, parallel_time,
+                                  count / parallel_time)
+    print "Speedup: %.1fx" % (legacy_time / compiled_time)
+
+
+if __name__ == '__main__':
+    main()
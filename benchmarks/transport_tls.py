@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""Benchmarks circuslib.transport against a local TLS stub server
+
+Starts a threaded https server on localhost (with a throwaway self-signed
+certificate made using the openssl command) that answers every request
+after a fixed delay, then makes the same number of API calls with a new
+connection per call, over a pool of keep-alive connections (with and
+without gzip), and from an event loop (circuslib.eventclient), at several
+concurrency levels.
+
+Usage: benchmarks/transport_tls.py [COUNT] [LATENCY_MS]
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from circuslib import bulk, eventclient, transport
+
+
+class StubAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.005
+    # Buffer the response so it goes out in one packet, rather than one
+    # per header (which runs into delayed acks on keep-alive connections)
+    wbufsize = -1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = transport.decompress(body)
+        time.sleep(self.latency)
+        data = json.loads(body)
+        data['_cid'] = "%s/1" % self.path
+        response = json.dumps(data)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            response = transport.compress(response)
+            gzipped = True
+        else:
+            gzipped = False
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', len(response))
+        self.end_headers()
+        self.wfile.write(response)
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubAPIServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, handler, certfile):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.certfile = certfile
+
+    def get_request(self):
+        sock, address = self.socket.accept()
+        sock = ssl.wrap_socket(sock, certfile=self.certfile,
+                               server_side=True)
+        return sock, address
+
+    def handle_error(self, request, address):
+        # Clients closing their connections when they are done isn't
+        # interesting
+        pass
+
+
+def make_certificate(directory):
+    certfile = os.path.join(directory, 'stub.pem')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-days', '1', '-subj', '/CN=localhost', '-keyout', certfile,
+             '-out', certfile], stdout=devnull, stderr=devnull)
+    return certfile
+
+
+def start_server(latency, certfile):
+    StubAPIHandler.latency = latency
+    server = StubAPIServer(('127.0.0.1', 0), StubAPIHandler, certfile)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.005
+    directory = tempfile.mkdtemp()
+    try:
+        server = start_server(latency, make_certificate(directory))
+        port = server.server_address[1]
+        resources = [{'_cid': '/check_bundle',
+                      'display_name': 'check %s' % i,
+                      'notes': 'x' * 2048} for i in range(count)]
+        print "%s resources, %sms simulated latency" % (count,
+                                                        latency * 1000)
+        print "%-22s %6s %10s %10s %12s" % ("transport", "-j", "seconds",
+                                            "req/s", "connections")
+        modes = [
+            ('new connection', {'keepalive': False}),
+            ('keep-alive', {'keepalive': True}),
+            ('keep-alive + gzip', {'keepalive': True, 'gzip': True})]
+        for concurrency in (1, 4, 16, 64):
+            for name, kwargs in modes + [('event loop', None)]:
+                context = ssl._create_unverified_context()
+                if kwargs is None:
+                    api = eventclient.EventTransport(
+                        'token', '127.0.0.1', port=port,
+                        max_in_flight=concurrency, ssl_context=context)
+                    run = bulk.run_futures(
+                        lambda r: api.submit('POST', r['_cid'], r),
+                        resources, concurrency)
+                else:
+                    api = transport.Transport(
+                        'token', '127.0.0.1', port=port,
+                        pool_size=concurrency, ssl_context=context, **kwargs)
+                    run = bulk.run(
+                        lambda r: api.api_call('POST', r['_cid'], r),
+                        resources, concurrency)
+                start = time.time()
+                results = list(run)
+                elapsed = time.time() - start
+                assert all(r.ok for r in results)
+                print "%-22s %6s %10.2f %10.1f %12s" % (
+                    name, concurrency, elapsed, count / elapsed,
+                    getattr(api, 'created', None) or api.pool.created)
+                api.close()
+        server.shutdown()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
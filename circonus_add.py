@@ -14,71 +14,98 @@ accepts two different file formats:
 The content of each resource is sent directly to the API. See the API
 documentation for information on what this should contain, or use circonusvi
 to take a look at existing resources for examples.
+
+With --sync, the file is treated as the desired state instead: existing
+resources are matched up with the ones in the file using an identity key
+(e.g. a graph's title, or the field given with -k), and only the resources
+that are missing or different are added or updated. With --prune, existing
+resources (of the types in the file) that aren't in the file are deleted.
+Running the same sync again makes no changes.
+
+Resources can refer to others in the same file that are about to be added,
+e.g. a graph of a new check bundle's metrics. Name a resource with a _ref
+key, and use placeholders such as {ref:NAME} (its new _cid) or
+{id:NAME._checks.0} (the id of its first check) in the others. Resources
+are then added in dependency order (as many at once as -j allows), the ids
+are filled in as they are created, and anything that refers to a resource
+that failed to be added is skipped. See circuslib/scheduler.py for details.
+
+Each run records which resources have been added in a journal. If a run is
+interrupted, running the same command again with --resume only adds the
+resources that weren't added the first time.
 """
-import getopt
-import json
+import os
 import re
 import sys
 
-from circonusapi import circonusapi
-from circonusapi import config
-from circuslib import util
+from circuslib import journal, jsonstream, log, plan, scheduler, sync, util
+from circuslib import options as shared_options
 
-conf = config.load_config()
+options = None
 
-options = {
-    'account': conf.get('general', 'default_account'),
-    'debug': False
-}
+def get_options():
+    opts = shared_options.defaults()
+    opts.update({
+        'journal': None,
+        'resume': False,
+        'sync': False,
+        'prune': False,
+        'keys': []
+    })
+    return opts
 
-def usage():
+def usage(opts):
     print "Usage:"
     print sys.argv[0], "[options] [FILENAME]"
+    print sys.argv[0], "[options] --apply PLAN_FILENAME"
     print
     print "Reads in a json file with a list of resources to add"
     print
-    print "  -a -- Specify which account to use"
-    print "  -d -- Enable debug mode"
+    print "  --resume -- skip anything the journal says was already added"
+    print "  --journal -- where to keep the journal (default: a file in" \
+          " %s)" % journal.DEFAULT_DIRECTORY
+    print "  --sync -- only add or update resources that differ from the file"
+    print "  --prune -- with --sync, delete resources that aren't in the file"
+    print "  -k -- with --sync, the field to match resources on, as FIELD or" \
+          " ENDPOINT=FIELD. Can be given more than once (default: the title)"
+    shared_options.usage(opts)
 
-def parse_options():
-    try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], "a:d?")
-    except getopt.GetoptError, err:
-        # print help information and exit:
-        print str(err) # will print something like "option -a not recognized"
-        usage()
-        sys.exit(2)
+def parse_options(argv):
+    opts = get_options()
 
-    for o,a in opts:
-        if o == '-a':
-            options['account'] = a
-        if o == '-d':
-            options['debug'] = not options['debug']
-        if o == '-?':
-            usage()
-            sys.exit(0)
-    return args
-
-def get_api():
-    token = conf.get('tokens', options['account'], None)
-    api = circonusapi.CirconusAPI(token)
-    if options['debug']:
-        api.debug = True
-    return api
-
-def make_changes(changes):
-    for c in changes:
-        print "Making API Call: %s %s ..." % (c['action'], c['endpoint']),
-        if c['action'] == 'DELETE':
-            # We don't send any data along for deletions
-            c['data'] = None
-        try:
-            api.api_call(c['action'], c['endpoint'], c['data'])
-        except circonusapi.CirconusAPIError, e:
-            print "Error"
-            print "    %s" % e
-            continue
-        print "Success"
+    def handler(o, a):
+        if o == '--resume':
+            opts['resume'] = True
+        if o == '--journal':
+            opts['journal'] = a
+        if o == '--sync':
+            opts['sync'] = True
+        if o == '--prune':
+            opts['prune'] = True
+        if o == '-k':
+            opts['keys'].append(a)
+    args = shared_options.parse(argv, opts, usage, "k:",
+                                ["resume", "journal=", "sync", "prune"],
+                                handler)
+    return opts, args
+
+def make_changes(api, changes, concurrency=1):
+    """Makes a list of changes (see circuslib.plan). Each change has an
+    action (POST/PUT/DELETE), endpoint and data."""
+    return plan.make_changes(api, changes, concurrency)
+
+def dedup_keys(pairs):
+    # Makes any duplicate keys in a sequence of (key, value) pairs unique by
+    # appending /x1, /x2 and so on to the end. See json_pairs_hook_dedup_keys.
+    seen = set()
+    ctr = 0
+    for k,v in pairs:
+        oldk = k
+        while k in seen:
+            ctr += 1
+            k = "%s/x%s" % (oldk, ctr)
+        seen.add(k)
+        yield k, v
 
 def json_pairs_hook_dedup_keys(data):
     # json decoder object_pairs_hook that allows duplicate keys, and makes
@@ -88,60 +115,147 @@ def json_pairs_hook_dedup_keys(data):
     # error about duplicate keys when decoding the json. Separate code
     # elsewhere automatically strips off the /x1 when selecting the endpoint
     # to use for adding entries.
-    d = {}
-    ctr = 0
-    for k,v in data:
-        oldk = k
-        while k in d:
-            ctr += 1
-            k = "%s/x%s" % (oldk, ctr)
-        d[k] = v
-    return d
+    return dict(dedup_keys(data))
+
+def iter_json_file(filename):
+    """Yields the resources in a json file one at a time
 
-def load_json_file(filename):
+    We accept two formats for adding data: a json list, where the '_cid'
+    field is the endpoint to add, or a json object, where the keys are the
+    endpoints (duplicate keys are allowed). Either way, resources are
+    yielded with the endpoint in '_cid'. The file is parsed incrementally,
+    so memory use doesn't depend on the size of the file.
+    """
     with open(filename) as fh:
-        return json.load(fh, object_pairs_hook=json_pairs_hook_dedup_keys)
+        pairs = jsonstream.iterload(fh,
+            object_pairs_hook=json_pairs_hook_dedup_keys)
+        for k, v in dedup_keys(pairs):
+            # Keys are endpoints for the object format, and list indexes
+            # for the list format
+            if isinstance(k, basestring):
+                v['_cid'] = k
+            yield v
+
+def get_endpoint(resource):
+    return re.sub("(?!^)/.*", "", resource['_cid'])
 
-def fix_data_format(data):
-    """We accept two formats for adding data:
+def additions(data):
+    """Converts resources to add into changes (see circuslib.plan)"""
+    for i in data:
+        endpoint = get_endpoint(i)
+        yield plan.make_change("POST", endpoint, i,
+                               "Making API Call: POST %s" % endpoint)
 
-    A json list, where the '_cid' field is the endpoint to add. We strip off
-    any resource ID from the end.
+def make_additions(api, data, concurrency=1, run_journal=None, total=None):
+    return plan.make_changes(api, additions(data), concurrency, run_journal,
+                             total)
 
-    A json object (python dict), where the keys are the endpoints to add.
-    Again we strip off any resource ID. The json parser also will accept
-    duplicate keys and dedup them upon loading.
+def get_journal(filename):
+    """Opens the journal for a run on the given input (or plan) file"""
+    path = options['journal'] or journal.default_path(
+        'circonus_add', shared_options.account(options),
+        os.path.abspath(filename))
+    return journal.Journal(path, options['resume'])
 
-    This function converts the object/dict format into the list format, if
-    needed.
-    """
-    if type(data) == dict:
-        new_data = []
-        for k, v in data.items():
-            v['_cid'] = k
-            new_data.append(v)
-        return new_data
-    return data
-
-def make_additions(api, data):
-    for i in data:
-        endpoint = re.sub("(?!^)/.*", "", i['_cid'])
-        print "Making API Call: POST %s ..." % (endpoint),
-        try:
-            api.api_call("POST", endpoint, i)
-        except circonusapi.CirconusAPIError, e:
-            print "Error"
-            print "    %s" % e
-            continue
-        print "Success"
+def desired_resources(filename):
+    """Yields the resources in a json file for syncing. The /x1, /x2 etc.
+    added to duplicate keys are removed, so only real resource ids are
+    left in _cid."""
+    for resource in iter_json_file(filename):
+        resource['_cid'] = re.sub("^(/?[a-z_]+)/x[0-9]+$", r"\1",
+                                  resource['_cid'])
+        yield resource
 
-if __name__ == '__main__':
-    args = parse_options()
+def sync_changes(api, filename):
+    """Works out the changes needed to make the account match a file"""
+    log.msg("Comparing %s with existing resources" % filename)
+    return list(sync.diff(api, desired_resources(filename),
+                          sync.parse_keys(options['keys']),
+                          options['prune']))
+
+def run_sync(api, filename):
+    changes = sync_changes(api, filename)
+    if options['plan']:
+        plan.plan_pretty(options['plan'], changes, options['rate'],
+                         options['concurrency'])
+        return
+    if not changes:
+        log.msg("Everything is already in sync")
+        return
+    for c in changes:
+        log.debug(c['description'])
+    plan.print_summary(plan.summarize(changes), options['rate'],
+                       options['concurrency'])
+    if util.confirm("%s changes, OK to continue?" % len(changes)):
+        make_changes(api, changes, options['concurrency'])
+
+def run_ordered(filename, count):
+    """Adds resources that refer to each other (see circuslib.scheduler).
+    The whole file is loaded, as the order depends on all of it."""
+    if options['plan']:
+        log.error("Plans can't be written for files with _ref placeholders,"
+                  " as the ids aren't known until the resources are added")
+        sys.exit(1)
+    if options['resume']:
+        log.error("--resume isn't supported for files with _ref"
+                  " placeholders")
+        sys.exit(1)
+    resources = list(iter_json_file(filename))
+    try:
+        resource_levels = scheduler.levels(resources)[0]
+    except scheduler.SchedulerError, e:
+        log.error(str(e))
+        sys.exit(1)
+    if util.confirm("%s additions in %s levels, OK to continue?" % (
+            count, len(resource_levels))):
+        scheduler.run(shared_options.get_api(options), resources,
+                      get_endpoint, options['concurrency'])
+
+def main(argv=None):
+    global options
+    if argv is None:
+        argv = sys.argv[1:]
+    options, args = parse_options(argv)
+    if options['apply']:
+        run_journal = get_journal(options['apply'])
+        plan.apply_pretty(shared_options.get_api(options), options['apply'],
+                          options['rate'], options['concurrency'],
+                          run_journal)
+        run_journal.close()
+        sys.exit(0)
     if len(args) != 1:
-        usage()
+        usage(options)
         sys.exit(2)
-    api = get_api()
-    data = load_json_file(args[0])
-    data = fix_data_format(data)
-    if util.confirm("%s additions, OK to continue?" % len(data)):
-        make_additions(api, data)
+    if options['sync']:
+        run_sync(shared_options.get_api(options), args[0])
+        sys.exit(0)
+    # The file is read twice, once to count the resources and once as they
+    # are added, to avoid holding it all in memory
+    count = 0
+    has_refs = False
+    for i in iter_json_file(args[0]):
+        count += 1
+        has_refs = has_refs or scheduler.has_refs(i)
+    if has_refs:
+        run_ordered(args[0], count)
+        sys.exit(0)
+    if options['plan']:
+        plan.plan_pretty(options['plan'], additions(iter_json_file(args[0])),
+                         options['rate'], options['concurrency'])
+        sys.exit(0)
+    api = shared_options.get_api(options)
+    run_journal = get_journal(args[0])
+    if run_journal.done:
+        # Don't count those in the confirmation or progress
+        done = run_journal.count_done(additions(iter_json_file(args[0])))
+        log.msg("%s additions were already made according to the journal" % (
+            done))
+        count -= done
+    if util.confirm("%s additions, OK to continue?" % count):
+        make_additions(api, iter_json_file(args[0]), options['concurrency'],
+                       run_journal, count)
+        log.msg("Journal written to %s" % run_journal.filename)
+    run_journal.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""Bulk submission engine
+
+Runs a function (usually an API call) over a list of items using a bounded
+pool of worker threads. Results are handed back in the same order as the
+input, regardless of the order in which they complete, so that callers can
+report per-item success/failure exactly as they would from a serial loop.
+
+run_futures does the same for functions that start a call and return a
+future for it (e.g. Client.submit with an evented api), without any
+threads.
+"""
+import collections
+import sys
+import threading
+import Queue
+
+
+class Result(object):
+    """The outcome of running the bulk function on a single item"""
+    def __init__(self, index, item, value=None, error=None):
+        self.index = index
+        self.item = item
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class _Failure(object):
+    """Wraps an unexpected exception raised in a worker/feeder thread so it
+    can be re-raised in the calling thread"""
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def _call(func, index, item, errors):
+    try:
+        return Result(index, item, value=func(item))
+    except errors, e:
+        return Result(index, item, error=e)
+
+
+def _run_serial(func, items, errors):
+    for index, item in enumerate(items):
+        yield _call(func, index, item, errors)
+
+
+def run(func, items, concurrency=1, errors=(Exception,)):
+    """Calls func(item) for every item, yielding a Result for each in order
+
+    Parameters:
+
+        func - the function to call for each item
+        items - any iterable. It is consumed lazily, so generators are fine.
+        concurrency - the maximum number of calls to have in flight at once
+        errors - exception types that count as the failure of a single item.
+            Any other exception aborts the run and is re-raised.
+    """
+    concurrency = int(concurrency)
+    if concurrency <= 1:
+        for r in _run_serial(func, items, errors):
+            yield r
+        return
+
+    todo = Queue.Queue(maxsize=concurrency)
+    done = Queue.Queue()
+    # Limits how far ahead of the slowest in-flight item we can get, which
+    # keeps the reorder buffer (and memory use) bounded
+    window = threading.Semaphore(concurrency * 4)
+    stop = threading.Event()
+    count = []
+
+    def feeder():
+        total = 0
+        try:
+            for index, item in enumerate(items):
+                window.acquire()
+                if stop.is_set():
+                    break
+                todo.put((index, item))
+                total += 1
+        except Exception:
+            done.put(_Failure(sys.exc_info()))
+        count.append(total)
+        for i in range(concurrency):
+            todo.put(None)
+
+    def worker():
+        while True:
+            job = todo.get()
+            if job is None:
+                break
+            if stop.is_set():
+                # Drain the queue without doing any work so the feeder can
+                # finish up
+                continue
+            try:
+                done.put(_call(func, job[0], job[1], errors))
+            except Exception:
+                done.put(_Failure(sys.exc_info()))
+
+    threads = [threading.Thread(target=feeder)]
+    threads.extend(threading.Thread(target=worker)
+                   for i in range(concurrency))
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    pending = {}
+    next_index = 0
+    try:
+        while not count or next_index < count[0]:
+            try:
+                # A timeout keeps the main thread responsive to ^C
+                r = done.get(True, 0.5)
+            except Queue.Empty:
+                if count and not threads[0].is_alive() and \
+                        not any(t.is_alive() for t in threads[1:]) and \
+                        done.empty():
+                    break
+                continue
+            if isinstance(r, _Failure):
+                raise r.exc_info[0], r.exc_info[1], r.exc_info[2]
+            pending[r.index] = r
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+                window.release()
+        # Everything is done, so let the threads finish up cleanly
+        for t in threads:
+            t.join()
+    finally:
+        stop.set()
+        # Unblock the feeder if it is waiting on the window
+        window.release()
+
+
+def run_futures(submit, items, concurrency=1, errors=(Exception,)):
+    """Like run, but submit(item) starts the work and returns a future (see
+    circuslib.eventclient.Future) instead of doing it
+
+    Up to concurrency items are submitted ahead of the oldest one that
+    hasn't finished, and results are yielded in order as they finish.
+    """
+    pending = collections.deque()
+
+    def result(index, item, future):
+        try:
+            return Result(index, item, value=future.result())
+        except errors, e:
+            return Result(index, item, error=e)
+
+    for index, item in enumerate(items):
+        try:
+            future = submit(item)
+        except errors, e:
+            pending.append((index, item, _Failed(e)))
+        else:
+            pending.append((index, item, future))
+        while len(pending) >= max(1, concurrency) or \
+                (pending and pending[0][2].done()):
+            yield result(*pending.popleft())
+    while pending:
+        yield result(*pending.popleft())
+
+
+class _Failed(object):
+    """A future for an item whose submission failed"""
+    def __init__(self, error):
+        self.error = error
+
+    def done(self):
+        return True
+
+    def result(self):
+        raise self.error
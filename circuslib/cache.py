@@ -0,0 +1,147 @@
+"""On-disk cache of API list endpoints
+
+Listing an endpoint such as /check_bundle returns every resource in the
+account, which can be a lot of data. The cache keeps a copy of each listing
+on disk (in ~/.circus/cache/ACCOUNT/ENDPOINT.json by default) so that a
+series of commands run one after the other only needs to download it once.
+
+Entries expire after a configurable TTL, and are removed whenever a write
+(POST/PUT/DELETE) is made to the same endpoint through circuslib.client.
+"""
+import errno
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+import jsonstream
+import log
+
+DEFAULT_DIRECTORY = os.path.expanduser("~/.circus/cache")
+DEFAULT_TTL = 600
+
+
+def list_endpoint(endpoint):
+    """Returns the name of the endpoint if the given api path is a listing
+    (e.g. '/check_bundle' or 'check_bundle'), or None if it refers to a
+    single resource (e.g. '/check_bundle/1234')"""
+    m = re.match("/?([a-z_]+)/?$", endpoint)
+    if m:
+        return m.group(1)
+    return None
+
+
+def resource_endpoint(endpoint):
+    """Returns the name of the endpoint an api path belongs to. E.g.
+    /check_bundle/1234 => check_bundle"""
+    return endpoint.strip('/').split('/')[0]
+
+
+class Cache(object):
+    """Cache of endpoint listings for a single account
+
+    Parameters:
+
+        account - the account name, used to keep separate accounts apart
+        ttl - how long (in seconds) a listing stays valid
+        refresh - if True, ignore anything already in the cache and fetch
+            everything again (the new results are still cached)
+        directory - where to store the cache files
+    """
+    def __init__(self, account, ttl=DEFAULT_TTL, refresh=False,
+                 directory=DEFAULT_DIRECTORY):
+        self.directory = os.path.join(directory, account or 'default')
+        self.ttl = ttl
+        self.refresh = refresh
+        # Endpoints fetched during this run, which are never stale
+        self.refreshed = set()
+        self.lock = threading.Lock()
+
+    def path(self, endpoint):
+        return os.path.join(self.directory, "%s.json" % endpoint)
+
+    def _fresh(self, endpoint):
+        """Returns the path of the cached listing for an endpoint if there
+        is a fresh one, or None otherwise"""
+        path = self.path(endpoint)
+        if self.refresh and endpoint not in self.refreshed:
+            return None
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            return None
+        if age > self.ttl and endpoint not in self.refreshed:
+            return None
+        log.debug("Using cached %s (%ds old)" % (endpoint, age))
+        return path
+
+    def get(self, endpoint):
+        """Returns the cached listing for an endpoint, or None if there isn't
+        a fresh one"""
+        path = self._fresh(endpoint)
+        if path is None:
+            return None
+        try:
+            with open(path) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return None
+
+    def iter(self, endpoint):
+        """Like get, but returns an iterator over the resources in the
+        listing, which are parsed from the cache file one at a time"""
+        path = self._fresh(endpoint)
+        if path is None:
+            return None
+        try:
+            fh = open(path)
+        except IOError:
+            return None
+        return iter_file(fh)
+
+    def put(self, endpoint, data):
+        """Stores a listing in the cache"""
+        self.fill(endpoint, lambda fh: json.dump(data, fh))
+
+    def fill(self, endpoint, write):
+        """Stores a listing in the cache by calling write(fh) to write its
+        json to the cache file. This lets a listing be downloaded straight
+        to disk without holding it in memory."""
+        try:
+            os.makedirs(self.directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Write to a temporary file and rename it so that other processes
+        # never see a half written file
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                write(fh)
+        except:
+            os.unlink(tmp)
+            raise
+        with self.lock:
+            os.rename(tmp, self.path(endpoint))
+            self.refreshed.add(endpoint)
+
+    def invalidate(self, endpoint):
+        """Removes a listing from the cache, e.g. after it has changed"""
+        with self.lock:
+            self.refreshed.discard(endpoint)
+            try:
+                os.unlink(self.path(endpoint))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            log.debug("Invalidated cached %s" % endpoint)
+
+
+def iter_file(fh):
+    """Iterates over the resources in a json listing file, parsing them one
+    at a time, and closes the file at the end"""
+    with fh:
+        for i, resource in jsonstream.iterload(fh):
+            yield resource
@@ -0,0 +1,439 @@
+"""A wrapper around circonusapi.CirconusAPI for bulk operations
+
+The client adds the things you need when making thousands of API calls in a
+row:
+
+ * Token bucket rate limiting, so we never go over a set number of requests
+   per second.
+ * Retries with exponential backoff and jitter when the API tells us to slow
+   down (429) or is having trouble (5xx). Only idempotent calls are retried
+   after errors where the request may have been processed.
+ * An adaptive concurrency limit. Throttling errors and rising latencies
+   halve the number of calls allowed in flight at once, and it creeps back
+   up again as calls succeed. This lets bulk operations run at close to the
+   fastest rate the API will allow without drowning in errors.
+
+By default, calls are made over a pool of keep-alive connections (see
+circuslib.transport) sized to the concurrency level, instead of a new
+connection per call. With evented=True, they are made from a single event
+loop thread instead (see circuslib.eventclient), and submit can be used to
+start calls without waiting for them, so the number of calls in flight
+isn't limited by the number of threads.
+
+If a cache (see circuslib.cache) is given, listings of whole endpoints are
+served from it, and any write to an endpoint invalidates its cached listing.
+
+The client has the same api_call and list_*/get_*/add_*/edit_*/delete_*
+methods as CirconusAPI, so it can be used anywhere an api object is.
+"""
+import httplib
+import random
+import re
+import socket
+import tempfile
+import threading
+import time
+import urllib2
+
+from circonusapi import circonusapi
+
+import cache
+import eventclient
+import log
+import metrics
+import store
+import transport
+
+# Methods that are safe to retry even if the request may have reached the API
+IDEMPOTENT_METHODS = transport.IDEMPOTENT_METHODS
+# Status codes where the API has refused the request without processing it
+THROTTLED_STATUSES = (429, 503)
+# Status codes that are worth retrying for idempotent calls
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Errors from the network layer, where we don't get a response at all
+NETWORK_ERRORS = (urllib2.URLError, httplib.HTTPException, socket.error)
+
+
+def get_status(e):
+    """Tries to work out the HTTP status code behind an API error"""
+    for obj in [e] + list(getattr(e, 'args', [])):
+        code = getattr(obj, 'code', None)
+        if isinstance(code, int):
+            return code
+    m = re.search(r'\b([45]\d\d)\b', str(e))
+    if m:
+        return int(m.group(1))
+    return None
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter
+
+    Allows `rate` requests per second on average, with bursts of up to
+    `burst` requests. A rate of None disables rate limiting.
+    """
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate or 1)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def reserve(self):
+        """Takes a token without waiting, returning how many seconds the
+        caller should wait before using it"""
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+
+
+class AdaptiveLimit(object):
+    """A concurrency limit that adapts to how the API is coping
+
+    Uses additive increase/multiplicative decrease: every successful call
+    with a reasonable latency grows the limit by 1/limit (i.e. by one per
+    'window' of calls), and a throttling error or a latency well above the
+    best seen so far halves it.
+    """
+    def __init__(self, maximum, minimum=1, latency_tolerance=2.0):
+        self.maximum = max(minimum, maximum)
+        self.minimum = minimum
+        self.limit = float(self.maximum)
+        self.latency_tolerance = latency_tolerance
+        self.min_latency = None
+        self.avg_latency = None
+        self.in_flight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    def success(self, latency):
+        with self.cond:
+            if self.min_latency is None or latency < self.min_latency:
+                self.min_latency = latency
+            if self.avg_latency is None:
+                self.avg_latency = latency
+            else:
+                self.avg_latency = 0.9 * self.avg_latency + 0.1 * latency
+            if self.avg_latency > self.min_latency * self.latency_tolerance:
+                self._decrease()
+                # Start measuring again from the new level
+                self.avg_latency = self.min_latency
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def throttled(self):
+        with self.cond:
+            self._decrease()
+
+    def _decrease(self):
+        old = int(self.limit)
+        self.limit = max(self.minimum, self.limit / 2)
+        if int(self.limit) != old:
+            log.debug("Reducing concurrency to %s" % int(self.limit))
+
+
+class Client(object):
+    """Rate limiting, retrying wrapper around a CirconusAPI object
+
+    Parameters:
+
+        api - the circonusapi.CirconusAPI object to wrap
+        rate - the maximum number of requests per second (None = no limit)
+        concurrency - the maximum number of calls to allow in flight. The
+            actual number is adjusted between 1 and this value.
+        retries - how many times to retry a failed call
+        backoff - the initial delay in seconds before retrying. This doubles
+            on every retry, and the actual delay is randomized.
+        max_backoff - the maximum delay between retries
+        cache - a circuslib.cache.Cache to use for endpoint listings
+    """
+    def __init__(self, api, rate=None, concurrency=1, retries=5, backoff=0.5,
+                 max_backoff=30, cache=None):
+        self.api = api
+        self.cache = cache
+        self.bucket = TokenBucket(rate)
+        self.limit = AdaptiveLimit(concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def should_retry(self, method, e):
+        if isinstance(e, NETWORK_ERRORS):
+            # We can't tell if the request was processed or not
+            return method in IDEMPOTENT_METHODS
+        status = get_status(e)
+        if status in THROTTLED_STATUSES:
+            return True
+        return status in RETRY_STATUSES and method in IDEMPOTENT_METHODS
+
+    def api_call(self, method, endpoint, data=None):
+        method = method.upper()
+        if method == 'GET':
+            listing = cache.list_endpoint(endpoint)
+            if self.cache is None or not listing:
+                return self._call(method, endpoint, data)
+            rv = self.cache.get(listing)
+            if rv is None:
+                rv = self._call(method, endpoint, data)
+                self.cache.put(listing, rv)
+            return rv
+        try:
+            return self._call(method, endpoint, data)
+        finally:
+            # Invalidate even on failure, as the write may have happened
+            changed = cache.resource_endpoint(endpoint)
+            if self.cache is not None:
+                self.cache.invalidate(changed)
+            store.invalidate(self, changed)
+
+    def refresh(self, endpoint):
+        """Forgets any cached copy of an endpoint's listing, so that it is
+        fetched from the API next time. Use this before changing resources
+        based on what they currently look like."""
+        changed = cache.resource_endpoint(endpoint)
+        if self.cache is not None:
+            self.cache.invalidate(changed)
+        store.invalidate(self, changed)
+
+    def iter_list(self, endpoint):
+        """Iterates over the resources in an endpoint listing
+
+        Resources are parsed from a file one at a time, so that the full
+        listing is never held in memory. If the api can download (see
+        transport.Transport.download), the listing is written straight to
+        the cache file, or to a temporary file without a cache. Otherwise
+        it is fetched as a whole first.
+        """
+        listing = cache.list_endpoint(endpoint)
+        download = listing and hasattr(self.api, 'download')
+        if self.cache is not None and listing:
+            rv = self.cache.iter(listing)
+            if rv is None:
+                if download:
+                    self.cache.fill(listing,
+                                    lambda fh: self._download(endpoint, fh))
+                else:
+                    self.cache.put(listing, self._call("GET", endpoint,
+                                                       None))
+                rv = self.cache.iter(listing)
+            if rv is not None:
+                return rv
+        if download:
+            fh = tempfile.TemporaryFile()
+            self._download(endpoint, fh)
+            fh.seek(0)
+            return cache.iter_file(fh)
+        return _drain(self._call("GET", endpoint, None))
+
+    def _download(self, endpoint, fh):
+        """Downloads a listing to fh, with the same rate limiting and retries
+        as any other call"""
+        def download(method, endpoint, data):
+            self.api.download(endpoint, fh)
+        self._call("GET", endpoint, None, download)
+
+    def _call(self, method, endpoint, data, call=None):
+        """Makes a call with rate limiting and retries. call is the function
+        that makes the request, api.api_call by default."""
+        call = call or self.api.api_call
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            self.limit.acquire()
+            start = time.time()
+            try:
+                rv = call(method, endpoint, data)
+            except (circonusapi.CirconusAPIError,) + NETWORK_ERRORS, e:
+                metrics.record('api_call', time.time() - start, method=method,
+                               endpoint=cache.resource_endpoint(endpoint),
+                               status=get_status(e) or 'error',
+                               retry=attempt > 0)
+                if get_status(e) in THROTTLED_STATUSES:
+                    self.limit.throttled()
+                if attempt >= self.retries or not self.should_retry(method,
+                                                                    e):
+                    raise
+                attempt += 1
+                delay = random.uniform(0, min(self.max_backoff,
+                                              self.backoff * 2 ** attempt))
+                log.debug("%s %s failed (%s), retry %s in %.1fs" % (
+                    method, endpoint, e, attempt, delay))
+                time.sleep(delay)
+                continue
+            finally:
+                self.limit.release()
+            latency = time.time() - start
+            self.limit.success(latency)
+            metrics.record('api_call', latency, method=method,
+                           endpoint=cache.resource_endpoint(endpoint),
+                           status='ok', retry=attempt > 0)
+            return rv
+
+    def submit(self, method, endpoint, data=None):
+        """Starts a call, returning a circuslib.eventclient.Future for its
+        result
+
+        With an evented api, the call (and any retries) is made from the
+        event loop without tying up the calling thread, which only waits
+        for the rate and concurrency limits. Otherwise, or for listings
+        that may come from the cache, the call is made straight away.
+        """
+        method = method.upper()
+        future = eventclient.Future()
+        if not getattr(self.api, 'evented', False) or method == 'GET' and \
+                self.cache is not None and cache.list_endpoint(endpoint):
+            try:
+                future.set_result(self.api_call(method, endpoint, data))
+            except (circonusapi.CirconusAPIError,) + NETWORK_ERRORS, e:
+                future.set_error(e)
+            return future
+
+        loop = self.api.loop
+        state = {'attempt': 0, 'start': None}
+
+        def send():
+            state['start'] = time.time()
+            self.api.submit(method, endpoint, data).add_done_callback(done)
+
+        def done(f):
+            latency = time.time() - state['start']
+            e = f.error
+            if e is None:
+                self.limit.success(latency)
+                metrics.record('api_call', latency, method=method,
+                               endpoint=cache.resource_endpoint(endpoint),
+                               status='ok', retry=state['attempt'] > 0)
+                finish(f.value, None)
+                return
+            metrics.record('api_call', latency, method=method,
+                           endpoint=cache.resource_endpoint(endpoint),
+                           status=get_status(e) or 'error',
+                           retry=state['attempt'] > 0)
+            if get_status(e) in THROTTLED_STATUSES:
+                self.limit.throttled()
+            if state['attempt'] >= self.retries or \
+                    not self.should_retry(method, e):
+                finish(None, e)
+                return
+            state['attempt'] += 1
+            attempt = state['attempt']
+            delay = random.uniform(0, min(self.max_backoff,
+                                          self.backoff * 2 ** attempt))
+            log.debug("%s %s failed (%s), retry %s in %.1fs" % (
+                method, endpoint, e, attempt, delay))
+            # Retries are sent from the loop thread, so mustn't block on
+            # the rate limit. done can run in the caller's thread (if the
+            # call failed straight away), and call_later may only be used
+            # in the loop thread, so go through call_soon.
+            loop.call_soon(loop.call_later,
+                           max(delay, self.bucket.reserve()), send)
+
+        def finish(value, error):
+            # The concurrency slot is held across retries, and released
+            # once the call is finished with
+            self.limit.release()
+            if method != 'GET':
+                changed = cache.resource_endpoint(endpoint)
+                if self.cache is not None:
+                    self.cache.invalidate(changed)
+                store.invalidate(self, changed)
+            if error is None:
+                future.set_result(value)
+            else:
+                future.set_error(error)
+
+        self.bucket.acquire()
+        self.limit.acquire()
+        send()
+        return future
+
+    def __getattr__(self, name):
+        """Provides the list_*, get_*, add_*, edit_* and delete_* shortcuts
+        that CirconusAPI has, going through api_call so they are also rate
+        limited and retried"""
+        m = re.match('(list|get|add|edit|delete)_(.+)$', name)
+        if not m:
+            return getattr(self.api, name)
+        action, endpoint = m.groups()
+
+        def resource(rid):
+            rid = str(rid)
+            if rid.startswith('/'):
+                return rid
+            return "/%s/%s" % (endpoint, rid)
+
+        if action == 'list':
+            return lambda: self.api_call("GET", "/%s" % endpoint)
+        if action == 'get':
+            return lambda rid: self.api_call("GET", resource(rid))
+        if action == 'add':
+            return lambda data: self.api_call("POST", "/%s" % endpoint, data)
+        if action == 'edit':
+            return lambda rid, data: self.api_call("PUT", resource(rid), data)
+        return lambda rid: self.api_call("DELETE", resource(rid))
+
+
+def _drain(items):
+    """Yields items from a list, removing them as it goes so that they can be
+    freed once processed"""
+    items.reverse()
+    while items:
+        yield items.pop()
+
+
+def get_client(token, debug=False, keepalive=True, gzip=False,
+               evented=False, **kwargs):
+    """Creates a Client for the given API token
+
+    With keepalive, calls are made using a circuslib.transport.Transport
+    with a connection for each call allowed in parallel, and gzip turns on
+    request compression. Otherwise a plain circonusapi.CirconusAPI is used.
+    evented uses a circuslib.eventclient.EventTransport instead of either,
+    allowing as many calls in flight as the concurrency level.
+
+    Any extra keyword arguments are passed on to Client.
+    """
+    if evented:
+        api = eventclient.EventTransport(
+            token, max_in_flight=kwargs.get('concurrency', 1), gzip=gzip)
+    elif keepalive:
+        api = transport.Transport(token,
+                                  pool_size=kwargs.get('concurrency', 1),
+                                  gzip=gzip)
+    else:
+        api = circonusapi.CirconusAPI(token)
+    if debug:
+        api.debug = True
+    return Client(api, **kwargs)
@@ -0,0 +1,676 @@
+"""Event loop transport for the circonus API
+
+The bulk tools make API calls from a pool of threads, one for each call in
+flight. That's fine for tens of calls at once, but with thousands in flight
+the threads themselves become the limit. asyncio isn't available on the
+Python version the tools run on, so this does the same thing by hand: a
+single thread runs an event loop (using poll, or select where there is no
+poll) over a set of non-blocking keep-alive connections. Callers submit
+requests to it and get a Future back.
+
+EventTransport.submit(method, endpoint, data) starts a call and returns a
+Future straight away. A semaphore limits the number of calls (and so
+connections) in flight, and submit waits when the limit is reached.
+api_call is the sync facade: it submits a call and waits for the result, so
+an EventTransport can be used anywhere a Transport or CirconusAPI is. It is
+normally wrapped by circuslib.client.Client (see client.get_client with
+evented=True), which then has a submit method of its own, adding the usual
+rate limiting and retries.
+
+Response bodies are processed as they arrive. Chunked transfer encoding and
+gzip are decoded incrementally, so the compressed body is never held in
+memory. Whole listings written to a file with download() don't go through
+the loop: they use the blocking connection pool of transport.Transport.
+"""
+import collections
+import errno
+import heapq
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+import zlib
+
+import log
+import metrics
+import transport
+
+# Errors from a non-blocking socket that just mean "try again later"
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+READ_SIZE = 65536
+
+
+class Future(object):
+    """The result of a call that may not have finished yet"""
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.value = None
+        self.error = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_result(self, value):
+        self._finish(value, None)
+
+    def set_error(self, error):
+        self._finish(None, error)
+
+    def _finish(self, value, error):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.value = value
+            self.error = error
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def add_done_callback(self, fn):
+        """Calls fn(future) when the future is done (straight away if it
+        already is). Callbacks usually run in the event loop thread, so
+        they shouldn't block."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def result(self):
+        """Waits for the call to finish, returning its result or raising
+        its error"""
+        # Wait in steps so that ^C still works in the main thread
+        while not self._event.wait(0.5):
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class EventLoop(object):
+    """Runs callbacks, timers and socket events in a single thread
+
+    The thread is started when the loop is first used. Other threads hand
+    work to it with call_soon, which wakes it up through a pipe.
+    """
+    def __init__(self):
+        self.calls = collections.deque()
+        self.timers = []
+        self.timer_count = 0
+        # fd => (handler, events). Handlers have fileno(), on_readable(),
+        # on_writable() and on_error(e)
+        self.handlers = {}
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            _set_nonblocking(fd)
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+            self.poller.register(self.wake_r, select.POLLIN)
+        else:
+            self.poller = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def call_soon(self, fn, *args):
+        """Runs fn(*args) in the loop thread. Safe to call from any
+        thread."""
+        self.start()
+        self.calls.append((fn, args))
+        try:
+            os.write(self.wake_w, 'x')
+        except OSError, e:
+            # The pipe is full, so the loop is going to wake up anyway
+            if e.errno not in WOULD_BLOCK:
+                raise
+
+    def call_later(self, delay, fn, *args):
+        """Runs fn(*args) in the loop thread after delay seconds. Only call
+        this from the loop thread (e.g. in a callback); from other threads,
+        wrap it in call_soon."""
+        self.timer_count += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.timer_count,
+                                     fn, args))
+
+    def watch(self, handler, read=False, write=False):
+        """Sets which events to wait for on a handler's socket. With
+        neither, the socket is no longer watched."""
+        fd = handler.fileno()
+        events = 0
+        if read:
+            events |= select.POLLIN if self.poller else 1
+        if write:
+            events |= select.POLLOUT if self.poller else 2
+        current = self.handlers.get(fd)
+        if not events:
+            if current is not None:
+                del self.handlers[fd]
+                if self.poller:
+                    self.poller.unregister(fd)
+            return
+        if self.poller:
+            if current is None:
+                self.poller.register(fd, events)
+            elif current[1] != events:
+                self.poller.modify(fd, events)
+        self.handlers[fd] = (handler, events)
+
+    def _timeout(self):
+        if self.calls:
+            return 0
+        if not self.timers:
+            return 1.0
+        return min(1.0, max(0, self.timers[0][0] - time.time()))
+
+    def _poll(self, timeout):
+        """Returns a list of (handler, readable, writable, error)"""
+        if self.poller:
+            try:
+                events = self.poller.poll(timeout * 1000)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+            ready = []
+            for fd, event in events:
+                if fd == self.wake_r:
+                    self._drain_wakeups()
+                    continue
+                if fd not in self.handlers:
+                    continue
+                ready.append((self.handlers[fd][0],
+                              event & (select.POLLIN | select.POLLHUP),
+                              event & select.POLLOUT,
+                              event & (select.POLLERR | select.POLLNVAL)))
+            return ready
+        readers = [fd for fd, (h, ev) in self.handlers.items() if ev & 1]
+        writers = [fd for fd, (h, ev) in self.handlers.items() if ev & 2]
+        try:
+            r, w, x = select.select(readers + [self.wake_r], writers, [],
+                                    timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if self.wake_r in r:
+            self._drain_wakeups()
+        ready = []
+        for fd in set(r) | set(w):
+            if fd in self.handlers:
+                ready.append((self.handlers[fd][0], fd in r, fd in w, False))
+        return ready
+
+    def _drain_wakeups(self):
+        try:
+            while os.read(self.wake_r, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in WOULD_BLOCK:
+                raise
+
+    def _run(self):
+        while True:
+            while self.calls:
+                fn, args = self.calls.popleft()
+                self._safely(fn, *args)
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                when, n, fn, args = heapq.heappop(self.timers)
+                self._safely(fn, *args)
+            for handler, readable, writable, error in self._poll(
+                    self._timeout()):
+                if error:
+                    self._safely(handler.on_error,
+                                 socket.error(errno.ECONNRESET,
+                                              "Connection error"))
+                    continue
+                if writable:
+                    self._safely(handler.on_writable)
+                if readable:
+                    self._safely(handler.on_readable)
+
+    def _safely(self, fn, *args):
+        # An exception here would otherwise kill the loop thread, and with
+        # it every call in flight
+        try:
+            fn(*args)
+        except Exception, e:
+            log.error("Unexpected error in event loop: %s" % e)
+
+
+class ResponseParser(object):
+    """Parses an HTTP/1.1 response as it arrives"""
+    def __init__(self, method):
+        self.method = method
+        self.buf = ''
+        self.state = 'headers'
+        self.status = None
+        self.reason = None
+        self.headers = {}
+        self.remaining = 0
+        self.body = []
+        self.decompressor = None
+        self.bytes_in = 0
+        self.will_close = False
+
+    def feed(self, data):
+        """Processes more of the response. Returns True once it's all been
+        read."""
+        self.bytes_in += len(data)
+        self.buf += data
+        while self.state != 'done':
+            if self.state == 'headers':
+                end = self.buf.find('\r\n\r\n')
+                if end < 0:
+                    return False
+                self._parse_headers(self.buf[:end])
+                self.buf = self.buf[end + 4:]
+            elif self.state in ('body', 'chunk'):
+                data = self.buf[:self.remaining]
+                self.buf = self.buf[len(data):]
+                self.remaining -= len(data)
+                self._body(data)
+                if self.remaining:
+                    return False
+                self.state = 'done' if self.state == 'body' else 'chunk_end'
+            elif self.state == 'until_close':
+                self._body(self.buf)
+                self.buf = ''
+                return False
+            elif self.state == 'chunk_end':
+                if len(self.buf) < 2:
+                    return False
+                self.buf = self.buf[2:]
+                self.state = 'chunk_size'
+            elif self.state in ('chunk_size', 'trailers'):
+                end = self.buf.find('\r\n')
+                if end < 0:
+                    return False
+                line = self.buf[:end]
+                self.buf = self.buf[end + 2:]
+                if self.state == 'trailers':
+                    if not line:
+                        self.state = 'done'
+                    continue
+                self.remaining = int(line.split(';')[0].strip(), 16)
+                self.state = 'chunk' if self.remaining else 'trailers'
+        return True
+
+    def eof(self):
+        """Called when the server closes the connection. Returns True if
+        the response was complete."""
+        if self.state == 'until_close':
+            self.state = 'done'
+        return self.state == 'done'
+
+    def get_body(self):
+        if self.decompressor is not None:
+            self.body.append(self.decompressor.flush())
+        return ''.join(self.body)
+
+    def _body(self, data):
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        if data:
+            self.body.append(data)
+
+    def _parse_headers(self, text):
+        lines = text.split('\r\n')
+        parts = lines[0].split(' ', 2)
+        version = parts[0]
+        self.status = int(parts[1])
+        self.reason = parts[2] if len(parts) > 2 else ''
+        for line in lines[1:]:
+            if ':' in line:
+                k, v = line.split(':', 1)
+                self.headers[k.strip().lower()] = v.strip()
+        connection = self.headers.get('connection', '').lower()
+        self.will_close = connection == 'close' or (
+            version == 'HTTP/1.0' and connection != 'keep-alive')
+        if self.headers.get('content-encoding') == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.method == 'HEAD' or self.status in (204, 304) or \
+                self.status < 200:
+            self.state = 'done'
+        elif 'chunked' in self.headers.get('transfer-encoding', ''):
+            self.state = 'chunk_size'
+        elif 'content-length' in self.headers:
+            self.remaining = int(self.headers['content-length'])
+            self.state = 'body' if self.remaining else 'done'
+        else:
+            self.state = 'until_close'
+            self.will_close = True
+
+
+class Request(object):
+    def __init__(self, method, path, body, headers, future):
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers
+        self.future = future
+
+    def encode(self, host):
+        lines = ["%s %s HTTP/1.1" % (self.method, self.path),
+                 "Host: %s" % host]
+        headers = dict(self.headers)
+        headers['Content-Length'] = len(self.body or '')
+        for k, v in sorted(headers.items()):
+            lines.append("%s: %s" % (k, v))
+        return "\r\n".join(lines) + "\r\n\r\n" + (self.body or '')
+
+
+class Connection(object):
+    """A non-blocking HTTP/1.1 connection, driven by the event loop"""
+    def __init__(self, owner, address):
+        self.owner = owner
+        self.loop = owner.loop
+        self.sock = socket.socket(address[0], socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.fd = self.sock.fileno()
+        self.state = 'connecting'
+        self.request = None
+        self.parser = None
+        self.out = ''
+        self.sent = 0
+        self.reused = False
+        self.start_time = None
+        self.deadline = None
+        err = self.sock.connect_ex(address[4])
+        if err not in (0, errno.EINPROGRESS) + WOULD_BLOCK:
+            raise socket.error(err, os.strerror(err))
+
+    def fileno(self):
+        return self.fd
+
+    def start(self, request, reused):
+        """Sends a request. Only called when the connection is idle (or
+        still connecting)."""
+        self.request = request
+        self.reused = reused
+        self.parser = ResponseParser(request.method)
+        self.out = request.encode(self.owner.host_header)
+        self.sent = 0
+        self.start_time = time.time()
+        self.deadline = self.start_time + self.owner.timeout
+        self.loop.call_later(self.owner.timeout, self.check_timeout,
+                             request)
+        if self.state == 'idle':
+            self.state = 'sending'
+            self._send()
+        else:
+            self.loop.watch(self, write=True)
+
+    def check_timeout(self, request):
+        if self.request is request and time.time() >= self.deadline:
+            self.fail(socket.timeout("timed out"))
+
+    def on_writable(self):
+        if self.state == 'connecting':
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.fail(socket.error(err, os.strerror(err)))
+                return
+            if self.owner.secure:
+                self.sock = self.owner.ssl_context.wrap_socket(
+                    self.sock, server_hostname=self.owner.host,
+                    do_handshake_on_connect=False)
+                self.state = 'handshake'
+            else:
+                self.state = 'sending'
+        if self.state == 'handshake':
+            self._handshake()
+        elif self.state == 'sending':
+            self._send()
+        elif self.state == 'reading':
+            # An SSL read that needed to write something first
+            self.on_readable()
+
+    def on_readable(self):
+        if self.state == 'handshake':
+            self._handshake()
+            return
+        if self.state == 'sending':
+            # An SSL write that needed to read something first
+            self._send()
+            return
+        if self.state != 'reading':
+            return
+        while True:
+            try:
+                data = self.sock.recv(READ_SIZE)
+            except ssl.SSLError, e:
+                if e.errno == ssl.SSL_ERROR_WANT_READ:
+                    self.loop.watch(self, read=True)
+                    return
+                if e.errno == ssl.SSL_ERROR_WANT_WRITE:
+                    self.loop.watch(self, write=True)
+                    return
+                self.fail(e)
+                return
+            except socket.error, e:
+                if e.errno in WOULD_BLOCK:
+                    return
+                self.fail(e)
+                return
+            if not data:
+                if self.parser.eof():
+                    self.finish()
+                else:
+                    self.fail(socket.error(errno.ECONNRESET,
+                                           "Connection closed by server"))
+                return
+            try:
+                complete = self.parser.feed(data)
+            except (ValueError, IndexError, zlib.error), e:
+                self.fail(socket.error(errno.EPROTO,
+                                       "Invalid response: %s" % e))
+                return
+            if complete:
+                self.finish()
+                return
+
+    def on_error(self, e):
+        if self.state == 'closed':
+            return
+        # Use the socket's own error (e.g. connection refused) if it has one
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            e = socket.error(err, os.strerror(err))
+        self.fail(e)
+
+    def _handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLError, e:
+            if e.errno == ssl.SSL_ERROR_WANT_READ:
+                self.loop.watch(self, read=True)
+            elif e.errno == ssl.SSL_ERROR_WANT_WRITE:
+                self.loop.watch(self, write=True)
+            else:
+                self.fail(e)
+            return
+        except socket.error, e:
+            self.fail(e)
+            return
+        self.state = 'sending'
+        self._send()
+
+    def _send(self):
+        while self.sent < len(self.out):
+            try:
+                self.sent += self.sock.send(
+                    self.out[self.sent:self.sent + READ_SIZE])
+            except ssl.SSLError, e:
+                if e.errno == ssl.SSL_ERROR_WANT_READ:
+                    self.loop.watch(self, read=True)
+                elif e.errno == ssl.SSL_ERROR_WANT_WRITE:
+                    self.loop.watch(self, write=True)
+                else:
+                    self.fail(e)
+                return
+            except socket.error, e:
+                if e.errno in WOULD_BLOCK:
+                    self.loop.watch(self, write=True)
+                else:
+                    self.fail(e)
+                return
+        self.out = ''
+        self.state = 'reading'
+        self.loop.watch(self, read=True)
+        # With SSL, some of the response may already be buffered
+        self.on_readable()
+
+    def finish(self):
+        request, parser = self.request, self.parser
+        self.request = self.parser = None
+        self.state = 'idle'
+        self.loop.watch(self)
+        self.owner.finished(self, request, parser)
+
+    def fail(self, e):
+        request, parser = self.request, self.parser
+        # The server may close a keep-alive connection that has been idle
+        # for a while. If so, the request never got to it. If it was all
+        # written, we can't be sure, so only send it again if that's
+        # harmless (as in transport.is_stale).
+        written = self.state not in ('connecting', 'handshake', 'sending')
+        stale = self.reused and (parser is None or parser.bytes_in == 0) \
+            and not isinstance(e, socket.timeout) and (
+                not written or (request is not None and
+                                request.method in
+                                transport.IDEMPOTENT_METHODS))
+        self.close()
+        if request is not None:
+            self.owner.failed(request, e, stale)
+
+    def close(self):
+        self.request = self.parser = None
+        self.state = 'closed'
+        self.loop.watch(self)
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class EventTransport(transport.Transport):
+    """Makes API calls from an event loop over keep-alive connections
+
+    Takes the same parameters as circuslib.transport.Transport, except that
+    max_in_flight limits the number of calls (and connections) at once, in
+    place of pool_size. A loop can be given to share one EventLoop between
+    transports.
+    """
+    evented = True
+
+    def __init__(self, token, hostname=transport.DEFAULT_HOSTNAME,
+                 app_name=transport.DEFAULT_APP_NAME, max_in_flight=100,
+                 gzip=False, secure=True, port=None, base_path="/v2",
+                 timeout=60, ssl_context=None, loop=None):
+        transport.Transport.__init__(self, token, hostname, app_name,
+                                     gzip=gzip, secure=secure, port=port,
+                                     base_path=base_path, timeout=timeout,
+                                     ssl_context=ssl_context)
+        self.host = hostname
+        self.port = port or (443 if secure else 80)
+        self.host_header = hostname if port is None else "%s:%s" % (
+            hostname, port)
+        self.secure = secure
+        self.timeout = timeout
+        if secure and ssl_context is None:
+            ssl_context = ssl.create_default_context()
+        self.ssl_context = ssl_context
+        self.slots = threading.BoundedSemaphore(max(1, max_in_flight))
+        self.loop = loop or EventLoop()
+        self.address = None
+        # Only used from the loop thread
+        self.idle = []
+        self.created = 0
+
+    def submit(self, method, endpoint, data=None):
+        """Starts an API call, returning a Future for its result
+
+        Waits if max_in_flight calls are already in flight.
+        """
+        method = method.upper()
+        path = "%s/%s" % (self.base_path, endpoint.lstrip('/'))
+        headers = self.headers()
+        body = self.encode(data, headers)
+        if self.debug:
+            log.debug("%s %s %s" % (method, path, data))
+        future = Future()
+        self.slots.acquire()
+        future.add_done_callback(lambda f: self.slots.release())
+        self.loop.call_soon(self._start, Request(method, path, body, headers,
+                                                 future))
+        return future
+
+    def api_call(self, method, endpoint, data=None):
+        return self.submit(method, endpoint, data).result()
+
+    def _start(self, request, reuse=True):
+        if reuse and self.idle:
+            conn, reused = self.idle.pop(), True
+        else:
+            try:
+                if self.address is None:
+                    # This blocks the loop, but only happens once
+                    self.address = socket.getaddrinfo(
+                        self.host, self.port, 0, socket.SOCK_STREAM)[0]
+                conn, reused = Connection(self, self.address), False
+            except socket.error, e:
+                request.future.set_error(e)
+                return
+            self.created += 1
+        conn.start(request, reused)
+
+    def finished(self, conn, request, parser):
+        metrics.record('http', time.time() - conn.start_time,
+                       method=request.method, status=parser.status,
+                       reused=conn.reused, bytes_out=len(request.body or ''),
+                       bytes_in=parser.bytes_in)
+        if parser.will_close:
+            conn.close()
+        else:
+            self.idle.append(conn)
+        try:
+            request.future.set_result(self.decode(
+                parser.status, parser.reason, parser.get_body()))
+        except (transport.TransportError, zlib.error), e:
+            request.future.set_error(e)
+
+    def failed(self, request, e, stale):
+        if stale:
+            log.debug("Reconnecting after %s" % e)
+            self._start(request, reuse=False)
+        else:
+            request.future.set_error(e)
+
+    def close(self):
+        def close_idle():
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+        self.loop.call_soon(close_idle)
+        # Listings are downloaded (see transport.Transport.download) over an
+        # ordinary blocking connection, as they are written to a file
+        transport.Transport.close(self)
+
+
+def _set_nonblocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
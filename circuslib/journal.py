@@ -0,0 +1,166 @@
+"""Write-ahead journal for resumable bulk operations
+
+Before each change is made, a 'pending' record is appended to the journal,
+and once the API call returns, a 'done' or 'failed' record. If a run is
+interrupted, it can be resumed from the journal: changes that are already
+done are skipped, and anything failed or still pending is tried again.
+
+The journal is a file with one json record per line:
+
+    {"key": "...", "status": "pending", "description": "..."}
+    {"key": "...", "status": "done"}
+    {"key": "...", "status": "failed", "error": "..."}
+
+Changes are identified by a hash of their action, endpoint and data (plus a
+counter, so identical changes in the same run are kept apart), which means
+the input doesn't need to be in the same order when resuming.
+
+Records are written as they happen, but only synced to disk in batches
+(every batch_size records or interval seconds). A crash can lose the last
+batch, in which case those changes are made again when resuming.
+"""
+import errno
+import hashlib
+import json
+import os
+import threading
+import time
+
+import log
+
+DEFAULT_DIRECTORY = os.path.expanduser("~/.circus/journal")
+
+
+def default_path(name, *parts):
+    """Returns a journal filename for a tool run with the given arguments.
+    Running the same tool with the same arguments gives the same file."""
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+    return os.path.join(DEFAULT_DIRECTORY, "%s-%s.journal" % (name,
+                                                              digest[:12]))
+
+
+def load(filename):
+    """Returns a dict of the latest status for each key in a journal"""
+    statuses = {}
+    try:
+        fh = open(filename)
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return statuses
+        raise
+    with fh:
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may be half written if we crashed
+                continue
+            statuses[record['key']] = record['status']
+    return statuses
+
+
+class Journal(object):
+    """An append-only journal of changes (see circuslib.plan)
+
+    Parameters:
+
+        filename - where to write the journal
+        resume - if True, read the existing journal and skip changes that it
+            says are done. Otherwise any existing journal is replaced (when
+            the first record is written).
+        batch_size - how many records to write between syncs
+        interval - how long (in seconds) to wait at most between syncs
+    """
+    def __init__(self, filename, resume=False, batch_size=100, interval=1.0):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.interval = interval
+        self.resume = resume
+        self.done = set()
+        if resume:
+            self.done = set(k for k, status in load(filename).items()
+                            if status == 'done')
+        self.fh = None
+        self.counts = {}
+        self.skipped = 0
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.lock = threading.Lock()
+
+    def key(self, change, counts=None):
+        """Returns the key identifying a change in this run. counts keeps
+        track of identical changes (self.counts by default)."""
+        if counts is None:
+            counts = self.counts
+        digest = hashlib.sha1(json.dumps(
+            [change['action'], change['endpoint'], change.get('data')],
+            sort_keys=True)).hexdigest()
+        n = counts.get(digest, 0)
+        counts[digest] = n + 1
+        return "%s-%s" % (digest, n)
+
+    def count_done(self, changes):
+        """Returns how many of a set of changes are already done, without
+        recording anything, e.g. to work out how many are left to make"""
+        if not self.done:
+            return 0
+        counts = {}
+        return sum(1 for c in changes if self.key(c, counts) in self.done)
+
+    def filter(self, changes):
+        """Yields (key, change) for each change that isn't done yet, and
+        records it as pending"""
+        for c in changes:
+            key = self.key(c)
+            if key in self.done:
+                self.skipped += 1
+                log.debug("Already done: %s" % c.get('description'))
+                log.result({
+                    'action': c['action'],
+                    'endpoint': c['endpoint'],
+                    'description': c.get('description'),
+                    'status': 'skipped'})
+                continue
+            self.record(key, 'pending', description=c.get('description'))
+            yield key, c
+
+    def record(self, key, status, **extra):
+        """Appends a record for a change to the journal"""
+        record = dict(extra, key=key, status=status)
+        with self.lock:
+            if self.fh is None:
+                self._open()
+            self.fh.write(json.dumps(record) + "\n")
+            self.unsynced += 1
+            if self.unsynced >= self.batch_size or \
+                    time.time() - self.last_sync >= self.interval:
+                self._sync()
+
+    def _open(self):
+        directory = os.path.dirname(self.filename)
+        if directory:
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.fh = open(self.filename, 'a' if self.resume else 'w')
+
+    def _sync(self):
+        if self.fh is None:
+            return
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def sync(self):
+        """Writes any outstanding records to disk"""
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.fh is not None and not self.fh.closed:
+                self._sync()
+                self.fh.close()
@@ -0,0 +1,102 @@
+"""Incremental parsing of large json files
+
+The json module needs the whole document (and the whole decoded result) in
+memory at once. For the files we deal with, the top level is nearly always a
+big list or object of resources, where each resource on its own is small. The
+functions here parse the top level container incrementally, decoding and
+yielding one item at a time, so memory use stays flat however big the file
+is.
+"""
+import json
+import re
+
+CHUNK_SIZE = 65536
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+NUMBER_TAIL = re.compile(r'[-+0-9.eE]*\Z')
+
+
+class _Buffer(object):
+    """A read buffer over a file handle that discards consumed data"""
+    def __init__(self, fh, chunk_size):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.data = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Reads more data, returning False if there is no more to read"""
+        if self.eof:
+            return False
+        if self.pos > self.chunk_size:
+            self.data = self.data[self.pos:]
+            self.pos = 0
+        # Read at least as much as we already have buffered, so that large
+        # items only get re-parsed a logarithmic number of times
+        chunk = self.fh.read(max(self.chunk_size, len(self.data) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.data += chunk
+        return True
+
+    def peek(self):
+        """Skips whitespace and returns the next character ('' at EOF)"""
+        while True:
+            self.pos = WHITESPACE.match(self.data, self.pos).end()
+            if self.pos < len(self.data) or not self.fill():
+                return self.data[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError("Expecting one of '%s' at offset %s, got '%s'" %
+                             (chars, self.pos, c))
+        self.pos += 1
+        return c
+
+    def decode(self, decoder):
+        """Decodes the next json value, reading more data as needed"""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.data, self.pos)
+            except ValueError:
+                if self.fill():
+                    continue
+                raise
+            # A number could carry on into data we haven't read yet
+            if NUMBER_TAIL.match(self.data, end) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iterload(fh, object_pairs_hook=None, chunk_size=CHUNK_SIZE):
+    """Iterates over the items in the top level list/object of a json file
+
+    Yields (key, value) tuples for a json object, and (index, value) tuples
+    for a list. Keys are yielded in file order and are not deduplicated.
+    object_pairs_hook is used when decoding any objects inside the values,
+    in the same way as for json.load.
+    """
+    decoder = json.JSONDecoder(object_pairs_hook=object_pairs_hook)
+    buf = _Buffer(fh, chunk_size)
+    opening = buf.expect('[{')
+    closing = ']' if opening == '[' else '}'
+    index = 0
+    if buf.peek() == closing:
+        return
+    while True:
+        if opening == '{':
+            key = buf.decode(decoder)
+            if not isinstance(key, basestring):
+                raise ValueError("Expecting a string key at offset %s" %
+                                 buf.pos)
+            buf.expect(':')
+        else:
+            key = index
+        yield key, buf.decode(decoder)
+        index += 1
+        if buf.expect(',' + closing) == closing:
+            return
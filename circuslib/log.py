@@ -1,5 +1,7 @@
 """Module to pretty print log/informational messages"""
+import json
 import sys
+import time
 
 # Set this to true to turn on debugging (i.e. do log.debug_enabled = True)
 debug_enabled = False
@@ -31,6 +33,42 @@ colors = {
     'bwhite':     cesc % (1, 37)}
 
 
+# Where records written by result() go. This is None unless json output is
+# turned on with enable_json_output().
+results = None
+
+
+def enable_json_output():
+    """Switches to machine readable output
+
+    Records passed to result() are written to stdout as json, one per line,
+    and everything else that would have been printed goes to stderr
+    instead, so that stdout can be piped into another program.
+    """
+    global results, color_enabled
+    if results is None:
+        results = sys.stdout
+        sys.stdout = sys.stderr
+        color_enabled = sys.stderr.isatty()
+
+
+def disable_json_output():
+    """Switches back to normal output after enable_json_output()"""
+    global results, color_enabled
+    if results is not None:
+        sys.stdout = results
+        results = None
+        color_enabled = sys.stdout.isatty()
+
+
+def result(record):
+    """Outputs the outcome of something (e.g. a resource being added) as a
+    json record, if json output is turned on"""
+    if results is not None:
+        results.write(json.dumps(record) + "\n")
+        results.flush()
+
+
 def colorformat(s, color):
     if color_enabled:
         return " %s*%s %s" % (colors[color], colors['normal'], s)
@@ -63,3 +101,40 @@ def msgnf(s):
     Useful for adding extra text to the end of a line output using msgnb.
     """
     print s
+
+
+class Progress(object):
+    """Prints how far through a long running task we are
+
+    A line is printed at most once every interval seconds, however often
+    update is called, so that printing doesn't slow down runs with many
+    thousands of items.
+    """
+    def __init__(self, label, total=None, interval=2.0):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = self.last = time.time()
+
+    def update(self, n=1):
+        self.done += n
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            self._print(now)
+
+    def finish(self):
+        if self.total == 0:
+            # Nothing was done, so there's no progress to report
+            return
+        self._print(time.time())
+
+    def _print(self, now):
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed else 0
+        if self.total:
+            msg("%s: %s/%s (%.1f/s)" % (self.label, self.done, self.total,
+                                        rate))
+        else:
+            msg("%s: %s (%.1f/s)" % (self.label, self.done, rate))
@@ -0,0 +1,97 @@
+"""Regular expression matching over lists of resources
+
+A Matcher compiles its patterns once, and checks every include and exclude
+pattern against a resource in a single pass. Use it to filter resources as
+they are read, before doing anything expensive (such as sorting) with them.
+"""
+import re
+import time
+
+import metrics
+
+
+class Matcher(object):
+    """Matches resources using regular expressions on their fields
+
+    Parameters:
+
+        includes - a list of (field, pattern) tuples. A resource matches
+            only if every include pattern matches.
+        excludes - a list of (field, pattern) tuples. A resource doesn't
+            match if any exclude pattern matches.
+        flags - regular expression flags (e.g. re.I) for all patterns
+
+    Patterns aren't anchored (re.search is used). Resources that don't have
+    a field an include pattern is for don't match.
+    """
+    def __init__(self, includes=(), excludes=(), flags=0):
+        self.includes = [(f, re.compile(p, flags)) for f, p in includes]
+        self.excludes = [(f, re.compile(p, flags)) for f, p in excludes]
+
+    @classmethod
+    def from_filters(cls, includes=(), excludes=(), flags=0):
+        """Creates a Matcher from filters of the form field=pattern"""
+        def parse(filters):
+            parsed = []
+            for f in filters:
+                if '=' not in f:
+                    raise ValueError("Filter '%s' should be of the form "
+                                     "field=pattern" % f)
+                parsed.append(tuple(f.split('=', 1)))
+            return parsed
+        return cls(parse(includes), parse(excludes), flags)
+
+    def match(self, resource):
+        """Returns the matching groups if the resource matches, or None
+
+        Numbered groups from all include patterns are returned as group1,
+        group2 etc. in the order the patterns were given, along with any
+        named groups.
+        """
+        groups = {}
+        n = 1
+        for field, regex in self.includes:
+            value = resource.get(field)
+            if value is None:
+                return None
+            if not isinstance(value, basestring):
+                value = str(value)
+            m = regex.search(value)
+            if m is None:
+                return None
+            for g in m.groups():
+                groups["group%s" % n] = g
+                n += 1
+            groups.update(m.groupdict())
+        for field, regex in self.excludes:
+            value = resource.get(field)
+            if value is None:
+                continue
+            if not isinstance(value, basestring):
+                value = str(value)
+            if regex.search(value):
+                return None
+        return groups
+
+    def filter(self, resources):
+        """Yields (resource, groups) for each matching resource"""
+        match = self.match
+        if not metrics.enabled:
+            for r in resources:
+                groups = match(r)
+                if groups is not None:
+                    yield r, groups
+            return
+        # Only the time spent matching is counted, not the time taken to
+        # read the resources or by whatever uses the results
+        spent = 0.0
+        total = matched = 0
+        for r in resources:
+            start = time.time()
+            groups = match(r)
+            spent += time.time() - start
+            total += 1
+            if groups is not None:
+                matched += 1
+                yield r, groups
+        metrics.record('filter', spent, resources=total, matched=matched)
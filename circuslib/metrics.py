@@ -0,0 +1,169 @@
+"""Metrics and tracing for bulk runs
+
+Parts of circuslib record events as they happen: each API call (latency,
+status, retries), each HTTP request (bytes sent and received), template
+rendering and filtering of resources. Recording is off by default and costs
+next to nothing; call enable() (the --metrics option of the tools) to turn
+it on.
+
+When enabled, every event is written as one json object per line to the
+given file, e.g.:
+
+    {"type": "api_call", "time": 1400000000.0, "duration": 0.21,
+     "method": "POST", "endpoint": "graph", "status": "ok", "retry": false}
+
+and a summary of how long each type of event took (count, mean,
+percentiles) is printed at the end of the run.
+"""
+import atexit
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import log
+
+enabled = False
+
+_lock = threading.Lock()
+_fh = None
+_registered = False
+_histograms = {}
+_totals = {}
+
+# Histogram bucket upper bounds in seconds, from 0.1ms up to ~ 100s
+BUCKETS = [0.0001 * 2 ** (i / 2.0) for i in range(41)]
+
+
+class Histogram(object):
+    """A histogram of durations with exponentially sized buckets"""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket the pth percentile is in"""
+        wanted = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= wanted:
+                if i >= len(BUCKETS):
+                    return self.max
+                return min(BUCKETS[i], self.max)
+        return self.max
+
+
+def enable(filename=None):
+    """Turns on recording, writing events to filename if given, and prints
+    a summary when the program exits"""
+    global enabled, _fh, _registered
+    with _lock:
+        if filename:
+            if _fh is not None:
+                _fh.close()
+            _fh = open(filename, 'w')
+        if not _registered:
+            atexit.register(finish)
+            _registered = True
+        enabled = True
+
+
+def disable():
+    """Turns off recording, closing the events file and forgetting
+    everything recorded so far (use finish to print the summary first)"""
+    global enabled, _fh
+    with _lock:
+        enabled = False
+        if _fh is not None:
+            _fh.close()
+            _fh = None
+        _histograms.clear()
+        _totals.clear()
+
+
+def record(event_type, duration=None, **fields):
+    """Records an event. If a duration (in seconds) is given it is added to
+    the histogram for the event type. Fields called bytes_* and retry are
+    totalled up for the summary, as is the number of each status."""
+    if not enabled:
+        return
+    fields['type'] = event_type
+    fields['time'] = time.time()
+    if duration is not None:
+        fields['duration'] = duration
+    with _lock:
+        if duration is not None:
+            h = _histograms.get(event_type)
+            if h is None:
+                h = _histograms[event_type] = Histogram()
+            h.add(duration)
+        for k, v in fields.items():
+            if (k.startswith('bytes_') or k == 'retry') and v:
+                key = (event_type, k)
+                _totals[key] = _totals.get(key, 0) + int(v)
+        if 'status' in fields:
+            key = (event_type, "status %s" % fields['status'])
+            _totals[key] = _totals.get(key, 0) + 1
+        if _fh is not None:
+            _fh.write(json.dumps(fields) + "\n")
+
+
+@contextmanager
+def timer(event_type, **fields):
+    """Records an event with how long the with block took"""
+    if not enabled:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(event_type, time.time() - start, **fields)
+
+
+def _ms(seconds):
+    return "%.1fms" % (seconds * 1000)
+
+
+def summary():
+    """Prints a summary of everything recorded so far"""
+    with _lock:
+        if not _histograms and not _totals:
+            return
+        log.msg("Timings:")
+        print "    %-14s %8s %10s %10s %10s %10s %10s %10s" % (
+            "", "count", "total", "mean", "p50", "p90", "p99", "max")
+        for name, h in sorted(_histograms.items()):
+            print "    %-14s %8s %10s %10s %10s %10s %10s %10s" % (
+                name, h.count, "%.2fs" % h.total, _ms(h.mean()),
+                _ms(h.percentile(50)), _ms(h.percentile(90)),
+                _ms(h.percentile(99)), _ms(h.max))
+        if _totals:
+            log.msg("Totals:")
+            for (name, key), value in sorted(_totals.items()):
+                print "    %-14s %-16s %12s" % (name, key, value)
+
+
+def finish():
+    """Prints the summary and turns recording off. This happens when the
+    program exits, and after each command in circus shell, so that every
+    command gets its own summary."""
+    summary()
+    disable()
@@ -0,0 +1,188 @@
+"""Command line options shared by all of the tools
+
+Every tool accepts the same options for choosing the account, how API calls
+are made (concurrency, rate limits, caching, connections), output, and
+planning. This module parses those, leaving each tool to handle its own
+options, and creates the api object from them.
+
+The config file is only loaded when it is first needed, and api objects are
+kept for reuse, so running several commands in the same process (see the
+circus command's shell mode) only sets up each account once.
+"""
+import getopt
+import sys
+
+import log
+import metrics
+import util
+
+SHORT = "a:dj:r:y"
+LONG = ["no-cache", "refresh", "cache-ttl=", "no-keepalive", "gzip",
+        "evented", "metrics=", "yes", "output=", "plan=", "apply="]
+
+_config = None
+# Api objects by (account, settings), for reuse between commands
+_apis = {}
+
+
+def config():
+    """Returns the circus config, loading it the first time"""
+    global _config
+    if _config is None:
+        from circonusapi import config as circonus_config
+        _config = circonus_config.load_config()
+    return _config
+
+
+def defaults():
+    """Returns the default values for the shared options"""
+    import cache
+    return {
+        'account': None,
+        'debug': False,
+        'concurrency': 1,
+        'rate': None,
+        'cache': True,
+        'refresh': False,
+        'cache_ttl': cache.DEFAULT_TTL,
+        'keepalive': True,
+        'gzip': False,
+        'evented': False,
+        'metrics': None,
+        'yes': False,
+        'output': 'text',
+        'plan': None,
+        'apply': None
+    }
+
+
+def usage(opts):
+    """Prints help for the shared options"""
+    print "  -a -- account (default: the default_account in the config file)"
+    print "  -d -- debug"
+    print "  -j -- number of API calls to make in parallel (default: %s)" % (
+        opts['concurrency'])
+    print "  -r -- maximum number of API calls per second (default: no limit)"
+    print "  -y, --yes -- don't ask for confirmation before making changes"
+    print "  --no-cache -- don't use the local cache of API listings"
+    print "  --refresh -- ignore the local cache and fetch listings again"
+    print "  --cache-ttl -- how long to use cached listings for, in seconds" \
+          " (default: %s)" % opts['cache_ttl']
+    print "  --no-keepalive -- open a new connection for every API call"
+    print "  --gzip -- compress API requests"
+    print "  --evented -- make API calls from a single event loop thread" \
+          " instead of a thread per call, for very high -j"
+    print "  --output -- text, or json to print a json record for each" \
+          " outcome (default: text)"
+    print "  --metrics -- write timings of API calls etc. to this file, and" \
+          " print a summary at the end"
+    print "  --plan -- write the changes to this file instead of making them"
+    print "  --apply -- make the changes in this plan file"
+
+
+def parse(argv, opts, usage_fn, short="", long_opts=(), handler=None):
+    """Parses command line arguments
+
+    Shared options are stored in opts. Any others (given in short and
+    long_opts, in getopt format) are passed to handler(o, a). usage_fn is
+    called (with opts) if the arguments are invalid, or for -?.
+
+    Returns the remaining arguments.
+    """
+    try:
+        parsed, args = getopt.gnu_getopt(argv, SHORT + short + "?",
+                                         LONG + list(long_opts))
+    except getopt.GetoptError, err:
+        print str(err)
+        usage_fn(opts)
+        sys.exit(2)
+
+    for o, a in parsed:
+        if o == '-a':
+            opts['account'] = a
+        elif o == '-d':
+            opts['debug'] = not opts['debug']
+        elif o == '-j':
+            opts['concurrency'] = int(a)
+        elif o == '-r':
+            opts['rate'] = float(a)
+        elif o in ('-y', '--yes'):
+            opts['yes'] = True
+        elif o == '--no-cache':
+            opts['cache'] = False
+        elif o == '--refresh':
+            opts['refresh'] = True
+        elif o == '--cache-ttl':
+            opts['cache_ttl'] = int(a)
+        elif o == '--no-keepalive':
+            opts['keepalive'] = False
+        elif o == '--gzip':
+            opts['gzip'] = True
+        elif o == '--evented':
+            opts['evented'] = True
+        elif o == '--output':
+            if a not in ('text', 'json'):
+                print "Output must be text or json"
+                usage_fn(opts)
+                sys.exit(2)
+            opts['output'] = a
+        elif o == '--metrics':
+            opts['metrics'] = a
+        elif o == '--plan':
+            opts['plan'] = a
+        elif o == '--apply':
+            opts['apply'] = a
+        elif o == '-?':
+            usage_fn(opts)
+            sys.exit(0)
+        elif handler is not None:
+            handler(o, a)
+    setup(opts)
+    return args
+
+
+def setup(opts):
+    """Applies the debug, output and confirmation settings"""
+    log.debug_enabled = opts['debug']
+    util.assume_yes = opts['yes']
+    if opts['output'] == 'json':
+        log.enable_json_output()
+    else:
+        log.disable_json_output()
+    if opts['metrics']:
+        metrics.enable(opts['metrics'])
+    else:
+        metrics.disable()
+
+
+def account(opts):
+    """Returns the account to use"""
+    return opts['account'] or config().get('general', 'default_account')
+
+
+def get_api(opts):
+    """Returns a circuslib.client.Client for the options given
+
+    Clients are reused if asked for again with the same settings, so the
+    connections, cache and resource store stay warm.
+    """
+    import cache
+    import client
+    name = account(opts)
+    key = (name, opts['debug'], opts['rate'], opts['concurrency'],
+           opts['cache'], opts['refresh'], opts['cache_ttl'],
+           opts['keepalive'], opts['gzip'], opts['evented'])
+    if key not in _apis:
+        listing_cache = None
+        if opts['cache']:
+            listing_cache = cache.Cache(name, opts['cache_ttl'],
+                                        opts['refresh'])
+        _apis[key] = client.get_client(config().get('tokens', name, None),
+                                       debug=opts['debug'],
+                                       rate=opts['rate'],
+                                       concurrency=opts['concurrency'],
+                                       cache=listing_cache,
+                                       keepalive=opts['keepalive'],
+                                       gzip=opts['gzip'],
+                                       evented=opts['evented'])
+    return _apis[key]
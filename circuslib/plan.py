@@ -0,0 +1,233 @@
+"""Planning and applying sets of API changes
+
+A change is a dict describing a single API call:
+
+    action - the http method (POST, PUT or DELETE)
+    endpoint - the endpoint or resource to call (e.g. /check_bundle or
+        /check_bundle/1234)
+    data - the data to send (None for deletions)
+    description - a human readable description of the change
+
+The bulk tools can write the changes they would make to a plan file instead
+of making them (--plan). The plan can be reviewed, and later applied exactly
+as written (--apply) without querying or recomputing anything.
+"""
+import json
+
+from circonusapi import circonusapi
+
+import bulk
+import cache
+import jsonstream
+import log
+import util
+
+# Assumed time for a single API call when estimating how long a plan will
+# take without a rate limit
+DEFAULT_LATENCY = 0.25
+# Errors that count as the failure of a single change
+API_ERRORS = (circonusapi.CirconusAPIError,)
+# Fields other than the ones being changed that must be sent with any PUT
+# to an endpoint
+required_fields = {
+    # You have to provide title/datapoints with any graph changes
+    'graph': ['title', 'datapoints']
+}
+
+
+def make_change(action, endpoint, data, description):
+    return {
+        'action': action,
+        'endpoint': endpoint,
+        'data': data,
+        'description': description}
+
+
+def update_data(current, changes):
+    """Returns the data to PUT to change some fields of a resource: just the
+    changed fields, plus any others the endpoint requires (taken from
+    current). Sending the whole resource would undo any changes made to the
+    other fields since current was fetched."""
+    data = {}
+    endpoint = cache.resource_endpoint(current['_cid'])
+    for field in required_fields.get(endpoint, []):
+        if field in current:
+            data[field] = current[field]
+    data.update(changes)
+    return data
+
+
+def write_plan(filename, changes):
+    """Writes changes to a plan file, returning the summary (see summarize)
+
+    Changes are written one at a time, so changes can be a generator.
+    """
+    stats = {}
+    with open(filename, 'w') as fh:
+        fh.write('[\n')
+        first = True
+        for c in changes:
+            if not first:
+                fh.write(',\n')
+            first = False
+            _count(stats, c)
+            json.dump(c, fh)
+        fh.write('\n]\n')
+    return stats
+
+
+def read_plan(filename):
+    """Iterates over the changes in a plan file"""
+    with open(filename) as fh:
+        for i, c in jsonstream.iterload(fh):
+            yield c
+
+
+def _count(stats, c):
+    key = (c['action'], cache.resource_endpoint(c['endpoint']))
+    s = stats.setdefault(key, {'requests': 0, 'bytes': 0})
+    s['requests'] += 1
+    if c.get('data') is not None:
+        s['bytes'] += len(json.dumps(c['data']))
+
+
+def summarize(changes):
+    """Counts the requests and payload bytes for a set of changes
+
+    Returns a dict keyed by (action, endpoint name), with requests and bytes
+    for each.
+    """
+    stats = {}
+    for c in changes:
+        _count(stats, c)
+    return stats
+
+
+def estimate_duration(requests, rate=None, concurrency=1):
+    """Estimates how long (in seconds) a number of requests will take"""
+    estimate = requests * DEFAULT_LATENCY / max(1, concurrency)
+    if rate:
+        estimate = max(estimate, requests / float(rate))
+    return estimate
+
+
+def print_summary(stats, rate=None, concurrency=1):
+    total_requests = sum(s['requests'] for s in stats.values())
+    total_bytes = sum(s['bytes'] for s in stats.values())
+    log.msg("Plan summary:")
+    for (action, endpoint), s in sorted(stats.items()):
+        print "    %-6s %-20s %8s requests %12s bytes" % (
+            action, endpoint, s['requests'], s['bytes'])
+    print "    %-27s %8s requests %12s bytes" % (
+        "Total", total_requests, total_bytes)
+    estimate = estimate_duration(total_requests, rate, concurrency)
+    if rate:
+        log.msg("Estimated time at %s requests/s with %s in parallel: %.0fs"
+                % (rate, concurrency, estimate))
+    else:
+        log.msg("Estimated time with %s in parallel (no rate limit, assuming"
+                " %.2fs per request): %.0fs" % (concurrency, DEFAULT_LATENCY,
+                                                estimate))
+
+
+def result_record(change, r):
+    """Returns the record output (see log.result) for the outcome of a
+    change, given its bulk.Result"""
+    record = {
+        'action': change['action'],
+        'endpoint': change['endpoint'],
+        'description': change.get('description'),
+        'status': 'ok' if r.ok else 'failed'}
+    if r.ok:
+        if isinstance(r.value, dict) and '_cid' in r.value:
+            record['_cid'] = r.value['_cid']
+    else:
+        record['error'] = str(r.error)
+    return record
+
+
+def make_changes(api, changes, concurrency=1, journal=None, total=None):
+    """Makes a set of changes, printing any that fail
+
+    Progress is printed every few seconds (out of total, if given). The
+    outcome of each change is printed in debug mode.
+
+    If a journal (see circuslib.journal) is given, changes it says are
+    already done are skipped, and the outcome of each change is recorded.
+
+    Returns a (succeeded, failed) tuple of counts.
+    """
+    def call(item):
+        key, c = item
+        data = c.get('data')
+        if c['action'] == 'DELETE':
+            # We don't send any data along for deletions
+            data = None
+        return api.api_call(c['action'], c['endpoint'], data)
+
+    def submit(item):
+        key, c = item
+        data = None if c['action'] == 'DELETE' else c.get('data')
+        return api.submit(c['action'], c['endpoint'], data)
+    if journal is None:
+        items = ((None, c) for c in changes)
+    else:
+        items = journal.filter(changes)
+    succeeded = failed = 0
+    progress = log.Progress("Changes made", total)
+    try:
+        if getattr(api, 'evented', False):
+            # No thread per call, so concurrency can be much higher
+            outcomes = bulk.run_futures(submit, items, concurrency,
+                                        errors=API_ERRORS)
+        else:
+            outcomes = bulk.run(call, items, concurrency, errors=API_ERRORS)
+        for r in outcomes:
+            key, c = r.item
+            description = c.get('description') or "%s %s" % (c['action'],
+                                                             c['endpoint'])
+            if r.ok:
+                succeeded += 1
+                log.debug("%s...Success" % description)
+            else:
+                failed += 1
+                log.error("%s...Failed: %s" % (description, r.error))
+            log.result(result_record(c, r))
+            progress.update()
+            if journal is not None:
+                if r.ok:
+                    journal.record(key, 'done')
+                else:
+                    journal.record(key, 'failed', error=str(r.error))
+    finally:
+        if journal is not None:
+            journal.sync()
+    progress.finish()
+    log.msg("%s changes made, %s failed" % (succeeded, failed))
+    if journal is not None and journal.skipped:
+        log.msg("Skipped %s changes that were already made" % journal.skipped)
+    return succeeded, failed
+
+
+def plan_pretty(filename, changes, rate=None, concurrency=1):
+    """Writes changes to a plan file and prints a summary of them"""
+    print_summary(write_plan(filename, changes), rate, concurrency)
+    log.msg("Plan written to %s. Use --apply %s to make the changes." % (
+        filename, filename))
+
+
+def apply_pretty(api, filename, rate=None, concurrency=1, journal=None):
+    """Applies a plan file, after showing a summary and asking to confirm.
+    Changes the journal says are done aren't counted in the progress."""
+    stats = summarize(read_plan(filename))
+    print_summary(stats, rate, concurrency)
+    total = sum(s['requests'] for s in stats.values())
+    if journal is not None and journal.done:
+        done = journal.count_done(read_plan(filename))
+        log.msg("%s of these changes were already made according to the"
+                " journal" % done)
+        total -= done
+    if util.confirm("Apply this plan?"):
+        make_changes(api, read_plan(filename), concurrency, journal, total)
+    else:
+        log.msg("Not applying the plan")
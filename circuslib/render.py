@@ -0,0 +1,148 @@
+"""Rendering templates for many resources across several processes
+
+Template.sub is fast, but it runs on a single core, and with tens of
+thousands of resources and a large template (e.g. a graph with many
+datapoints) rendering can take longer than the API calls. render() fans the
+work out to a pool of worker processes:
+
+ * The template is sent to each worker once, when the pool starts, and
+   compiled there (see Template.__getstate__).
+ * Resources are sent in chunks, so the cost of passing work between
+   processes is paid once per chunk rather than once per resource.
+ * Only a few chunks are in flight at once, and results are yielded in the
+   same order as the resources, as soon as they are ready. This means the
+   caller can start submitting the first results while later ones are
+   still being rendered.
+
+Values from related resources (keys with a dot, see template.FlatParams)
+need the resource store, which lives in the main process, so those are
+looked up before the resources are sent to the workers. Render times are
+only recorded (see circuslib.metrics) when rendering in the main process.
+"""
+import collections
+import multiprocessing
+
+import metrics
+import template
+
+DEFAULT_CHUNKSIZE = 256
+
+# Set in each worker process by _init_worker
+_template = None
+_names = None
+_defaults = None
+
+
+def params(resource, defaults, names=None, resource_store=None):
+    """Returns the template params for a resource: its (flattened) values,
+    with defaults for anything it doesn't have. If names (e.g.
+    Template.variables()) is given, those keys are resolved straight away.
+    With a resource_store, values from related resources can be used."""
+    merged = template.FlatParams(resource, defaults, resource_store)
+    if names:
+        merged.precompute(names)
+    return merged
+
+
+def render(t, resources, defaults=None, resource_store=None, processes=1,
+           chunksize=DEFAULT_CHUNKSIZE):
+    """Yields t.sub() for each resource, in order
+
+    Parameters:
+
+        t - the template.Template to render
+        resources - an iterable of resources. It is consumed lazily.
+        defaults - values for any params not found in a resource (e.g.
+            ones given on the command line)
+        resource_store - a store.ResourceStore for values from related
+            resources
+        processes - how many worker processes to render in. With 1, the
+            rendering is done in this process.
+        chunksize - how many resources to send to a worker at once
+    """
+    names = t.variables()
+    if processes <= 1:
+        for r in resources:
+            yield t.sub(params(r, defaults, names, resource_store))
+        return
+
+    # Keys that need the resource store
+    joined = [n for n in names if '.' in n]
+    pool = multiprocessing.Pool(processes, _init_worker, (t, defaults))
+    pending = collections.deque()
+    try:
+        for chunk in _chunks(resources, chunksize):
+            if joined and resource_store is not None:
+                chunk = [(r, _lookup_joined(r, joined, resource_store))
+                         for r in chunk]
+            else:
+                chunk = [(r, None) for r in chunk]
+            pending.append(pool.apply_async(_render_chunk, (chunk,)))
+            # Keep every worker busy, with a chunk waiting for each, but
+            # don't read further ahead than that
+            while len(pending) > processes * 2:
+                for output in _get(pending.popleft()):
+                    yield output
+        while pending:
+            for output in _get(pending.popleft()):
+                yield output
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _get(result):
+    # A timeout on get() keeps the main thread responsive to ^C
+    while True:
+        try:
+            return result.get(0.5)
+        except multiprocessing.TimeoutError:
+            pass
+
+
+def _chunks(items, size):
+    chunk = []
+    for i in items:
+        chunk.append(i)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _lookup_joined(resource, names, resource_store):
+    merged = template.FlatParams(resource, store=resource_store)
+    values = {}
+    for name in names:
+        if name in merged:
+            values[name] = merged[name]
+    return values
+
+
+def _init_worker(t, defaults):
+    global _template, _names, _defaults
+    _template = t
+    _names = t.variables()
+    _defaults = defaults or {}
+    # Metrics are written by the main process only
+    metrics.enabled = False
+
+
+def _render_chunk(chunk):
+    output = []
+    for resource, joined in chunk:
+        defaults = _defaults
+        if joined:
+            # Related values were looked up in the main process. They're
+            # never in the resource itself, so they can go in the defaults.
+            defaults = dict(_defaults)
+            defaults.update(joined)
+        rendered = _template.sub(params(resource, defaults, _names))
+        if type(rendered) not in (dict, list):
+            # Generators (from __foreach templates) can't be sent back to
+            # the main process
+            rendered = list(rendered)
+        output.append(rendered)
+    return output
@@ -0,0 +1,199 @@
+"""Adding resources that refer to each other, in dependency order
+
+Resources in a single input can refer to other resources in the same input
+that haven't been created yet. Give a resource a name with a _ref key, and
+use a placeholder wherever its id (or anything else about it once created)
+is needed:
+
+    {ref:NAME} - the _cid of the new resource, e.g. /check_bundle/1234
+    {ref:NAME.FIELD} - a field of the new resource, as returned by the API.
+        Lists are indexed with numbers, e.g. {ref:web._checks.0}
+    {id:NAME...} - like ref, but just the id at the end of the value, as a
+        number if it is one (e.g. 5678 for /check/5678). Use this for the
+        check_id of graph datapoints: {id:web._checks.0}
+
+If a placeholder is the whole of a string, it is replaced by the value
+itself (so numbers stay numbers), otherwise the value is put into the
+string.
+
+The resources are sorted into levels: the first level has everything that
+doesn't refer to anything, the next everything that only refers to the
+first level, and so on. Each level is added in parallel, and the values of
+newly created resources are filled in to the next levels as they go.
+Resources that refer to something that failed to be added are skipped.
+"""
+import re
+
+from circonusapi import circonusapi
+
+import bulk
+import log
+
+PLACEHOLDER = re.compile(r"\{(ref|id):([^.}]+)((?:\.[^.}]+)*)\}")
+
+
+class SchedulerError(Exception):
+    pass
+
+
+def find_refs(obj):
+    """Returns the set of names referred to anywhere in obj"""
+    refs = set()
+    if isinstance(obj, dict):
+        for v in obj.values():
+            refs |= find_refs(v)
+    elif isinstance(obj, list):
+        for v in obj:
+            refs |= find_refs(v)
+    elif isinstance(obj, basestring):
+        for m in PLACEHOLDER.finditer(obj):
+            refs.add(m.group(2))
+    return refs
+
+
+def has_refs(resource):
+    """Returns True if a resource has a name or refers to another"""
+    return '_ref' in resource or bool(find_refs(resource))
+
+
+def _lookup(created, kind, name, path):
+    value = created[name]
+    if not path:
+        value = value['_cid']
+    for part in path.split('.')[1:]:
+        if isinstance(value, list):
+            value = value[int(part)]
+        else:
+            value = value[part]
+    if kind == 'id':
+        value = str(value).rstrip('/').split('/')[-1]
+        if value.isdigit():
+            value = int(value)
+    return value
+
+
+def substitute(obj, created):
+    """Replaces placeholders in obj with values from created (a dict of
+    name => resource returned by the API)"""
+    if isinstance(obj, dict):
+        return dict((k, substitute(v, created)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [substitute(v, created) for v in obj]
+    if isinstance(obj, basestring):
+        m = PLACEHOLDER.match(obj)
+        if m and m.end() == len(obj):
+            return _lookup(created, *m.groups())
+        return PLACEHOLDER.sub(
+            lambda m: str(_lookup(created, *m.groups())), obj)
+    return obj
+
+
+def levels(resources):
+    """Sorts resources into levels, returning a list of lists of indexes
+    into resources. Raises SchedulerError for unknown names or circular
+    references."""
+    names = {}
+    for i, r in enumerate(resources):
+        name = r.get('_ref')
+        if name is None:
+            continue
+        if name in names:
+            raise SchedulerError("Duplicate _ref: %s" % name)
+        names[name] = i
+    deps = []
+    for i, r in enumerate(resources):
+        refs = find_refs(r)
+        unknown = refs - set(names)
+        if unknown:
+            raise SchedulerError("Unknown _ref: %s" % ', '.join(
+                sorted(unknown)))
+        deps.append(set(names[n] for n in refs))
+
+    result = []
+    level_of = {}
+    remaining = set(range(len(resources)))
+    while remaining:
+        level = sorted(i for i in remaining
+                       if all(d in level_of for d in deps[i]))
+        if not level:
+            raise SchedulerError("Circular references between: %s" % ', '.join(
+                sorted(resources[i].get('_ref', str(i)) for i in remaining)))
+        for i in level:
+            level_of[i] = len(result)
+        remaining -= set(level)
+        result.append(level)
+    return result, deps
+
+
+def run(api, resources, get_endpoint, concurrency=1):
+    """Adds resources in dependency order
+
+    get_endpoint(resource) returns the endpoint to POST a resource to.
+
+    Returns (succeeded, failed, skipped) counts.
+    """
+    resource_levels, deps = levels(resources)
+    log.msg("Adding %s resources in %s levels" % (len(resources),
+                                                  len(resource_levels)))
+    created = {}
+    # Indexes of resources that weren't added, either because they failed
+    # or because they depend on something that wasn't added
+    not_added = set()
+    succeeded = failed = skipped = 0
+
+    def add(i):
+        data = substitute(resources[i], created)
+        data.pop('_ref', None)
+        return api.api_call("POST", get_endpoint(data), data)
+
+    def make_record(i):
+        endpoint = get_endpoint(resources[i])
+        return {'action': 'POST', 'endpoint': endpoint,
+                'description': _describe(endpoint, resources[i], i)}
+
+    for n, level in enumerate(resource_levels):
+        todo = []
+        for i in level:
+            if deps[i] & not_added:
+                not_added.add(i)
+                skipped += 1
+                record = make_record(i)
+                record['status'] = 'skipped'
+                log.error("Skipping %s as something it refers to wasn't"
+                          " added" % record['description'])
+                log.result(record)
+            else:
+                todo.append(i)
+        log.msg("Level %s: adding %s resources" % (n + 1, len(todo)))
+        # KeyError/IndexError come from placeholders for fields the new
+        # resource doesn't have
+        for r in bulk.run(add, todo, concurrency,
+                          errors=(circonusapi.CirconusAPIError, KeyError,
+                                  IndexError)):
+            i = r.item
+            record = make_record(i)
+            if r.ok:
+                succeeded += 1
+                name = resources[i].get('_ref')
+                if name is not None:
+                    created[name] = r.value
+                record['status'] = 'ok'
+                if isinstance(r.value, dict) and '_cid' in r.value:
+                    record['_cid'] = r.value['_cid']
+                log.debug("%s...Success" % record['description'])
+            else:
+                failed += 1
+                not_added.add(i)
+                record['status'] = 'failed'
+                record['error'] = str(r.error)
+                log.error("%s...Failed: %s" % (record['description'],
+                                               r.error))
+            log.result(record)
+    log.msg("%s added, %s failed, %s skipped" % (succeeded, failed, skipped))
+    return succeeded, failed, skipped
+
+
+def _describe(endpoint, resource, i):
+    if '_ref' in resource:
+        return "%s (%s)" % (endpoint, resource['_ref'])
+    return "%s (#%s)" % (endpoint, i + 1)
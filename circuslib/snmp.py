@@ -0,0 +1,294 @@
+"""SNMP walk backends used for discovering things (e.g. switch ports)
+
+Two backends are provided, both of which take the same arguments and return
+a list of (oid, value) tuples for everything under the given oid:
+
+ * native - an SNMPv2c GETBULK walk done in-process over UDP. This asks for
+   many values per request (max_repetitions), so even large switches only
+   take a couple of round trips.
+ * snmpwalk - runs the net-snmp snmpwalk command and parses its output. This
+   is kept as a fallback for agents that the native backend doesn't get on
+   with.
+"""
+import random
+import re
+import socket
+import subprocess
+import threading
+import time
+
+
+class SNMPError(Exception):
+    pass
+
+
+# BER tags
+INTEGER = 0x02
+OCTET_STRING = 0x04
+NULL = 0x05
+OBJECT_IDENTIFIER = 0x06
+SEQUENCE = 0x30
+IP_ADDRESS = 0x40
+COUNTER32 = 0x41
+GAUGE32 = 0x42
+TIMETICKS = 0x43
+OPAQUE = 0x44
+COUNTER64 = 0x46
+NO_SUCH_OBJECT = 0x80
+NO_SUCH_INSTANCE = 0x81
+END_OF_MIB_VIEW = 0x82
+GET_RESPONSE = 0xa2
+GET_BULK_REQUEST = 0xa5
+
+SNMP_VERSION_2C = 1
+
+
+def _encode_length(n):
+    if n < 0x80:
+        return chr(n)
+    s = ''
+    while n:
+        s = chr(n & 0xff) + s
+        n >>= 8
+    return chr(0x80 | len(s)) + s
+
+
+def _encode(tag, value):
+    return chr(tag) + _encode_length(len(value)) + value
+
+
+def _encode_int(n):
+    s = ''
+    while True:
+        s = chr(n & 0xff) + s
+        n >>= 8
+        # Stop once the remaining value is just sign extension
+        if (n == 0 and not ord(s[0]) & 0x80) or \
+                (n == -1 and ord(s[0]) & 0x80):
+            break
+    return _encode(INTEGER, s)
+
+
+def _encode_oid(oid):
+    arcs = [int(i) for i in oid.strip('.').split('.')]
+    if len(arcs) < 2:
+        raise ValueError("Invalid OID: %s" % oid)
+    s = chr(40 * arcs[0] + arcs[1])
+    for arc in arcs[2:]:
+        chunk = chr(arc & 0x7f)
+        arc >>= 7
+        while arc:
+            chunk = chr(0x80 | (arc & 0x7f)) + chunk
+            arc >>= 7
+        s += chunk
+    return _encode(OBJECT_IDENTIFIER, s)
+
+
+def _decode(data, pos=0):
+    """Decodes a single TLV, returning (tag, value, next_pos)"""
+    try:
+        tag = ord(data[pos])
+        length = ord(data[pos + 1])
+        pos += 2
+        if length & 0x80:
+            n = length & 0x7f
+            length = 0
+            for c in data[pos:pos + n]:
+                length = (length << 8) | ord(c)
+            pos += n
+    except IndexError:
+        raise SNMPError("Truncated SNMP packet")
+    if pos + length > len(data):
+        raise SNMPError("Truncated SNMP packet")
+    return tag, data[pos:pos + length], pos + length
+
+
+def _decode_sequence(data):
+    items = []
+    pos = 0
+    while pos < len(data):
+        tag, value, pos = _decode(data, pos)
+        items.append((tag, value))
+    return items
+
+
+def _decode_int(value, signed=True):
+    n = 0
+    for c in value:
+        n = (n << 8) | ord(c)
+    if signed and value and ord(value[0]) & 0x80:
+        n -= 1 << (8 * len(value))
+    return n
+
+
+def _decode_oid(value):
+    if not value:
+        return ''
+    first = ord(value[0])
+    arcs = [min(first // 40, 2), first - 40 * min(first // 40, 2)]
+    n = 0
+    for c in value[1:]:
+        n = (n << 7) | (ord(c) & 0x7f)
+        if not ord(c) & 0x80:
+            arcs.append(n)
+            n = 0
+    return '.' + '.'.join(str(i) for i in arcs)
+
+
+def _decode_value(tag, value):
+    if tag == INTEGER:
+        return _decode_int(value)
+    if tag in (COUNTER32, GAUGE32, TIMETICKS, COUNTER64):
+        return _decode_int(value, signed=False)
+    if tag == OBJECT_IDENTIFIER:
+        return _decode_oid(value)
+    if tag == IP_ADDRESS:
+        return '.'.join(str(ord(c)) for c in value)
+    if tag in (NULL, NO_SUCH_OBJECT, NO_SUCH_INSTANCE, END_OF_MIB_VIEW):
+        return None
+    return value
+
+
+def encode_get_bulk(request_id, community, oid, max_repetitions):
+    """Builds an SNMPv2c GetBulkRequest packet for a single oid"""
+    varbind = _encode(SEQUENCE, _encode_oid(oid) + _encode(NULL, ''))
+    pdu = _encode(GET_BULK_REQUEST,
+                  _encode_int(request_id) +
+                  _encode_int(0) +  # non-repeaters
+                  _encode_int(max_repetitions) +
+                  _encode(SEQUENCE, varbind))
+    return _encode(SEQUENCE, _encode_int(SNMP_VERSION_2C) +
+                   _encode(OCTET_STRING, community) + pdu)
+
+
+def decode_response(data):
+    """Decodes an SNMP response packet
+
+    Returns (request_id, error_status, varbinds), where varbinds is a list of
+    (oid, tag, value) tuples. Raises SNMPError if the packet can't be
+    decoded.
+    """
+    try:
+        return _decode_response(data)
+    except (ValueError, TypeError, IndexError), e:
+        raise SNMPError("Invalid SNMP response: %s" % e)
+
+
+def _decode_response(data):
+    tag, message, pos = _decode(data)
+    if tag != SEQUENCE:
+        raise SNMPError("Invalid SNMP packet")
+    items = _decode_sequence(message)
+    if len(items) != 3 or items[2][0] != GET_RESPONSE:
+        raise SNMPError("Unexpected SNMP packet")
+    pdu = _decode_sequence(items[2][1])
+    if len(pdu) != 4:
+        raise SNMPError("Invalid SNMP response")
+    request_id = _decode_int(pdu[0][1])
+    error_status = _decode_int(pdu[1][1])
+    varbinds = []
+    for vb_tag, vb in _decode_sequence(pdu[3][1]):
+        (oid_tag, oid), (value_tag, value) = _decode_sequence(vb)
+        varbinds.append((_decode_oid(oid), value_tag,
+                         _decode_value(value_tag, value)))
+    return request_id, error_status, varbinds
+
+
+def _oid_key(oid):
+    return [int(i) for i in oid.strip('.').split('.')]
+
+
+def walk(target, community, oid, port=161, timeout=30, max_repetitions=50,
+         retry_interval=1):
+    """Walks an oid subtree using SNMPv2c GETBULK requests
+
+    Requests are resent every retry_interval seconds if there is no response,
+    until timeout seconds have passed in total.
+    """
+    oid = '.' + oid.strip('.')
+    prefix = oid + '.'
+    deadline = time.time() + timeout
+    results = []
+    current = oid
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        while True:
+            request_id = random.randint(1, 0x7fffffff)
+            packet = encode_get_bulk(request_id, community, current,
+                                     max_repetitions)
+            response = None
+            while response is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise SNMPError("Timed out waiting for %s" % target)
+                try:
+                    sock.sendto(packet, (target, int(port)))
+                    sock.settimeout(min(retry_interval, remaining))
+                    data = sock.recv(65535)
+                except socket.timeout:
+                    continue
+                except socket.error, e:
+                    raise SNMPError("%s: %s" % (target, e))
+                rid, error_status, varbinds = decode_response(data)
+                # Ignore late responses to earlier requests
+                if rid == request_id:
+                    response = (error_status, varbinds)
+            error_status, varbinds = response
+            if error_status:
+                raise SNMPError("%s returned SNMP error %s" % (
+                    target, error_status))
+            if not varbinds:
+                break
+            for vb_oid, tag, value in varbinds:
+                if tag == END_OF_MIB_VIEW or not vb_oid.startswith(prefix):
+                    return results
+                if _oid_key(vb_oid) <= _oid_key(current):
+                    raise SNMPError("%s returned OIDs out of order" % target)
+                results.append((vb_oid, value))
+                current = vb_oid
+    finally:
+        sock.close()
+    return results
+
+
+def snmpwalk(target, community, oid, port=161, timeout=30):
+    """Walks an oid subtree by running the snmpwalk command
+
+    The command is killed if it takes longer than timeout seconds.
+    """
+    try:
+        proc = subprocess.Popen(("snmpwalk", "-On", "-v2c", "-c",
+            community, "%s:%s" % (target, port), oid),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError, e:
+        raise SNMPError("Unable to run snmpwalk: %s" % e)
+    timed_out = []
+
+    def kill():
+        timed_out.append(True)
+        proc.kill()
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        output, errors = proc.communicate()
+    finally:
+        timer.cancel()
+    if timed_out:
+        raise SNMPError("snmpwalk timed out")
+    if proc.returncode != 0:
+        raise SNMPError("snmpwalk failed: %s" % errors.strip())
+    results = []
+    for line in output.split("\n"):
+        m = re.match(r'([.0-9]+) = (?:[A-Za-z0-9-]+: )?(.*)$', line)
+        if m:
+            value = m.group(2)
+            if len(value) > 1 and value[0] == value[-1] == '"':
+                value = value[1:-1]
+            results.append((m.group(1), value))
+    return results
+
+
+backends = {
+    'native': walk,
+    'snmpwalk': snmpwalk
+}
@@ -0,0 +1,201 @@
+"""In-memory store of API resources with indexes for fast lookups
+
+The store loads each endpoint listing once (on first use), and builds hash
+indexes on demand, so that looking up related resources (e.g. the broker for
+a check, or the check bundle behind a graph datapoint) doesn't need a scan of
+the whole listing every time.
+
+The store is a snapshot: resources added or changed after an endpoint has
+been loaded won't show up unless it is invalidated, or until it expires.
+Endpoints expire after the same TTL as the listing cache (see
+circuslib.cache), so a long running process such as circus shell picks up
+changes made elsewhere.
+"""
+import re
+import threading
+import time
+import weakref
+
+import cache
+
+# Mapping of endpoints to which attribute is used as a friendly name
+title_fields = {
+    "/graph": "title",
+    "/check_bundle": "display_name",
+    "/rule_set": "metric_name",
+    "/worksheet": "description",
+    "/template": "name",
+    "/contact_group": "name",
+    "/account": "name",
+    "/broker": "_name",
+    "/user": "email"
+}
+
+_stores = weakref.WeakKeyDictionary()
+
+
+def invalidate(api, endpoint):
+    """Forgets an endpoint in the store for an api object, if it has one.
+    Used when resources in the endpoint are changed."""
+    store = _stores.get(api)
+    if store is not None:
+        store.invalidate(endpoint)
+
+
+class ResourceStore(object):
+    """Indexed resources for a single account
+
+    Parameters:
+
+        api - the api object (usually a circuslib.client.Client) used to
+            load endpoint listings
+        ttl - how long (in seconds) to keep an endpoint before loading it
+            again. Defaults to the TTL of the api's listing cache.
+    """
+    def __init__(self, api, ttl=None):
+        self.api = api
+        if ttl is None:
+            ttl = getattr(getattr(api, 'cache', None), 'ttl',
+                          cache.DEFAULT_TTL)
+        self.ttl = ttl
+        self.endpoints = {}
+        # When each endpoint was loaded
+        self.loaded = {}
+        # How many times each endpoint has been invalidated
+        self.generations = {}
+        self.by_cid = {}
+        self.indexes = {}
+        self.lock = threading.RLock()
+
+    @classmethod
+    def for_api(cls, api):
+        """Returns a store shared by everything using the same api object"""
+        store = _stores.get(api)
+        if store is None:
+            store = _stores[api] = cls(api)
+        return store
+
+    def load(self, endpoint):
+        """Returns all resources for an endpoint, loading it if needed"""
+        endpoint = endpoint.strip('/')
+        with self.lock:
+            self._expire(endpoint)
+            if endpoint in self.endpoints:
+                return self.endpoints[endpoint]
+            generation = self.generations.get(endpoint, 0)
+        # The lock isn't held while loading. With an evented api, loading
+        # waits for the event loop thread, which may itself need the lock
+        # to invalidate an endpoint once a call finishes.
+        if hasattr(self.api, 'iter_list'):
+            resources = list(self.api.iter_list("/%s" % endpoint))
+        else:
+            resources = self.api.api_call("GET", "/%s" % endpoint)
+        with self.lock:
+            if endpoint in self.endpoints:
+                # Another thread loaded it at the same time
+                return self.endpoints[endpoint]
+            if self.generations.get(endpoint, 0) != generation:
+                # Invalidated while loading, so this may already be out of
+                # date. Use it, but don't keep it.
+                return resources
+            for r in resources:
+                if '_cid' in r:
+                    self.by_cid[r['_cid']] = r
+            self.endpoints[endpoint] = resources
+            self.loaded[endpoint] = time.time()
+            return resources
+
+    def _expire(self, endpoint):
+        loaded = self.loaded.get(endpoint)
+        if loaded is not None and time.time() - loaded > self.ttl:
+            self.invalidate(endpoint)
+
+    def invalidate(self, endpoint):
+        """Forgets an endpoint, so it will be loaded again on next use"""
+        endpoint = endpoint.strip('/')
+        with self.lock:
+            self.generations[endpoint] = self.generations.get(endpoint, 0) + 1
+            self.loaded.pop(endpoint, None)
+            for r in self.endpoints.pop(endpoint, []):
+                self.by_cid.pop(r.get('_cid'), None)
+            for key in [k for k in self.indexes if k[0] == endpoint]:
+                del self.indexes[key]
+
+    def index(self, endpoint, field):
+        """Returns a dict mapping values of a field to lists of resources.
+        If the field is a list (e.g. tags), each item is indexed."""
+        endpoint = endpoint.strip('/')
+        key = (endpoint, field)
+        resources = self.load(endpoint)
+        with self.lock:
+            if key in self.indexes:
+                return self.indexes[key]
+            index = {}
+            for r in resources:
+                values = r.get(field)
+                if type(values) != list:
+                    values = [values]
+                for v in values:
+                    if type(v) not in (dict, list):
+                        index.setdefault(v, []).append(r)
+            # Only keep it if it was built from the stored resources
+            if self.endpoints.get(endpoint) is resources:
+                self.indexes[key] = index
+            return index
+
+    def find(self, endpoint, field, value):
+        """Returns a list of resources where field has the given value"""
+        return self.index(endpoint, field).get(value, [])
+
+    def by_name(self, endpoint, name):
+        """Finds resources by their display name/title"""
+        endpoint = endpoint.strip('/')
+        return self.find(endpoint, title_fields.get("/%s" % endpoint,
+                                                    'title'), name)
+
+    def by_tag(self, endpoint, tag):
+        return self.find(endpoint, 'tags', tag)
+
+    def by_check(self, check_id):
+        """Finds the check bundle a check (e.g. /check/1234 or just 1234)
+        belongs to, or None"""
+        if not str(check_id).startswith('/'):
+            check_id = "/check/%s" % check_id
+        bundles = self.find('check_bundle', '_checks', check_id)
+        if bundles:
+            return bundles[0]
+        return None
+
+    def get(self, cid):
+        """Looks up a resource by its _cid, or None if it doesn't exist.
+        Check ids (/check/1234) return the check bundle they belong to."""
+        cid = str(cid)
+        m = re.match("/([a-z_]+)/", cid)
+        if not m:
+            return None
+        if m.group(1) == 'check':
+            return self.by_check(cid)
+        resources = self.load(m.group(1))
+        if self.endpoints.get(m.group(1)) is not resources:
+            # Loaded, but not stored (see load)
+            for r in resources:
+                if r.get('_cid') == cid:
+                    return r
+            return None
+        return self.by_cid.get(cid)
+
+    def related(self, key, value):
+        """Looks up the resource a value in another resource refers to
+
+        Values are usually resource ids (e.g. /broker/1). Bare numbers are
+        treated as check ids if the key they came from ends in check_id, as
+        in graph datapoints.
+        """
+        if isinstance(value, (int, long)) or \
+                (isinstance(value, basestring) and value.isdigit()):
+            if key.endswith('check_id'):
+                return self.by_check(value)
+            return None
+        if isinstance(value, basestring):
+            return self.get(value)
+        return None
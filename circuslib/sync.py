@@ -0,0 +1,157 @@
+"""Syncing the resources in an account to a desired state
+
+Given the resources that should exist, diff works out the smallest set of
+changes (see circuslib.plan) that makes the account match:
+
+ * resources that don't exist yet are added (POST)
+ * resources that exist but have different values for any of the fields
+   given are updated (PUT)
+ * with prune, resources of the same type that aren't in the desired state
+   are deleted (DELETE)
+
+Existing resources are matched up with desired ones using an identity key:
+a field that is unique for each resource, such as a graph's title (by
+default, the field in store.title_fields). A desired resource whose _cid
+includes an id (e.g. /graph/1234) is matched by that id instead.
+
+Current resources come from the endpoint listings, indexed by the identity
+key, so a sync where little has changed costs only a listing per endpoint
+plus a request per actual change. The listings are always fetched from the
+API rather than the cache, and updates only send the desired fields (plus
+any the endpoint requires, see plan.required_fields), so a sync never puts
+back old values of fields someone else has changed.
+
+A desired resource with an id that doesn't exist is reported as an error
+and skipped, rather than being added as a new resource.
+"""
+import log
+import plan
+from store import ResourceStore, title_fields
+
+
+def parse_keys(keys):
+    """Parses identity keys given as 'field' (for every endpoint) or
+    'endpoint=field'. Returns a dict of endpoint => field, where the
+    endpoint None is the default for all endpoints."""
+    parsed = {}
+    for k in keys:
+        if '=' in k:
+            endpoint, field = k.split('=', 1)
+            parsed[endpoint.strip('/')] = field
+        else:
+            parsed[None] = k
+    return parsed
+
+
+def identity_field(endpoint, keys=None):
+    """Returns the identity key field for an endpoint (e.g. 'graph')"""
+    keys = keys or {}
+    if endpoint in keys:
+        return keys[endpoint]
+    if None in keys:
+        return keys[None]
+    return title_fields.get("/%s" % endpoint, 'title')
+
+
+def differs(current, desired):
+    """Returns True if any field in desired has a different value in
+    current. Fields only in current (e.g. ones the API fills in) don't
+    count."""
+    for k, v in desired.items():
+        if k == '_cid':
+            continue
+        if current.get(k) != v:
+            return True
+    return False
+
+
+def _describe(resource, field):
+    return "%s (%s)" % (resource.get('_cid'), resource.get(field))
+
+
+def diff(api, desired, keys=None, prune=False):
+    """Yields the changes needed to make the account match desired
+
+    Parameters:
+
+        api - the api object to look up current resources with
+        desired - an iterable of resources, each with a _cid giving the
+            endpoint (e.g. /graph) or resource (e.g. /graph/1234)
+        keys - identity key fields, as returned by parse_keys
+        prune - if True, delete current resources that aren't in desired,
+            for each endpoint that appears in desired
+
+    Desired resources are compared against current ones as they are read,
+    so desired can be a generator.
+    """
+    resource_store = ResourceStore.for_api(api)
+    # endpoint => {identity => [current resources]}
+    indexes = {}
+    # _cids of current resources that have been matched
+    matched = set()
+
+    def candidates(endpoint):
+        if endpoint not in indexes:
+            if hasattr(api, 'refresh'):
+                api.refresh(endpoint)
+            field = identity_field(endpoint, keys)
+            index = indexes[endpoint] = resource_store.index(endpoint, field)
+            duplicates = sum(1 for v in index.values() if len(v) > 1)
+            if duplicates:
+                log.msg("%s %s values are shared by more than one existing"
+                        " %s" % (duplicates, field, endpoint))
+        return indexes[endpoint]
+
+    def take(endpoint, field, resource):
+        """Finds the current resource that matches a desired one"""
+        for current in candidates(endpoint).get(resource.get(field), []):
+            if current['_cid'] not in matched:
+                return current
+        return None
+
+    for resource in desired:
+        endpoint = resource['_cid'].strip('/').split('/')[0]
+        field = identity_field(endpoint, keys)
+        candidates(endpoint)
+        if '/' in resource['_cid'].strip('/'):
+            current = resource_store.get(resource['_cid'])
+            if current is None or current['_cid'] in matched:
+                if current is None:
+                    error = "doesn't exist"
+                else:
+                    error = "is in the desired state more than once"
+                log.error("%s %s, skipping it" % (resource['_cid'], error))
+                log.result({
+                    'action': 'PUT',
+                    'endpoint': resource['_cid'],
+                    'description': "Updating %s" % _describe(resource,
+                                                             field),
+                    'status': 'failed',
+                    'error': error})
+                continue
+        else:
+            current = take(endpoint, field, resource)
+        if current is None:
+            if field not in resource:
+                log.msg("No %s to match on, adding: %s" % (field, resource))
+            data = dict(resource)
+            data['_cid'] = "/%s" % endpoint
+            yield plan.make_change("POST", "/%s" % endpoint, data,
+                                   "Adding %s %s" % (endpoint,
+                                                     resource.get(field)))
+            continue
+        matched.add(current['_cid'])
+        if differs(current, resource):
+            data = plan.update_data(current, resource)
+            data['_cid'] = current['_cid']
+            yield plan.make_change("PUT", current['_cid'], data,
+                                   "Updating %s" % _describe(current, field))
+
+    if prune:
+        for endpoint in sorted(indexes):
+            field = identity_field(endpoint, keys)
+            for resource in resource_store.load(endpoint):
+                if resource['_cid'] not in matched:
+                    yield plan.make_change(
+                        "DELETE", resource['_cid'], None,
+                        "Deleting %s" % _describe(resource, field))
@@ -3,19 +3,220 @@
 Note: The templates in this module are not those inside circonus, but are
 simply json files with placeholders for things like check bundle IDs to allow
 bulk operations.
+
+Templates are compiled when they are loaded. Each string is split up into
+literal text and placeholders ahead of time, and parts of the template that
+don't contain any placeholders are only copied when the template is used.
+This makes Template.sub cheap enough to call once for every one of a large
+number of resources.
+
+A template can also make one resource for each element of a list in the
+resource it's rendered for (e.g. a rule set for each of a check bundle's
+metrics) with a __foreach key. See Template.sub.
+
+Templates can be pickled (e.g. to send them to worker processes), and are
+compiled again when unpickled.
+
+Variables are only expanded once per call to Template.sub, however many times
+they are used. Template variables (__vars) that don't depend on any params
+are only expanded once for the lifetime of the template.
 """
 import json
 import re
 import sys
 
 import log
+import metrics
+
+# Placeholders look like {name} or {filter:name}
+PLACEHOLDER = re.compile("{(?:([a-zA-Z_]+):)?([^ }]+)}")
+
+def _copy(i):
+    """Copies a json structure. Faster than copy.deepcopy as only dicts and
+    lists need copying"""
+    if type(i) == dict:
+        return dict((k, _copy(v)) for k, v in i.iteritems())
+    if type(i) == list:
+        return [_copy(v) for v in i]
+    return i
+
+_MISSING = object()
+
+class FlatParams(object):
+    """Template params taken from a nested resource (e.g. a check bundle)
+
+    Nested values are referred to using flattened keys, where the keys at
+    each level are joined with underscores and list items are referred to by
+    their index (e.g. {"metrics": [{"name": "foo"}]} gives metrics_0_name).
+    Rather than building every possible key up front, keys are resolved from
+    the resource when they are looked up, so only the values a template
+    actually uses are ever worked out.
+
+    Values in defaults are used for any keys not found in the resource.
+
+    If a store (circuslib.store.ResourceStore) is given, values from related
+    resources can be looked up by joining keys with a dot. The part before
+    the dot is a key whose value refers to another resource, and the part
+    after is looked up in that resource. For example, brokers_0._name is the
+    name of a check bundle's first broker, and datapoints_0_check_id.target
+    is the target of the check behind a graph's first datapoint.
+    """
+    def __init__(self, resource, defaults=None, store=None):
+        self.resource = resource
+        self.defaults = defaults or {}
+        self.store = store
+        self._resolved = {}
+
+    def precompute(self, names):
+        """Resolves the given keys straight away, e.g. the names returned by
+        Template.variables()"""
+        for name in names:
+            self._lookup(name)
+
+    def _lookup(self, key):
+        value = self._resolved.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._resolve(self.resource, key)
+            if value is _MISSING and self.store is not None and '.' in key:
+                value = self._join(key)
+            if value is _MISSING:
+                value = self.defaults.get(key, _MISSING)
+            self._resolved[key] = value
+        return value
+
+    def _join(self, key):
+        """Looks up a key in a related resource"""
+        local, remote = key.split('.', 1)
+        value = self._lookup(local)
+        if value is _MISSING:
+            return _MISSING
+        related = self.store.related(local, value)
+        if related is None:
+            return _MISSING
+        return FlatParams(related, store=self.store).get(remote, _MISSING)
+
+    def _resolve(self, obj, key):
+        """Finds the scalar value for a flattened key inside obj"""
+        if type(obj) == list:
+            idx, _, rest = key.partition('_')
+            if not idx.isdigit() or int(idx) >= len(obj):
+                return _MISSING
+            obj = obj[int(idx)]
+            if not rest:
+                return _MISSING if type(obj) in (dict, list) else obj
+            return self._resolve(obj, rest) if type(obj) in (dict, list) \
+                else _MISSING
+        # Nested values take precedence over a top level key with the same
+        # flattened name
+        pos = key.find('_', 1)
+        while pos != -1:
+            child = obj.get(key[:pos])
+            if type(child) in (dict, list):
+                value = self._resolve(child, key[pos + 1:])
+                if value is not _MISSING:
+                    return value
+            pos = key.find('_', pos + 1)
+        value = obj.get(key, _MISSING)
+        if type(value) in (dict, list):
+            return _MISSING
+        return value
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is _MISSING:
+            return default
+        return value
+
+class ItemParams(object):
+    """Params for one element of a collection in a __foreach template
+
+    The element's values are available under a name (e.g. item_name for the
+    name of a metric, or just item if the element isn't a dict or list), as
+    is its position (item_index). Anything else comes from the params for
+    the resource the collection is in.
+    """
+    def __init__(self, params, name, item, index):
+        self.params = params
+        self.name = name
+        self.prefix = name + '_'
+        self.item = item
+        self.index = str(index)
+        if type(item) in (dict, list):
+            self.item_params = FlatParams(item)
+        else:
+            self.item_params = None
+
+    def _lookup(self, key):
+        if key == self.name and self.item_params is None:
+            return self.item
+        if key.startswith(self.prefix):
+            if self.item_params is not None:
+                value = self.item_params.get(key[len(self.prefix):], _MISSING)
+                if value is not _MISSING:
+                    return value
+            if key == self.prefix + 'index':
+                return self.index
+        return self.params.get(key, _MISSING)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is _MISSING:
+            return default
+        return value
+
+class _Context(object):
+    """State for a single call to Template.sub"""
+    def __init__(self, params):
+        self.params = params
+        # Expanded variables, keyed by name, and by (filter, name) once a
+        # filter has been applied
+        self.memo = {}
+        # The chain of variables currently being expanded
+        self.expanding = []
 
 class Template(object):
     """Generic template class for json templates"""
     def __init__(self, filename):
         fh = open(filename)
-        self.template = json.load(fh)
+        template = json.load(fh)
         fh.close()
+        self._load(template)
+
+    def __getstate__(self):
+        # Compiled templates can't be pickled, so templates are sent to
+        # other processes (see circuslib.render) as json, and compiled again
+        # at the other end
+        if not self.vars and self.foreach is None:
+            return self.template
+        template = dict(self.template)
+        template['__vars'] = self.vars
+        if self.foreach is not None:
+            template['__foreach'] = self.foreach
+        return template
+
+    def __setstate__(self, template):
+        self._load(template)
+
+    def _load(self, template):
+        self.template = template
         # Allow a special property __vars in all templates which contain
         # variables specified in the template file itself. This is most useful
         # for when you have repetitive items
@@ -27,10 +228,100 @@ class Template(object):
         # Allow '__comment' to be used for file comments
         if '__comment' in self.template:
             del self.template['__comment']
+        # __foreach makes a resource for each element of a collection
+        self.foreach = None
+        if type(self.template) == dict and '__foreach' in self.template:
+            self.foreach = self.template.pop('__foreach')
+            if isinstance(self.foreach, basestring):
+                self.foreach = {'collection': self.foreach}
+        # Compiled strings, keyed by the original string
+        self._strings = {}
+        self._render = self._compile(self.template)
+        # Expansions of variables that don't depend on params
+        self._static_deps = self._find_static_vars()
+        self._static_cache = {}
 
     def sub(self, params):
-        """Substitute parameters in the template"""
-        return self._process(self.template, params)
+        """Substitute parameters in the template
+
+        If the template has a __foreach key, a generator is returned instead,
+        which substitutes the template once for each element of a list in
+        the resource, as they are needed. __foreach is either the name of
+        the list (e.g. "metrics"), or an object with:
+
+            collection - the name of the list
+            filter - a regex to pick elements with. Metrics (and other
+                dicts) are matched on their name field, as in
+                util.find_metrics, and anything else on its value. Elements
+                stay in their original order.
+            as - the name for the element in placeholders (default: item),
+                e.g. {item_name} or {item_index}
+        """
+        if self.foreach is not None:
+            return self._sub_each(params)
+        with metrics.timer('render'):
+            return self._render(_Context(params))
+
+    def _sub_each(self, params):
+        name = self.foreach.get('as', 'item')
+        for index, item in self.items(params):
+            with metrics.timer('render'):
+                yield self._render(_Context(ItemParams(params, name, item,
+                                                       index)))
+
+    def items(self, params):
+        """Yields (index, element) for the elements of the __foreach
+        collection for params, in their original order. The index is the
+        element's position in the whole collection, even with a filter."""
+        # params are usually FlatParams, but can be a plain dict
+        resource = getattr(params, 'resource', params)
+        collection = resource.get(self.foreach['collection']) or []
+        pattern = self.foreach.get('filter')
+        regex = re.compile(pattern) if pattern is not None else None
+        for index, item in enumerate(collection):
+            # Metrics (and other dicts) are matched on their name, the
+            # same way as util.find_metrics
+            if regex is None or regex.search(
+                    item.get('name', '') if type(item) == dict
+                    else unicode(item)):
+                yield index, item
+
+    def variables(self):
+        """Returns the names of all variables/params used in the template"""
+        names = set()
+
+        def visit(i):
+            if type(i) == dict:
+                for k, v in i.iteritems():
+                    visit(k)
+                    visit(v)
+            elif type(i) == list:
+                for v in i:
+                    visit(v)
+            elif type(i) == str or type(i) == unicode:
+                names.update(m.group(2) for m in PLACEHOLDER.finditer(i))
+        visit(self.template)
+        visit(self.vars.values())
+        return names
+
+    def get_metrics(self):
+        """Returns the names of metrics used in the template (the values of
+        any metric_name keys), other than those containing placeholders"""
+        metrics = set()
+
+        def visit(i):
+            if type(i) == dict:
+                for k, v in i.iteritems():
+                    if k == 'metric_name' and isinstance(v, basestring) and \
+                            PLACEHOLDER.search(v) is None:
+                        metrics.add(v)
+                    else:
+                        visit(v)
+            elif type(i) == list:
+                for v in i:
+                    visit(v)
+        visit(self.template)
+        return metrics
 
     def parse_nv_params(self, params):
         """Parses a list of params in the form name=value into a dict
@@ -46,36 +337,148 @@ class Template(object):
             template_params[name] = value
         return template_params
 
-    def _process(self, i, params):
+    def _find_static_vars(self):
+        """Works out which template variables can be expanded without any
+        params
+
+        Returns a dict mapping each such variable to the set of variables
+        its expansion uses (including itself). The expansion can be reused
+        as long as none of these are overridden by params.
+        """
+        deps = {}
+
+        def visit(var, path):
+            if var in deps:
+                return deps[var]
+            if var not in self.vars or var in path:
+                return None
+            refs = set([var])
+            value = self.vars[var]
+            if type(value) == str or type(value) == unicode:
+                for m in PLACEHOLDER.finditer(value):
+                    d = visit(m.group(2), path | set([var]))
+                    if d is None:
+                        deps[var] = None
+                        return None
+                    refs |= d
+            deps[var] = refs
+            return refs
+
+        for var in self.vars:
+            visit(var, set())
+        return dict((k, v) for k, v in deps.items() if v is not None)
+
+    def _compile(self, i):
+        """Compiles part of a template into a function that takes a render
+        context and returns the substituted result"""
+        if self._is_static(i):
+            if type(i) in (dict, list):
+                return lambda ctx: _copy(i)
+            return lambda ctx: i
         if type(i) == dict:
-            return self._process_dict(i, params)
+            return self._compile_dict(i)
         if type(i) == list:
-            return self._process_list(i, params)
+            return self._compile_list(i)
+        return self._compile_str(i)
+
+    def _is_static(self, i):
+        """Returns True if there are no placeholders in part of a template"""
+        if type(i) == dict:
+            return all(self._is_static(k) and self._is_static(v)
+                       for k, v in i.iteritems())
+        if type(i) == list:
+            return all(self._is_static(v) for v in i)
         if type(i) == str or type(i) == unicode:
-            return self._process_str(i, params)
-        return i
+            return PLACEHOLDER.search(i) is None
+        return True
 
-    def _process_dict(self, d, params):
-        new_d = {}
+    def _compile_dict(self, d):
+        static = {}
+        dynamic = []
         for k, v in d.items():
-            new_k = self._process_str(k, params)
-            new_d[new_k] = self._process(v, params)
-        return new_d
+            if self._is_static(k) and self._is_static(v) and \
+                    type(v) not in (dict, list):
+                static[k] = v
+            else:
+                dynamic.append((self._compile_str(k), self._compile(v)))
+
+        def render(ctx):
+            new_d = dict(static)
+            for k, v in dynamic:
+                new_d[k(ctx)] = v(ctx)
+            return new_d
+        return render
 
-    def _process_list(self, l, params):
-        new_l = []
-        for i in l:
-            new_l.append(self._process(i, params))
-        return new_l
+    def _compile_list(self, l):
+        items = [self._compile(i) for i in l]
+        return lambda ctx: [i(ctx) for i in items]
+
+    def _compile_str(self, s):
+        """Compiles a string into a function that expands any placeholders
+        in it. Compiled strings are cached, so this is cheap to call again
+        with the same string."""
+        render = self._strings.get(s)
+        if render is not None:
+            return render
+        pieces = []
+        pos = 0
+        for m in PLACEHOLDER.finditer(s):
+            if m.start() > pos:
+                pieces.append(s[pos:m.start()])
+            pieces.append(m.groups())
+            pos = m.end()
+        if pos < len(s):
+            pieces.append(s[pos:])
+        expand_var = self._expand_var
+
+        if pos == 0:
+            render = lambda ctx: s
+        elif len(pieces) == 1:
+            filter_name, var = pieces[0]
+            render = lambda ctx: expand_var(filter_name, var, ctx)
+        else:
+            def render(ctx):
+                return ''.join(
+                    expand_var(p[0], p[1], ctx) if type(p) == tuple else p
+                    for p in pieces)
+        if len(self._strings) > 10000:
+            # Don't let strings from params build up forever
+            self._strings.clear()
+        self._strings[s] = render
+        return render
 
     def _apply_filter(self, filter_name, s):
         return getattr(self, "%s_filter" % filter_name, str)(s)
 
-    def _expand_var(self, filter_name, var, params):
+    def _expand_var(self, filter_name, var, ctx):
+        """Expands a variable/parameter and applies any filter to it"""
+        key = (filter_name, var)
+        if key in ctx.memo:
+            return ctx.memo[key]
+        expansion = self._apply_filter(filter_name, self._lookup(var, ctx))
+        ctx.memo[key] = expansion
+        return expansion
+
+    def _lookup(self, var, ctx):
         """Recursively expand variables/parameters
 
         Parameters take precedence over template variables
         """
+        if var in ctx.memo:
+            return ctx.memo[var]
+        params = ctx.params
+        deps = None
+        if var not in params:
+            deps = self._static_deps.get(var)
+            if deps is not None and not any(d in params for d in deps):
+                if var in self._static_cache:
+                    return self._static_cache[var]
+            else:
+                deps = None
+        if var in ctx.expanding:
+            raise ValueError("Circular reference in template variables: %s"
+                    % " -> ".join(ctx.expanding[ctx.expanding.index(var):]
+                                  + [var]))
         expansion = None
         if var in params:
             expansion = params[var]
@@ -85,14 +488,21 @@ class Template(object):
             raise ValueError("Unable to expand variable %s. Perhaps it "
                     "needs to be provided on the command line. " % var)
         # Recursively expand variables
-        expansion = self._process_str(expansion, params)
-        # Apply any filters
-        expansion = self._apply_filter(filter_name, expansion)
+        if type(expansion) == str or type(expansion) == unicode:
+            ctx.expanding.append(var)
+            try:
+                expansion = self._process_str(expansion, ctx)
+            finally:
+                ctx.expanding.pop()
+        ctx.memo[var] = expansion
+        if deps is not None:
+            self._static_cache[var] = expansion
         return expansion
 
-    def _process_str(self, s, params):
-        return re.sub("{(?:([a-zA-Z_]+):)?([^ }]+)}",
-                lambda m: self._expand_var(m.group(1), m.group(2), params), s)
+    def _process_str(self, s, ctx):
+        if '{' not in s:
+            return s
+        return self._compile_str(s)(ctx)
 
     def ascii_to_octet_filter(self, s):
         return '.'.join(str(ord(i)) for i in s)
@@ -0,0 +1,307 @@
+"""Keep-alive HTTP transport for the circonus API
+
+circonusapi.CirconusAPI opens a new connection (and does a new TLS
+handshake) for every call. When making thousands of calls in a row, that
+setup can take longer than the calls themselves. The Transport here keeps a
+pool of persistent HTTP/1.1 connections and reuses them, and can compress
+request and response bodies with gzip. Large responses (e.g. endpoint
+listings) can be written straight to a file with download().
+
+A Transport has the same api_call method as CirconusAPI, so it can be
+wrapped by circuslib.client.Client in its place (see client.get_client).
+"""
+import errno
+import gzip
+import httplib
+import json
+import socket
+import threading
+import time
+import zlib
+import StringIO
+
+from circonusapi import circonusapi
+
+import log
+import metrics
+
+DEFAULT_HOSTNAME = "api.circonus.com"
+DEFAULT_APP_NAME = "circus"
+# Request bodies smaller than this aren't worth compressing
+GZIP_MIN_SIZE = 1024
+# How much of a response to read at a time when downloading to a file
+CHUNK_SIZE = 65536
+
+# Methods that are safe to send again if we can't tell whether the API got
+# them the first time
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+# Socket errors we get when the server has closed a keep-alive connection
+# that was sitting idle in the pool
+STALE_SOCKET_ERRORS = (errno.ECONNRESET, errno.EPIPE)
+
+
+def is_stale(e, sent, method):
+    """Returns True if an error on a reused connection means the server had
+    closed it while it was idle, so the request can be sent again on a new
+    one
+
+    sent is True if the whole request was written to the connection. A
+    timeout never counts: the server has the request and is still working
+    on it.
+    """
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, httplib.CannotSendRequest):
+        return True
+    if isinstance(e, httplib.BadStatusLine):
+        # An empty status line means the connection closed without any
+        # response at all (newer versions of httplib say so in words)
+        closed = e.line in ('', "''") or \
+            'server has closed the connection' in str(e.line)
+    elif isinstance(e, socket.error):
+        closed = e.errno in STALE_SOCKET_ERRORS
+    else:
+        closed = False
+    if not closed:
+        return False
+    # If the request didn't get written, the server can't have acted on it.
+    # Otherwise we can't be sure, so only send it again if that's harmless.
+    return not sent or method in IDEMPOTENT_METHODS
+
+
+class TransportError(circonusapi.CirconusAPIError):
+    """An error response from the API"""
+    def __init__(self, code, message):
+        Exception.__init__(self, "%s: %s" % (code, message))
+        self.code = code
+        self.message = message
+
+
+class ConnectionPool(object):
+    """A pool of connections to a single host
+
+    At most `size` connections are open at once; callers wait for one to be
+    returned if they are all in use. Connections are reused most recently
+    used first, so idle ones at the bottom of the pool are the ones that get
+    closed by the server.
+    """
+    def __init__(self, host, port=None, secure=True, size=1, timeout=60,
+                 ssl_context=None):
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.idle = []
+        self.slots = threading.BoundedSemaphore(max(1, size))
+        self.lock = threading.Lock()
+        self.created = 0
+
+    def _connect(self):
+        self.created += 1
+        if self.secure:
+            kwargs = {}
+            if self.ssl_context is not None:
+                kwargs['context'] = self.ssl_context
+            return httplib.HTTPSConnection(self.host, self.port,
+                                           timeout=self.timeout, **kwargs)
+        return httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout)
+
+    def acquire(self):
+        """Returns (connection, reused)"""
+        self.slots.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+            return self._connect(), False
+
+    def release(self, conn, reuse=True):
+        """Returns a connection to the pool, or closes it if reuse is False
+        (e.g. after an error, or if the server asked to close it)"""
+        try:
+            if reuse:
+                with self.lock:
+                    self.idle.append(conn)
+            else:
+                conn.close()
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+
+class Transport(object):
+    """Makes API calls over a pool of keep-alive connections
+
+    Parameters:
+
+        token - the API token
+        hostname - the API host
+        app_name - the app name to send with the token
+        pool_size - the maximum number of connections. Set this to the
+            number of calls made in parallel (e.g. the -j option).
+        keepalive - if False, connections are closed after each call (this
+            is mostly useful for comparing against)
+        gzip - if True, compress request bodies (over GZIP_MIN_SIZE bytes)
+        secure - use https
+        port - the port to connect to (default: 443 or 80)
+        base_path - the path the API lives under
+        timeout - socket timeout in seconds
+        ssl_context - an ssl.SSLContext for https connections
+    """
+    def __init__(self, token, hostname=DEFAULT_HOSTNAME,
+                 app_name=DEFAULT_APP_NAME, pool_size=1, keepalive=True,
+                 gzip=False, secure=True, port=None, base_path="/v2",
+                 timeout=60, ssl_context=None):
+        self.token = token
+        self.hostname = hostname
+        self.app_name = app_name
+        self.keepalive = keepalive
+        self.gzip = gzip
+        self.base_path = base_path.rstrip('/')
+        self.debug = False
+        self.pool = ConnectionPool(hostname, port, secure, pool_size, timeout,
+                                   ssl_context)
+
+    def headers(self):
+        headers = {
+            'X-Circonus-Auth-Token': self.token,
+            'X-Circonus-App-Name': self.app_name,
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip'
+        }
+        if not self.keepalive:
+            headers['Connection'] = 'close'
+        return headers
+
+    def encode(self, data, headers):
+        """Returns the request body for data, setting any headers needed"""
+        if data is None:
+            return None
+        body = json.dumps(data)
+        headers['Content-Type'] = 'application/json'
+        if self.gzip and len(body) >= GZIP_MIN_SIZE:
+            body = compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        return body
+
+    def api_call(self, method, endpoint, data=None):
+        method = method.upper()
+        path = "%s/%s" % (self.base_path, endpoint.lstrip('/'))
+        headers = self.headers()
+        body = self.encode(data, headers)
+        if self.debug:
+            log.debug("%s %s %s" % (method, path, data))
+        status, reason, response_body = self.request(method, path, body,
+                                                     headers)
+        return self.decode(status, reason, response_body)
+
+    def download(self, endpoint, fh):
+        """Makes a GET request, writing the response body to fh as it
+        arrives instead of decoding it, so a large listing is never held in
+        memory. Raises TransportError for an error response."""
+        path = "%s/%s" % (self.base_path, endpoint.lstrip('/'))
+        if self.debug:
+            log.debug("GET %s (download)" % path)
+        status, reason, body = self.request("GET", path, None,
+                                            self.headers(), fh)
+        if status >= 300:
+            self.decode(status, reason, body)
+
+    def request(self, method, path, body, headers, output=None):
+        """Makes a single request, returning (status, reason, body)
+
+        If output (a file) is given, a successful response body is written
+        to it (decompressed) a chunk at a time, and the body returned is
+        empty.
+        """
+        while True:
+            conn, reused = self.pool.acquire()
+            start = time.time()
+            sent = False
+            try:
+                conn.request(method, path, body, headers)
+                sent = True
+                response = conn.getresponse()
+                if output is not None and response.status < 300:
+                    bytes_in = self.copy(response, output)
+                    response_body = ''
+                else:
+                    response_body = response.read()
+                    bytes_in = len(response_body)
+            except (httplib.HTTPException, socket.error), e:
+                self.pool.release(conn, reuse=False)
+                if reused and is_stale(e, sent, method):
+                    # The server closed the connection while it was idle,
+                    # so the request never got to it. Try a new one.
+                    log.debug("Reconnecting after %s" % e)
+                    continue
+                raise
+            except:
+                self.pool.release(conn, reuse=False)
+                raise
+            self.pool.release(conn, reuse=self.keepalive and
+                              not response.will_close)
+            metrics.record('http', time.time() - start, method=method,
+                           status=response.status, reused=reused,
+                           bytes_out=len(body or ''), bytes_in=bytes_in)
+            if response.getheader('Content-Encoding') == 'gzip' and \
+                    response_body:
+                response_body = decompress(response_body)
+            return response.status, response.reason, response_body
+
+    def copy(self, response, output):
+        """Writes a response body to output, returning the number of bytes
+        read"""
+        # Start again from scratch if this is a retry
+        output.seek(0)
+        output.truncate()
+        decompressor = None
+        if response.getheader('Content-Encoding') == 'gzip':
+            # 16 + MAX_WBITS tells zlib to expect a gzip header
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        total = 0
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            total += len(chunk)
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+            output.write(chunk)
+        if decompressor is not None:
+            output.write(decompressor.flush())
+        return total
+
+    def decode(self, status, reason, body):
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+        if status >= 300:
+            message = reason
+            if isinstance(data, dict):
+                message = data.get('message') or data.get('error') or reason
+            raise TransportError(status, message)
+        if data is None and body:
+            raise TransportError(status, "Invalid json response")
+        return data
+
+    def close(self):
+        self.pool.close()
+
+
+def compress(s):
+    buf = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fh:
+        fh.write(s)
+    return buf.getvalue()
+
+
+def decompress(s):
+    return gzip.GzipFile(fileobj=StringIO.StringIO(s)).read()
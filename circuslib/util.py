@@ -9,8 +9,16 @@ import log
 import sys
 import re
 from circonusapi import config
+from matcher import Matcher
+from store import ResourceStore
+
+# Set this to True to answer yes to every confirmation (e.g. for --yes)
+assume_yes = False
 
 def confirm(text="OK to continue?"):
+    if assume_yes:
+        log.msg("%s yes" % text)
+        return True
     response = None
     while response not in ['Y', 'y', 'N', 'n']:
         response = raw_input("%s (y/n) " % text)
@@ -20,9 +28,10 @@ def confirm(text="OK to continue?"):
 
 def get_broker(api, broker_name):
     """Find a broker endpoint given its name"""
-    rv = api.list_broker()
-    brokers = dict([(i['name'], i['_cid']) for i in rv])
-    return brokers[broker_name]
+    brokers = ResourceStore.for_api(api).find('broker', 'name', broker_name)
+    if not brokers:
+        raise KeyError(broker_name)
+    return brokers[0]['_cid']
 
 def get_broker_pretty(api, broker_name):
     """Find a broker endpoint given its name and exit with an error if it's
@@ -43,19 +52,13 @@ def find_check_bundle(api, pattern):
     all_bundles = api.list_check_bundle()
     filtered_bundles = []
     groups = {}
-    for b in sorted(all_bundles):
-        m = re.search(pattern, b['display_name'])
-        if m:
-            filtered_bundles.append(b)
-            # Store numbered groups
-            matchgroups = m.groups()
-            groups[b['_cid']] = {}
-            for i in range(0, len(matchgroups)):
-                groups[b['_cid']]["group%s" % (i + 1)] = matchgroups[i]
-            # Store named groups - (?P<name>...)
-            groups[b['_cid']].update(m.groupdict())
+    # Numbered groups are stored as group1, group2 etc., along with any named
+    # groups - (?P<name>...)
+    for b, g in Matcher([('display_name', pattern)]).filter(all_bundles):
+        filtered_bundles.append(b)
+        groups[b['_cid']] = g
     return {
-        'bundles': filtered_bundles,
+        'bundles': sorted(filtered_bundles),
         'groups': groups
     }
 
@@ -77,47 +80,62 @@ def find_metrics(check_bundle, pattern):
     all_metrics = check_bundle['metrics']
     matching_metrics = []
     non_matching_metrics = []
-    for i in sorted(all_metrics):
-        m = re.search(pattern, i['name'])
-        if m:
+    regex = re.compile(pattern)
+    for i in all_metrics:
+        if regex.search(i['name']):
             matching_metrics.append(i)
         else:
             non_matching_metrics.append(i)
     return {
-        'matching': matching_metrics,
-        'non_matching': non_matching_metrics
+        'matching': sorted(matching_metrics),
+        'non_matching': sorted(non_matching_metrics)
     }
 
-def verify_metrics_pretty(template, check_bundles):
-    log.msg("Verifying that bundles have the correct metrics")
-    template_metrics = template.get_metrics()
-    bundles_with_correct_metrics = []
-    bundles_with_wrong_metrics = []
-    count = 0
+def verify_metrics(metric_names, check_bundles):
+    """Checks check bundles against a list of metrics they should have
+
+    Returns a report with an entry for each bundle, in the same order as
+    check_bundles. Each entry is a dict containing:
+
+        bundle - the check bundle
+        missing - set of metric names the bundle doesn't have
+        extra - set of metric names the bundle has that weren't asked for
+    """
+    wanted = set(metric_names)
+    report = []
     for b in check_bundles:
-        count += 1
-        print "\r%s/%s" % (count, len(check_bundles)),
-        sys.stdout.flush()
-        metrics = b['metrics']
-        metric_names = [m['name'] for m in metrics]
-        for m in template_metrics:
-            if m not in metric_names:
-                bundles_with_wrong_metrics.append({
-                    'name': b['display_name'],
-                    'metric': m})
-            else:
-                bundles_with_correct_metrics.append(b)
+        names = set(m['name'] for m in b['metrics'])
+        report.append({
+            'bundle': b,
+            'missing': wanted - names,
+            'extra': names - wanted})
+    return report
+
+def verify_metrics_pretty(template, check_bundles, interactive=True):
+    """Checks that check bundles have the metrics a template uses
+
+    Returns the bundles that have all of the metrics. If some bundles are
+    missing metrics, they are listed, and (if interactive) you are asked
+    whether to continue without them.
+    """
+    log.msg("Verifying that bundles have the correct metrics")
+    report = verify_metrics(template.get_metrics(), check_bundles)
+    bundles_with_correct_metrics = [r['bundle'] for r in report
+                                    if not r['missing']]
+    bundles_with_wrong_metrics = [r for r in report if r['missing']]
     if bundles_with_wrong_metrics:
         log.msg("The following check bundles do not have metrics specified in"
                 " the template:")
-        for c in bundles_with_wrong_metrics:
-            log.msg("%(name)s - %(metric)s" % c)
-        if confirm("Do you want to continue with just the check bundles that"
+        for r in bundles_with_wrong_metrics:
+            log.msg("%s - %s" % (r['bundle']['display_name'],
+                                 ', '.join(sorted(r['missing']))))
+        if not interactive:
+            log.msg("Continuing with only matching check bundles")
+        elif confirm("Do you want to continue with just the check bundles that"
                 " match the template?"):
             log.msg("Continuing with only matching check bundles")
         else:
             log.error("Not continuing. The template does not match the"
                     " bundles")
             sys.exit(1)
-        return bundles_with_correct_metrics
-
+    return bundles_with_correct_metrics
@@ -9,111 +9,159 @@ and confirm that you want the tags to be applied.
 
 For tagging items other than check bundles, specify the appropriate endpoint
 with the -e option (e.g. ./tag.py -e graph).
+
+Tags can also be removed (-m remove), or replaced (-m replace). Replacing a
+tag removes any existing tags in the same category before adding the new
+one, e.g. ./tag.py -m replace 'web' dc:newdc moves all matching resources
+from whatever dc they were tagged with to newdc.
+
+Resources that already have the right tags are skipped without making any
+API calls.
+
+To review changes before making them, use --plan FILE to write them to a
+plan file, and then --apply FILE to make exactly those changes.
 """
-import getopt
 import re
 import sys
+import time
 
 from circonusapi import circonusapi
-from circonusapi import config
-from circuslib import util
 from circuslib import log
+from circuslib import matcher
+from circuslib import options as shared_options
+from circuslib import plan
+from circuslib import util
 
-conf = config.load_config()
+options = None
 
-options = {
-    'account': conf.get('general', 'default_account'),
-    'debug': False,
-    'endpoint': 'check_bundle'
-}
+def get_options():
+    opts = shared_options.defaults()
+    opts.update({
+        'endpoint': 'check_bundle',
+        'mode': 'add',
+        'excludes': []
+    })
+    return opts
 
 
-def usage():
+def usage(opts):
     print "Usage:"
     print sys.argv[0], "[options] PATTERN TAG [TAG...]"
+    print sys.argv[0], "[options] --apply PLAN_FILENAME"
     print
     print "Lets you bulk tag resources based on a regex"
     print
-    print "  -a -- Specify which account to use"
-    print "  -d -- Enable debug mode"
-    print "  -e -- Specify the endpoint (check, rule_set) to search/tag"
+    print "  -e -- the endpoint (check, rule_set) to search/tag"
+    print "  -x -- skip resources matching this pattern (can be repeated)"
+    print "  -m -- whether to add, remove or replace tags (default: %s)" % (
+        opts['mode'])
+    shared_options.usage(opts)
 
 
-def parse_options():
-    try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], "a:d?e:")
-    except getopt.GetoptError, err:
-        # print help information and exit:
-        print str(err)  # will print something like "option -a not recognized"
-        usage()
-        sys.exit(2)
+def parse_options(argv):
+    opts = get_options()
 
-    for o, a in opts:
-        if o == '-a':
-            options['account'] = a
-        if o == '-d':
-            options['debug'] = not options['debug']
+    def handler(o, a):
         if o == '-e':
-            options['endpoint'] = a
-        if o == '-?':
-            usage()
-            sys.exit(0)
-    return args
-
-
-def get_api():
-    token = conf.get('tokens', options['account'], None)
-    api = circonusapi.CirconusAPI(token)
-    if options['debug']:
-        api.debug = True
-    return api
+            opts['endpoint'] = a
+        if o == '-m':
+            if a not in ('add', 'remove', 'replace'):
+                print "Mode must be one of add, remove or replace"
+                usage(opts)
+                sys.exit(2)
+            opts['mode'] = a
+        if o == '-x':
+            opts['excludes'].append(a)
+    args = shared_options.parse(argv, opts, usage, "e:m:x:", (), handler)
+    return opts, args
 
 
 def get_matching_resources(api, search_field, pattern):
+    """Returns the resources to tag, or None if they couldn't be listed
+
+    The listing is always fetched from the API rather than the cache, as
+    the tags (and any other fields that have to be sent) must be up to
+    date when they are changed.
+    """
     log.msg("Finding matching resources")
+    m = matcher.Matcher([(search_field, pattern)],
+                        [(search_field, p) for p in options['excludes']],
+                        re.I)
     try:
-        resources = api.api_call('GET', options['endpoint'])
+        api.refresh(options['endpoint'])
+        # Resources are filtered as they are parsed, so only the matching
+        # ones are kept in memory
+        return [r for r, groups in m.filter(
+            api.iter_list(options['endpoint']))]
     except circonusapi.CirconusAPIError, e:
-        print "ERROR: %s" % e
+        log.error(e)
         return None
-    matching = []
-    for r in resources:
-        if re.search(pattern, r[search_field], re.I):
-            matching.append(r)
-    return matching
 
 
-def tag_resources(api, resources, tags, search_field):
-    log.msg("Tagging resources:")
+def new_tags(old_tags, tags, mode):
+    """Works out which tags a resource should end up with"""
+    if mode == 'remove':
+        return old_tags - set(tags)
+    if mode == 'replace':
+        categories = set(t.split(':', 1)[0] for t in tags)
+        old_tags = set(t for t in old_tags
+                       if t.split(':', 1)[0] not in categories)
+    return old_tags | set(tags)
+
+
+def tag_changes(resources, tags, search_field):
+    """Works out the changes needed to tag resources (see circuslib.plan).
+    Returns (changes, list of resources that already have the right tags)"""
+    changes = []
+    unchanged = []
     for r in resources:
         old_tags = set(r['tags'])
-        new_tags = old_tags | set(tags)
-        data = {'tags': list(new_tags)}
-        # Exceptions for differnet endpoint types
-        if options['endpoint'] == 'graph':
-            # You have to provide title/datapoints with any graph changes
-            data['title'] = r['title']
-            data['datapoints'] = r['datapoints']
-        log.debug("Data for %s: %s" % (r['_cid'], data))
-        log.msgnb("%s: %s... " % (r['_cid'], r[search_field]))
-        if old_tags == new_tags:
-            log.msgnf("No change")
+        tags_after = new_tags(old_tags, tags, options['mode'])
+        if old_tags == tags_after:
+            unchanged.append(r)
+            log.debug("No change for %s" % r['_cid'])
             continue
-        try:
-            api.api_call("PUT", r['_cid'], data)
-            log.msgnf("Done")
-        except circonusapi.CirconusAPIError, e:
-            log.msgnf("Failed")
-            log.error(e)
+        data = plan.update_data(r, {'tags': sorted(tags_after)})
+        log.debug("Data for %s: %s" % (r['_cid'], data))
+        changes.append(plan.make_change("PUT", r['_cid'], data, "%s: %s" % (
+            r['_cid'], r[search_field])))
+    log.msg("%s resources already have the right tags, %s to change" % (
+        len(unchanged), len(changes)))
+    return changes, unchanged
 
-if __name__ == '__main__':
-    args = parse_options()
-    if options['debug']:
-        log.debug_enabled = True
+
+def tag_resources(api, resources, tags, search_field):
+    log.msg("Tagging resources:")
+    start = time.time()
+    changes, unchanged = tag_changes(resources, tags, search_field)
+    for r in unchanged:
+        log.result({
+            'action': 'PUT',
+            'endpoint': r['_cid'],
+            'description': "%s: %s" % (r['_cid'], r[search_field]),
+            'status': 'unchanged'})
+
+    succeeded, failed = plan.make_changes(api, changes,
+                                          options['concurrency'],
+                                          total=len(changes))
+    elapsed = time.time() - start
+    log.msg("%s changed, %s unchanged, %s failed in %.1fs (%.1f changes/s)" % (
+        succeeded, len(unchanged), failed, elapsed,
+        len(changes) / elapsed if elapsed else 0))
+
+def main(argv=None):
+    global options
+    if argv is None:
+        argv = sys.argv[1:]
+    options, args = parse_options(argv)
+    if options['apply']:
+        plan.apply_pretty(shared_options.get_api(options), options['apply'],
+                          options['rate'], options['concurrency'])
+        sys.exit(0)
     if len(args) < 2:
-        usage()
+        usage(options)
         sys.exit(2)
-    api = get_api()
+    api = shared_options.get_api(options)
     pattern = args[0]
     tags = args[1:]
 
@@ -131,11 +179,26 @@ if __name__ == '__main__':
     # Default to 'title' as a guess for unknown resource types
     search_field = search_fields.get(options['endpoint'], 'title')
     resources = get_matching_resources(api, search_field, pattern)
+    if resources is None:
+        sys.exit(1)
     log.msg("Matching resources:")
     for r in resources:
         print "    %5s: %s" % (r['_cid'], r[search_field])
-    if util.confirm("Do you want to tag these resources with: %s?" % (
-            ', '.join(tags))):
+    if options['plan']:
+        changes, unchanged = tag_changes(resources, tags, search_field)
+        plan.plan_pretty(options['plan'], changes, options['rate'],
+                         options['concurrency'])
+        sys.exit(0)
+    actions = {
+        'add': 'tag these resources with',
+        'remove': 'remove these tags from these resources',
+        'replace': 'replace tags on these resources with'
+    }
+    if util.confirm("Do you want to %s: %s?" % (actions[options['mode']],
+                                                ', '.join(tags))):
         tag_resources(api, resources, tags, search_field)
     else:
         log.msg("Not applying tags")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Tests for add_switch_checks port discovery, using a fake snmpwalk on PATH
+
+Run with: python -m unittest discover tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import add_switch_checks
+from circuslib import snmp, util
+
+# Prints a couple of ports for any switch, except one called "down", for
+# which it fails the way snmpwalk does when a switch doesn't answer
+FAKE_SNMPWALK = """#!/bin/sh
+echo "$@" >> "$(dirname "$0")/calls"
+case "$5" in
+down:*)
+    echo "Timeout: No Response from $5" >&2
+    exit 1
+    ;;
+esac
+echo '.1.3.6.1.2.1.31.1.1.1.1.1 = STRING: "ethernet1/1"'
+echo '.1.3.6.1.2.1.31.1.1.1.1.2 = STRING: "ethernet1/2"'
+echo '.1.3.6.1.2.1.31.1.1.1.1.3 = STRING: "ethernet2/1"'
+echo '.1.3.6.1.2.1.31.1.1.1.1.4 = STRING: "Vlan1"'
+"""
+
+
+class FakeSnmpwalkTest(unittest.TestCase):
+    def setUp(self):
+        self.bin = tempfile.mkdtemp()
+        path = os.path.join(self.bin, 'snmpwalk')
+        with open(path, 'w') as fh:
+            fh.write(FAKE_SNMPWALK)
+        os.chmod(path, 0755)
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = self.bin + os.pathsep + self.old_path
+        self.old_get_api = add_switch_checks.shared_options.get_api
+        self.old_confirm = util.confirm
+        self.confirmed = []
+
+    def tearDown(self):
+        os.environ['PATH'] = self.old_path
+        add_switch_checks.shared_options.get_api = self.old_get_api
+        util.confirm = self.old_confirm
+        shutil.rmtree(self.bin)
+
+    def target(self, target, pattern=None):
+        params = add_switch_checks.get_params()
+        params.update({'target': target, 'friendly_name': target,
+                       'pattern': pattern, 'walker': 'snmpwalk'})
+        return params
+
+    def calls(self):
+        with open(os.path.join(self.bin, 'calls')) as fh:
+            return fh.read().splitlines()
+
+    def test_get_ports(self):
+        ports = add_switch_checks.get_ports(self.target('sw1', '1/'))
+        self.assertEqual(ports, {'1/1': '1', '1/2': '2'})
+        self.assertEqual(self.calls(), [
+            '-On -v2c -c public sw1:161 .1.3.6.1.2.1.31.1.1.1.1'])
+
+    def test_failed_switch_is_reported(self):
+        self.assertRaises(snmp.SNMPError, add_switch_checks.get_ports,
+                          self.target('down'))
+        found = add_switch_checks.discover_ports(
+            [self.target('sw1'), self.target('down'), self.target('sw2')],
+            concurrency=2)
+        self.assertEqual([t['target'] for t in found], ['sw1', 'sw2'])
+        self.assertEqual(found[0]['ports'],
+                         {'1/1': '1', '1/2': '2', '2/1': '3'})
+
+    def test_main_exits_when_discovery_fails(self):
+        add_switch_checks.shared_options.get_api = lambda params: None
+        util.confirm = lambda *args: self.confirmed.append(args)
+        try:
+            add_switch_checks.main(['--walker=snmpwalk', 'down', 'down'])
+        except SystemExit, e:
+            self.assertEqual(e.code, 1)
+        else:
+            self.fail("main didn't exit")
+        self.assertEqual(self.confirmed, [])
+
+
+class ReconcileTest(unittest.TestCase):
+    def test_update_only_sends_changes(self):
+        target = add_switch_checks.get_params()
+        target.update({'target': 'sw1', 'friendly_name': 'sw1',
+                       'ports': {'1/1': '1', '1/2': '2'}})
+        current = add_switch_checks.make_check_bundle(target, '1/1', '1')
+        current.update({'_cid': '/check_bundle/10', 'tags': ['dc:east'],
+                        'notes': 'edited by hand'})
+        current['config']['oid_speed'] = '.1.2.3'
+        changes, missing = add_switch_checks.reconcile(
+            [target], {('sw1', '1'): current}, update=True)
+        self.assertEqual(missing, [])
+        self.assertEqual([(c['action'], c['endpoint']) for c in changes],
+                         [('PUT', '/check_bundle/10'),
+                          ('POST', '/check_bundle')])
+        self.assertEqual(sorted(changes[0]['data']), ['config'])
+        self.assertEqual(changes[0]['data']['config']['oid_speed'],
+                         "%s.1" % add_switch_checks.oids['speed'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+"""Tests for circuslib.eventclient against a local http server
+
+Run with: python -m unittest discover tests
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from circuslib import client, eventclient, store, transport
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = json.dumps(self.server.listing)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.path:
+            body = transport.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        if 'chunked' in self.path:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(body), 1000):
+                chunk = body[i:i + 1000]
+                self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write("0\r\n\r\n")
+            return
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.bodies.append(body)
+        data = json.loads(body)
+        if data.get('slow'):
+            time.sleep(self.server.slow_delay)
+        status = 200
+        if self.server.failures:
+            self.server.failures -= 1
+            status = 503
+            data = {'message': 'Try again later'}
+        response = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(response))
+        self.end_headers()
+        self.wfile.write(response)
+        if data.get('close'):
+            # Close the connection after answering without saying so, as a
+            # server does when it times out an idle keep-alive connection
+            self.close_connection = 1
+
+    do_PUT = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    slow_delay = 1.5
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.bodies = []
+        # How many of the next POST/PUT requests to answer with a 503
+        self.failures = 0
+        self.listing = [{'_cid': '/graph/%s' % i, 'title': 'graph %s' % i}
+                        for i in range(1000)]
+
+    def handle_error(self, request, address):
+        pass
+
+
+class RecordingTransport(eventclient.EventTransport):
+    """Records which thread each call is submitted from"""
+    def __init__(self, *args, **kwargs):
+        eventclient.EventTransport.__init__(self, *args, **kwargs)
+        self.threads = []
+
+    def submit(self, method, endpoint, data=None):
+        self.threads.append(threading.current_thread())
+        return eventclient.EventTransport.submit(self, method, endpoint,
+                                                 data)
+
+
+class EventTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.api = RecordingTransport(
+            'token', '127.0.0.1', port=self.server.server_address[1],
+            secure=False, timeout=1, max_in_flight=4)
+
+    def tearDown(self):
+        self.api.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_responses(self):
+        for path in ('/graph', '/graph?gzip', '/graph?chunked',
+                     '/graph?chunked&gzip'):
+            self.assertEqual(self.api.api_call('GET', path),
+                             self.server.listing, path)
+        # All over the same connection
+        self.assertEqual(self.api.created, 1)
+
+    def test_download(self):
+        fh = StringIO.StringIO()
+        self.api.download('/graph?chunked&gzip', fh)
+        self.assertEqual(json.loads(fh.getvalue()), self.server.listing)
+        self.api.close()
+        self.assertEqual(self.api.pool.idle, [])
+
+    def test_many_in_flight(self):
+        futures = [self.api.submit('POST', '/graph', {'n': i})
+                   for i in range(20)]
+        self.assertEqual([f.result() for f in futures],
+                         [{'n': i} for i in range(20)])
+        self.assertTrue(self.api.created <= 4)
+
+    def test_timeout(self):
+        self.api.api_call('POST', '/graph', {'n': 1})
+        self.assertRaises(socket.timeout, self.api.api_call, 'POST',
+                          '/graph', {'slow': True, 'n': 2})
+        # Give the server time to finish (and to show any second copy)
+        time.sleep(self.server.slow_delay + 0.5)
+        slow = [b for b in self.server.bodies if json.loads(b).get('slow')]
+        self.assertEqual(len(slow), 1)
+
+    def test_stale_connection_is_retried_for_idempotent_calls(self):
+        self.api.api_call('PUT', '/graph/1', {'n': 1, 'close': True})
+        time.sleep(0.2)
+        self.assertEqual(self.api.api_call('PUT', '/graph/1', {'n': 2}),
+                         {'n': 2})
+        self.assertEqual(self.api.created, 2)
+        self.assertEqual(len(self.server.bodies), 2)
+
+    def test_stale_connection_is_not_retried_for_post(self):
+        self.api.api_call('POST', '/graph', {'n': 1, 'close': True})
+        time.sleep(0.2)
+        self.assertRaises(socket.error, self.api.api_call, 'POST', '/graph',
+                          {'n': 2})
+
+    def test_submit_retries_on_the_loop_thread(self):
+        self.server.failures = 2
+        c = client.Client(self.api, concurrency=4, retries=3, backoff=0.05)
+        future = c.submit('PUT', '/graph/1', {'n': 1})
+        self.assertEqual(future.result(), {'n': 1})
+        self.assertEqual(len(self.server.bodies), 3)
+        self.assertEqual(len(self.api.threads), 3)
+        self.assertEqual(self.api.threads[0], threading.current_thread())
+        for t in self.api.threads[1:]:
+            self.assertTrue(t is self.api.loop.thread)
+        # The concurrency slot was given back once the call was done
+        self.assertEqual(c.limit.in_flight, 0)
+
+    def test_submit_gives_up(self):
+        self.server.failures = 5
+        c = client.Client(self.api, concurrency=4, retries=2, backoff=0.05)
+        future = c.submit('PUT', '/graph/1', {'n': 1})
+        self.assertRaises(transport.TransportError, future.result)
+        self.assertEqual(len(self.server.bodies), 3)
+
+
+class StoreLockTest(unittest.TestCase):
+    def test_load_doesnt_block_the_loop(self):
+        loop = eventclient.EventLoop()
+        test = self
+
+        class Api(object):
+            def iter_list(self, endpoint):
+                # Wait for the loop like an evented call does, while the
+                # loop invalidates the endpoint, as Client.submit does when
+                # a write finishes
+                done = threading.Event()
+
+                def on_loop():
+                    store.invalidate(self, 'graph')
+                    done.set()
+                loop.call_soon(on_loop)
+                test.assertTrue(done.wait(5), "The event loop is blocked")
+                return iter([{'_cid': '/graph/1'}])
+
+        api = Api()
+        s = store.ResourceStore.for_api(api)
+        self.assertEqual(s.load('graph'), [{'_cid': '/graph/1'}])
+        self.assertEqual(s.get('/graph/1'), {'_cid': '/graph/1'})
+        # It was invalidated while loading, so isn't kept
+        self.assertFalse('graph' in s.endpoints)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+"""Tests for circuslib.snmp against a local udp SNMP responder
+
+Run with: python -m unittest discover tests
+"""
+import os
+import socket
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from circuslib import snmp
+
+IF_NAME = '.1.3.6.1.2.1.31.1.1.1.1'
+
+
+def encode_response(request_id, varbinds, error_status=0,
+                    community='public'):
+    """Builds a GetResponse packet from (oid, tag, raw value) tuples"""
+    encoded = ''
+    for oid, tag, value in varbinds:
+        encoded += snmp._encode(snmp.SEQUENCE, snmp._encode_oid(oid) +
+                                snmp._encode(tag, value))
+    pdu = snmp._encode(snmp.GET_RESPONSE,
+                       snmp._encode_int(request_id) +
+                       snmp._encode_int(error_status) +
+                       snmp._encode_int(0) +
+                       snmp._encode(snmp.SEQUENCE, encoded))
+    return snmp._encode(snmp.SEQUENCE,
+                        snmp._encode_int(snmp.SNMP_VERSION_2C) +
+                        snmp._encode(snmp.OCTET_STRING, community) + pdu)
+
+
+def decode_request(data):
+    """Returns (request_id, max_repetitions, oid) for a GetBulkRequest"""
+    tag, message, pos = snmp._decode(data)
+    version, community, (pdu_tag, pdu) = snmp._decode_sequence(message)
+    assert pdu_tag == snmp.GET_BULK_REQUEST
+    request_id, non_repeaters, max_repetitions, varbinds = \
+        snmp._decode_sequence(pdu)
+    (vb_tag, vb), = snmp._decode_sequence(varbinds[1])
+    (oid_tag, oid), null = snmp._decode_sequence(vb)
+    return (snmp._decode_int(request_id[1]),
+            snmp._decode_int(max_repetitions[1]), snmp._decode_oid(oid))
+
+
+class Responder(threading.Thread):
+    """Answers GETBULK requests from a table of oid => value
+
+    mode can be 'answer', 'drop' (never reply) or 'garbage' (reply with a
+    truncated packet).
+    """
+    def __init__(self, table, mode='answer'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.table = sorted(table.items(), key=lambda i: snmp._oid_key(i[0]))
+        self.mode = mode
+        self.requests = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(65535)
+            except socket.error:
+                return
+            request_id, max_repetitions, oid = decode_request(data)
+            self.requests.append(oid)
+            if self.mode == 'drop':
+                continue
+            response = self.respond(request_id, max_repetitions, oid)
+            if self.mode == 'garbage':
+                response = response[:len(response) - 3]
+            self.sock.sendto(response, address)
+
+    def respond(self, request_id, max_repetitions, oid):
+        key = snmp._oid_key(oid)
+        after = [(o, v) for o, v in self.table if snmp._oid_key(o) > key]
+        varbinds = [(o, snmp.OCTET_STRING, v)
+                    for o, v in after[:max_repetitions]]
+        if len(varbinds) < max_repetitions:
+            varbinds.append((oid, snmp.END_OF_MIB_VIEW, ''))
+        return encode_response(request_id, varbinds)
+
+    def stop(self):
+        self.sock.close()
+
+
+class CodecTest(unittest.TestCase):
+    def test_get_bulk_request(self):
+        packet = snmp.encode_get_bulk(1234, 'public', IF_NAME, 50)
+        self.assertEqual(decode_request(packet), (1234, 50, IF_NAME))
+
+    def test_response_round_trip(self):
+        packet = encode_response(0x7fffffff, [
+            (IF_NAME + '.1', snmp.OCTET_STRING, 'ethernet1/1'),
+            (IF_NAME + '.2', snmp.COUNTER64,
+             snmp._encode_int(2 ** 40)[2:]),
+            (IF_NAME + '.300', snmp.INTEGER, snmp._encode_int(-2)[2:]),
+            ('.1.3.6.1.2.1.4.20.1.1.10.0.0.1', snmp.IP_ADDRESS,
+             '\x0a\x00\x00\x01'),
+            (IF_NAME + '.4', snmp.END_OF_MIB_VIEW, '')])
+        self.assertEqual(snmp.decode_response(packet), (0x7fffffff, 0, [
+            (IF_NAME + '.1', snmp.OCTET_STRING, 'ethernet1/1'),
+            (IF_NAME + '.2', snmp.COUNTER64, 2 ** 40),
+            (IF_NAME + '.300', snmp.INTEGER, -2),
+            ('.1.3.6.1.2.1.4.20.1.1.10.0.0.1', snmp.IP_ADDRESS, '10.0.0.1'),
+            (IF_NAME + '.4', snmp.END_OF_MIB_VIEW, None)]))
+
+    def test_malformed_responses(self):
+        packet = encode_response(1, [(IF_NAME + '.1', snmp.OCTET_STRING,
+                                      'ethernet1/1')])
+        # A varbind with only an oid and no value
+        vb = snmp._encode(snmp.SEQUENCE, snmp._encode_oid(IF_NAME))
+        pdu = snmp._encode(snmp.GET_RESPONSE, snmp._encode_int(1) +
+                           snmp._encode_int(0) + snmp._encode_int(0) +
+                           snmp._encode(snmp.SEQUENCE, vb))
+        short_varbind = snmp._encode(
+            snmp.SEQUENCE, snmp._encode_int(snmp.SNMP_VERSION_2C) +
+            snmp._encode(snmp.OCTET_STRING, 'public') + pdu)
+        for data in ('', '\x30', packet[:-3], packet[:20], short_varbind):
+            self.assertRaises(snmp.SNMPError, snmp.decode_response, data)
+
+
+class WalkTest(unittest.TestCase):
+    def setUp(self):
+        self.responder = None
+
+    def tearDown(self):
+        if self.responder is not None:
+            self.responder.stop()
+
+    def start(self, table, mode='answer'):
+        self.responder = Responder(table, mode)
+        self.responder.start()
+        return self.responder.port
+
+    def test_walk_over_several_requests(self):
+        table = dict(("%s.%s" % (IF_NAME, i), "ethernet1/%s" % i)
+                     for i in range(1, 8))
+        # Something after the subtree, which shouldn't be returned
+        table['.1.3.6.1.2.1.31.1.1.1.2.1'] = 'not a port name'
+        port = self.start(table)
+        results = snmp.walk('127.0.0.1', 'public', IF_NAME, port=port,
+                            timeout=5, max_repetitions=3)
+        self.assertEqual(results, [("%s.%s" % (IF_NAME, i),
+                                    "ethernet1/%s" % i)
+                                   for i in range(1, 8)])
+        self.assertEqual(self.responder.requests, [
+            IF_NAME, IF_NAME + '.3', IF_NAME + '.6'])
+
+    def test_walk_ends_at_end_of_mib_view(self):
+        port = self.start({IF_NAME + '.1': 'ethernet1/1'})
+        results = snmp.walk('127.0.0.1', 'public', IF_NAME, port=port,
+                            timeout=5, max_repetitions=10)
+        self.assertEqual(results, [(IF_NAME + '.1', 'ethernet1/1')])
+
+    def test_timeout(self):
+        port = self.start({}, mode='drop')
+        self.assertRaises(snmp.SNMPError, snmp.walk, '127.0.0.1', 'public',
+                          IF_NAME, port=port, timeout=0.5,
+                          retry_interval=0.1)
+        # The request was resent while waiting
+        self.assertTrue(len(self.responder.requests) > 1)
+
+    def test_malformed_response(self):
+        port = self.start({IF_NAME + '.1': 'ethernet1/1'}, mode='garbage')
+        self.assertRaises(snmp.SNMPError, snmp.walk, '127.0.0.1', 'public',
+                          IF_NAME, port=port, timeout=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""Tests for circuslib.sync
+
+Run with: python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from circuslib import sync
+
+
+class FakeApi(object):
+    """Lists a fixed set of resources, and records refreshes"""
+    def __init__(self, resources):
+        self.resources = resources
+        self.refreshed = []
+
+    def refresh(self, endpoint):
+        self.refreshed.append(endpoint)
+
+    def iter_list(self, endpoint):
+        return iter([dict(r) for r in self.resources
+                     if r['_cid'].startswith(endpoint + '/')])
+
+
+class DiffTest(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeApi([
+            {'_cid': '/graph/1', 'title': 'web', 'datapoints': [],
+             'notes': 'changed since', 'tags': ['dc:east']},
+            {'_cid': '/graph/2', 'title': 'db', 'datapoints': [],
+             'tags': []}])
+
+    def diff(self, desired, prune=False):
+        return list(sync.diff(self.api, desired, prune=prune))
+
+    def test_update_sends_only_desired_and_required_fields(self):
+        changes = self.diff([{'_cid': '/graph', 'title': 'web',
+                              'tags': ['dc:west']}])
+        self.assertEqual(self.api.refreshed, ['graph'])
+        self.assertEqual(changes, [{
+            'action': 'PUT', 'endpoint': '/graph/1',
+            'data': {'_cid': '/graph/1', 'title': 'web', 'datapoints': [],
+                     'tags': ['dc:west']},
+            'description': 'Updating /graph/1 (web)'}])
+
+    def test_unchanged(self):
+        self.assertEqual(self.diff([{'_cid': '/graph/2', 'tags': []}]), [])
+
+    def test_missing_id_is_not_added(self):
+        changes = self.diff([{'_cid': '/graph/99', 'title': 'new'},
+                             {'_cid': '/graph', 'title': 'new'}])
+        self.assertEqual([(c['action'], c['endpoint']) for c in changes],
+                         [('POST', '/graph')])
+
+    def test_prune(self):
+        changes = self.diff([{'_cid': '/graph', 'title': 'web'}],
+                            prune=True)
+        self.assertEqual([(c['action'], c['endpoint']) for c in changes],
+                         [('DELETE', '/graph/2')])
+
+
+if __name__ == '__main__':
+    unittest.main()
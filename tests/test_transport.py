@@ -0,0 +1,164 @@
+"""Tests for circuslib.transport against a local http server
+
+Run with: python -m unittest discover tests
+"""
+import BaseHTTPServer
+import SocketServer
+import httplib
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from circuslib import cache, client, transport
+
+
+class RecordingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.bodies.append(body)
+        data = json.loads(body)
+        if data.get('slow'):
+            time.sleep(self.server.slow_delay)
+        response = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(response))
+        self.end_headers()
+        self.wfile.write(response)
+        if data.get('close'):
+            # Close the connection after answering without saying so, as a
+            # server does when it times out an idle keep-alive connection
+            self.close_connection = 1
+
+    do_PUT = do_POST
+
+    def do_GET(self):
+        response = json.dumps(self.server.listing)
+        self.send_response(200)
+        if self.server.compress:
+            response = transport.compress(response)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(response))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class RecordingServer(SocketServer.ThreadingMixIn,
+                      BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    slow_delay = 1.5
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           RecordingHandler)
+        self.bodies = []
+        self.listing = [{'_cid': '/graph/%s' % i, 'title': 'graph %s' % i}
+                        for i in range(1000)]
+        self.compress = False
+
+    def handle_error(self, request, address):
+        pass
+
+
+class ServerTestCase(unittest.TestCase):
+    """Starts a RecordingServer, with a Transport pointing at it"""
+    def setUp(self):
+        self.server = RecordingServer()
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.api = transport.Transport(
+            'token', '127.0.0.1', port=self.server.server_address[1],
+            secure=False, timeout=1)
+
+    def tearDown(self):
+        self.api.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TransportTest(ServerTestCase):
+    def test_timeout_on_reused_connection_is_not_resent(self):
+        self.api.api_call('POST', '/check_bundle', {'n': 1})
+        self.assertRaises(socket.timeout, self.api.api_call, 'POST',
+                          '/check_bundle', {'slow': True, 'n': 2})
+        # Give the server time to finish (and to show any second copy)
+        time.sleep(self.server.slow_delay + 0.5)
+        slow = [b for b in self.server.bodies if json.loads(b).get('slow')]
+        self.assertEqual(len(slow), 1)
+        self.assertEqual(self.api.pool.created, 1)
+
+    def test_closed_connection_is_retried_for_idempotent_calls(self):
+        self.api.api_call('PUT', '/graph/1', {'n': 1, 'close': True})
+        time.sleep(0.2)
+        self.assertEqual(self.api.api_call('PUT', '/graph/1', {'n': 2}),
+                         {'n': 2})
+        self.assertEqual(self.api.pool.created, 2)
+        self.assertEqual(len(self.server.bodies), 2)
+
+    def test_closed_connection_is_not_retried_for_post(self):
+        self.api.api_call('POST', '/graph', {'n': 1, 'close': True})
+        time.sleep(0.2)
+        self.assertRaises((httplib.HTTPException, socket.error),
+                          self.api.api_call, 'POST', '/graph', {'n': 2})
+
+    def test_is_stale(self):
+        self.assertFalse(transport.is_stale(socket.timeout(), False, 'GET'))
+        self.assertTrue(transport.is_stale(httplib.CannotSendRequest(), True,
+                                           'POST'))
+        closed = httplib.BadStatusLine('')
+        self.assertTrue(transport.is_stale(closed, True, 'PUT'))
+        self.assertFalse(transport.is_stale(closed, True, 'POST'))
+        self.assertFalse(transport.is_stale(httplib.BadStatusLine('junk'),
+                                            True, 'GET'))
+
+
+class DownloadTest(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.cache = cache.Cache('test', directory=self.directory)
+        self.client = client.Client(self.api, cache=self.cache)
+        # Listings must not be decoded as a whole
+        self.api.api_call = None
+
+    def tearDown(self):
+        ServerTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def test_download(self):
+        for compress in (False, True):
+            self.server.compress = compress
+            fh = StringIO.StringIO()
+            self.api.download('/graph', fh)
+            self.assertEqual(json.loads(fh.getvalue()), self.server.listing)
+
+    def test_iter_list_downloads_to_cache(self):
+        self.server.compress = True
+        self.assertEqual(list(self.client.iter_list('/graph')),
+                         self.server.listing)
+        with open(self.cache.path('graph')) as fh:
+            self.assertEqual(json.load(fh), self.server.listing)
+
+    def test_iter_list_without_cache(self):
+        self.client.cache = None
+        self.assertEqual(list(self.client.iter_list('/graph')),
+                         self.server.listing)
+
+
+if __name__ == '__main__':
+    unittest.main()